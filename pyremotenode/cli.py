@@ -1,9 +1,20 @@
 import argparse
+import glob
 import logging
+import logging.handlers
+import lzma
 import os
 import traceback
+import zlib
+from datetime import datetime
 
+from pyremotenode.comms.compression import train_dictionary
+from pyremotenode.comms.framing import Reassembler, decode_message, is_fragment
+from pyremotenode.receiver.aio import AsyncDataReceiver
 from pyremotenode.receiver.certus import JSONDataReceiver, DataReceiverHandler
+from pyremotenode.receiver.rudics import RudicsReceiver, RudicsReceiverHandler
+from pyremotenode.receiver.storage import SegmentStore, compact, segment_paths
+from pyremotenode.receiver.workers import WorkerSupervisor
 from pyremotenode.schedule import Scheduler
 from pyremotenode.utils import Configuration, setup_logging
 from pyremotenode.utils.system import background_fork
@@ -87,20 +98,182 @@ def receiver_main():
     a.add_argument("--verbose", "-v", help="Debugging information",
                    default=False, action="store_true")
     a.add_argument("--host-server", "-s", type=str, default="0.0.0.0")
+    a.add_argument("--rudics", "-r", help="Receive files from RUDICS data calls rather than Certus JSON",
+                   default=False, action="store_true")
+    a.add_argument("--asyncio", "-a", help="Serve Certus connections from a single event loop, rather than a "
+                                            "thread per connection", default=False, action="store_true")
+    a.add_argument("--max-connections", "-c", help="Most connections served at once with --asyncio, others wait",
+                   type=int, default=128)
+    a.add_argument("--timeout", "-t", help="Seconds a connection can be idle before it's dropped",
+                   type=float, default=60.)
+    a.add_argument("--no-crc16", help="Certus payloads don't carry the trailing CRC16 the node writes with each "
+                                      "message, so there's nothing to check and remove",
+                   dest="crc16", default=True, action="store_false")
+    a.add_argument("--storage", help="Write each Certus payload to its own file, or append them to segment logs "
+                                     "partitioned by day and unit", choices=["files", "segments"], default="files")
+    a.add_argument("--sync-delay", help="Seconds to hold back each sync of the segment logs, to batch more "
+                                        "payloads into it", type=float, default=0.)
+    a.add_argument("--workers", "-w", help="Serve Certus connections from this many processes sharing the port, "
+                                           "restarting any that die", type=int, default=0)
     a.add_argument("port", help="TCP port to listen on", type=int)
     a.add_argument("directory", help="Output directory")
     args = a.parse_args()
 
+    if args.asyncio and args.rudics:
+        a.error("--asyncio only applies to receiving from Certus")
+    if args.workers and args.rudics:
+        a.error("--workers only applies to receiving from Certus")
+    if args.workers < 0:
+        a.error("--workers can't be negative")
+
     if not args.no_daemon:
         background_fork()
 
     setup_logging("{}".format("receiver.{}".format(args.port)),
                   logdir=args.log_dir,
                   verbose=args.verbose)
-    ss = JSONDataReceiver((args.host_server, args.port),
-                          DataReceiverHandler,
-                          args.directory)
+
+    if not args.workers:
+        _serve(args)
+        return
+
+    def worker_main(worker):
+        # Each worker logs to its own file, so they don't fight over rotating a shared one
+        for handler in [h for h in logging.getLogger().handlers
+                        if isinstance(h, logging.handlers.TimedRotatingFileHandler)]:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+        setup_logging("receiver.{}.w{}".format(args.port, worker),
+                      logdir=args.log_dir,
+                      verbose=args.verbose)
+        _serve(args, worker)
+
+    logging.info("Starting {} workers".format(args.workers))
+    WorkerSupervisor(args.workers, worker_main).run()
+
+
+def _serve(args, worker=None):
+    store = SegmentStore(args.directory, sync_delay=args.sync_delay, writer=worker) \
+        if args.storage == "segments" else None
+
+    if args.rudics:
+        ss = RudicsReceiver((args.host_server, args.port),
+                            RudicsReceiverHandler,
+                            args.directory,
+                            timeout=args.timeout)
+    elif args.asyncio:
+        ss = AsyncDataReceiver((args.host_server, args.port),
+                               args.directory,
+                               crc16=args.crc16,
+                               store=store,
+                               max_connections=args.max_connections,
+                               timeout=args.timeout,
+                               worker=worker)
+    else:
+        ss = JSONDataReceiver((args.host_server, args.port),
+                              DataReceiverHandler,
+                              args.directory,
+                              crc16=args.crc16,
+                              timeout=args.timeout,
+                              store=store,
+                              worker=worker)
     logging.info("Starting server")
-    ss.serve_forever()
+    try:
+        ss.serve_forever()
+    finally:
+        if store is not None:
+            store.close()
     logging.info("Stopped listening for data...")
 
+
+def compactor_main():
+    a = argparse.ArgumentParser(description="Compact the segment logs written by run_receiver --storage segments")
+    a.add_argument("--before", "-b", help="Only compact partitions of days before this one, as YYYY-MM-DD, "
+                                          "defaults to today so the partitions still being written are left alone",
+                   default=datetime.utcnow().strftime("%Y-%m-%d"))
+    a.add_argument("--verbose", "-v", help="Debugging information",
+                   default=False, action="store_true")
+    a.add_argument("directory", help="Receiver output directory")
+    args = a.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="[%(asctime)-20s :%(levelname)-8s] - %(message)s")
+
+    kept, dropped = 0, 0
+    for day_dir in sorted(glob.glob(os.path.join(args.directory, "[0-9]" * 4, "[0-9]" * 2, "[0-9]" * 2))):
+        day = "-".join(os.path.relpath(day_dir, args.directory).split(os.sep))
+        if day >= args.before:
+            continue
+
+        for unit in sorted(os.listdir(day_dir)):
+            partition = os.path.join(day_dir, unit)
+            if len(segment_paths(partition)) < 2 and not os.path.exists(os.path.join(partition, ".compact")):
+                continue
+            partition_kept, partition_dropped = compact(partition)
+            kept += partition_kept
+            dropped += partition_dropped
+    logging.info("Compaction kept {} records and dropped {}".format(kept, dropped))
+
+
+def decoder_main():
+    a = argparse.ArgumentParser(description="Decode messages received from a remote node into the messages "
+                                            "originally queued on it")
+    a.add_argument("--output", "-o", help="Directory to write decoded messages to", default=".")
+    a.add_argument("--dictionary", "-d", help="Compression dictionary the node may have used, can be repeated",
+                   default=[], action="append")
+    a.add_argument("--raw", "-r", help="The node doesn't pack, fragment or compress its messages, so they're "
+                                       "raw and written out as they are, whatever they start with",
+                   default=False, action="store_true")
+    a.add_argument("--train-dictionary", "-t",
+                   help="Instead of decoding, train a compression dictionary from the (decoded) message files "
+                        "and write it to this path for deployment to the node")
+    a.add_argument("--verbose", "-v", help="Debugging information",
+                   default=False, action="store_true")
+    a.add_argument("messages", help="Received message files", nargs="+")
+    args = a.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="[%(asctime)-20s :%(levelname)-8s] - %(message)s")
+
+    if args.train_dictionary:
+        samples = []
+        for path in args.messages:
+            with open(path, "rb") as fh:
+                samples.append(fh.read())
+
+        with open(args.train_dictionary, "wb") as fh:
+            fh.write(train_dictionary(samples))
+        return
+
+    dictionaries = []
+    for path in args.dictionary:
+        with open(path, "rb") as fh:
+            dictionaries.append(fh.read())
+
+    os.makedirs(args.output, exist_ok=True)
+    # Fragments can be spread across any of the files given, a message is written out named after its last fragment
+    reassembler = Reassembler()
+
+    for path in args.messages:
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+
+            if not args.raw and is_fragment(data):
+                data = reassembler.add(data)
+                if data is None:
+                    continue
+            records = decode_message(data, dictionaries, framed=not args.raw)
+        except (OSError, ValueError, EOFError, lzma.LZMAError, zlib.error) as e:
+            logging.error("Could not decode {}: {}".format(path, e))
+            continue
+
+        for i, record in enumerate(records):
+            output_file = os.path.join(args.output, "{}.{:03d}".format(os.path.basename(path), i))
+            with open(output_file, "wb") as fh:
+                fh.write(record)
+        logging.info("Decoded {} messages from {}".format(len(records), path))
+
+    for (message_id, count), missing in reassembler.missing().items():
+        logging.warning("Message {:#010x} is incomplete, missing {} of its {} fragments: {}".format(
+            message_id, len(missing), count, missing))
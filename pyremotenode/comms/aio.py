@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import os
+import threading as t
+import time as tm
+from contextlib import contextmanager
+
+from pyremotenode.comms.responses import ResponseParser
+from pyremotenode.comms.unsolicited import ResponseRouter
+
+
+class AsyncModemDriver(object):
+    """ asyncio driver for the modem serial port
+
+    The port is switched to non-blocking and watched by the event loop, so reads and writes never block a thread.
+    Commands from any number of coroutines are serialised onto the port in the order they're awaited and
+    unsolicited result codes are dispatched to registered handlers as they arrive.
+
+    Everything here must be called from the loop the driver was created with.
+    """
+    def __init__(self, data_conn, loop, terminator="\r"):
+        self._conn = data_conn
+        self._loop = loop
+        self._terminator = terminator
+
+        self._fd = None
+        self._router = ResponseRouter()
+        self._lock = None
+        self._parser = None
+        self._waiter = None
+        self._received = 0
+        self._last_read = None
+        self._reading = False
+
+    def register(self, pattern, handler):
+        self._router.register(pattern, handler)
+
+    def dispatch(self, line):
+        return self._router.dispatch(line)
+
+    async def open(self):
+        self._lock = asyncio.Lock()
+        self._fd = self._conn.fileno()
+        os.set_blocking(self._fd, False)
+        self.resume()
+
+    def close(self):
+        self.pause()
+        if self._waiter and not self._waiter.done():
+            self._waiter.cancel()
+
+    def pause(self):
+        if self._reading:
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+
+    def resume(self):
+        if not self._reading:
+            self._loop.add_reader(self._fd, self._on_readable)
+            self._reading = True
+
+    async def command(self, parser, data, msg_timeout):
+        """Write a command and wait for the parser to complete
+
+        Args:
+            parser: ResponseParser for the command response
+            data: bytes, or list of bytes-like objects, to write to the modem
+            msg_timeout: seconds of silence on the line before we give up
+
+        Returns:
+            number of bytes fed to the parser
+        """
+        async with self._lock:
+            return await self._command(parser, data, msg_timeout)
+
+    async def modem_command(self,
+                            message,
+                            raw=False,
+                            msg_timeout=20.0,
+                            **kwargs):
+        """Coroutine equivalent of BaseConnection.modem_response
+
+        Args:
+            message: command string, or bytes if raw
+            raw: write message as is, without the terminator
+            msg_timeout: seconds of silence on the line before we give up
+            kwargs: passed to the ResponseParser
+
+        Returns:
+            ModemResponse, which will have no result if the modem went quiet without one
+        """
+        async with self._lock:
+            return await self._modem_command(message, raw, msg_timeout, **kwargs)
+
+    async def send_binary(self, command, buffers, msg_timeout=20.0):
+        """Write a binary message announced by a command, eg. AT+SBDWB or AT+IMTWB
+
+        The command and the binary that follows it are written without any other command getting in between.
+
+        Args:
+            command: announcing the binary, which the modem answers with READY
+            buffers: list of bytes-like objects making up the binary, including any checksum
+            msg_timeout: seconds of silence on the line before we give up
+
+        Returns:
+            ModemResponse to the binary, or to the command if the modem wasn't ready for it
+        """
+        async with self._lock:
+            response = await self._modem_command(command, msg_timeout=msg_timeout)
+            if response.result != "READY":
+                return response
+            return await self._modem_command(list(buffers), raw=True, msg_timeout=msg_timeout)
+
+    async def _command(self, parser, data, msg_timeout):
+        # Called holding the lock
+        self._parser = parser
+        self._router.expect(parser)
+        self._received = 0
+        self._last_read = tm.monotonic()
+        self._waiter = self._loop.create_future()
+
+        try:
+            for buf in data if isinstance(data, (list, tuple)) else [data]:
+                await self._write(buf)
+
+            while not self._waiter.done():
+                remaining = self._last_read + msg_timeout - tm.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._waiter), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            return self._received
+        finally:
+            self._router.expect(None)
+            self._parser = None
+            self._waiter = None
+
+    async def _modem_command(self, message, raw=False, msg_timeout=20.0, **kwargs):
+        data = message if raw else "{}{}".format(message.strip(), self._terminator).encode("latin-1")
+        parser = ResponseParser(unsolicited=self.dispatch, **kwargs)
+        await self._command(parser, data, msg_timeout)
+        return parser.response()
+
+    async def _write(self, data):
+        view = memoryview(data)
+
+        while len(view):
+            try:
+                written = os.write(self._fd, view)
+            except BlockingIOError:
+                written = 0
+            view = view[written:]
+
+            if len(view):
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            logging.exception("Could not read from the modem, no longer watching the port")
+            self.pause()
+            return
+
+        if not data:
+            return
+
+        if self._router.expecting:
+            self._received += len(data)
+            self._last_read = tm.monotonic()
+        self._router.feed(data)
+
+        if self._parser is not None and self._parser.complete and not self._waiter.done():
+            self._waiter.set_result(True)
+
+
+class SyncModemFacade(object):
+    """ Blocking access to an AsyncModemDriver for the threaded tasks and connections
+
+    The driver's event loop runs in a single thread that owns the serial port. Callers from any other thread
+    block on their own command only, with the loop queueing commands rather than tasks contending for the port.
+    This presents the same interface as the UnsolicitedDispatcher so BaseConnection can use either.
+    """
+    def __init__(self, data_conn, terminator="\r"):
+        self._loop = asyncio.new_event_loop()
+        self._driver = AsyncModemDriver(data_conn, self._loop, terminator)
+        self._paused = False
+        self._thread = None
+
+    def register(self, pattern, handler):
+        if self._thread:
+            self._loop.call_soon_threadsafe(self._driver.register, pattern, handler)
+        else:
+            self._driver.register(pattern, handler)
+
+    def dispatch(self, line):
+        return self._driver.dispatch(line)
+
+    def run(self, coro):
+        """Run a coroutine on the driver loop and block for its result"""
+        if t.current_thread() is self._thread:
+            raise RuntimeError("Cannot block on the modem from within its own event loop")
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def command(self, parser, data, msg_timeout):
+        return self.run(self._driver.command(parser, data, msg_timeout))
+
+    def send_binary(self, command, buffers, msg_timeout=20.0):
+        return self.run(self._driver.send_binary(command, buffers, msg_timeout))
+
+    @contextmanager
+    def paused(self):
+        self._loop.call_soon_threadsafe(self._driver.pause)
+        self.run(asyncio.sleep(0))
+        self._paused = True
+        try:
+            yield
+        finally:
+            self._paused = False
+            self._loop.call_soon_threadsafe(self._driver.resume)
+
+    def start(self):
+        if not self._thread:
+            logging.info("Starting asyncio modem transport")
+            ready = t.Event()
+
+            def _run():
+                asyncio.set_event_loop(self._loop)
+                try:
+                    self._loop.run_until_complete(self._driver.open())
+                finally:
+                    ready.set()
+                self._loop.run_forever()
+
+            self._thread = t.Thread(name=self.__class__.__name__, target=_run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+            ready.wait()
+
+    def stop(self):
+        if self._thread:
+            logging.info("Stopping asyncio modem transport")
+            self._loop.call_soon_threadsafe(self._driver.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            if self._thread is not t.current_thread():
+                self._thread.join()
+                self._loop.close()
+            self._thread = None
+
+    @property
+    def active(self):
+        return self._thread is not None and not self._paused
+
+    @property
+    def driver(self):
+        return self._driver
+
+    @property
+    def loop(self):
+        return self._loop
@@ -0,0 +1,145 @@
+import binascii
+import bz2
+import collections
+import logging
+import lzma
+import zlib
+
+# One byte header values, kept clear of printable text and the packed frame marker so encoded messages are
+# recognisable on the ground
+ENCODING_RAW = 0xe0
+ENCODING_DEFLATE = 0xe1
+ENCODING_DEFLATE_DICT = 0xe2
+ENCODING_LZMA = 0xe3
+ENCODING_BZ2 = 0xe4
+
+ENCODINGS = (ENCODING_RAW, ENCODING_DEFLATE, ENCODING_DEFLATE_DICT, ENCODING_LZMA, ENCODING_BZ2)
+
+# Raw streams avoid paying for container headers and checksums on every message, the link has its own checks
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 9}]
+DEFLATE_WBITS = -15
+MAX_DICTIONARY = 32768
+
+
+def dictionary_id(dictionary):
+    return binascii.crc32(dictionary) & 0xff
+
+
+class Compressor(object):
+    """ Picks the smallest encoding for each message
+
+    Every encoded message starts with a one byte header naming the encoding. Deflate with a preset dictionary is
+    followed by a one byte dictionary id so the ground can pick the matching dictionary. Messages that don't
+    compress are sent raw behind the header, so the worst case costs a single byte.
+    """
+    def __init__(self, dictionary=None, level=9):
+        self._dictionary = dictionary[-MAX_DICTIONARY:] if dictionary else None
+        self._level = level
+
+    def encode(self, data):
+        candidates = [
+            bytes([ENCODING_RAW]) + data,
+            bytes([ENCODING_DEFLATE]) + self._deflate(data),
+        ]
+        if self._dictionary:
+            candidates.append(bytes([ENCODING_DEFLATE_DICT, dictionary_id(self._dictionary)])
+                              + self._deflate(data, self._dictionary))
+        # These only pay off once there's a decent amount of data to amortise their stream overheads
+        if len(data) > 512:
+            candidates.append(bytes([ENCODING_LZMA]) + lzma.compress(
+                data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS))
+            candidates.append(bytes([ENCODING_BZ2]) + bz2.compress(data, self._level))
+
+        encoded = min(candidates, key=len)
+        logging.debug("Encoded {} bytes as {} bytes with encoding {:#x}".format(len(data), len(encoded), encoded[0]))
+        return encoded
+
+    def _deflate(self, data, dictionary=None):
+        if dictionary:
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, DEFLATE_WBITS, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, DEFLATE_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+
+def decode(data, dictionaries=None):
+    """Reverse Compressor.encode
+
+    Args:
+        data: bytes of an encoded message
+        dictionaries: list of preset dictionaries that may have been used
+
+    Returns:
+        bytes of the original message
+    """
+    if not len(data) or data[0] not in ENCODINGS:
+        raise ValueError("Not an encoded message")
+
+    encoding = data[0]
+    body = bytes(data[1:])
+
+    if encoding == ENCODING_RAW:
+        return body
+    elif encoding == ENCODING_DEFLATE:
+        return zlib.decompressobj(DEFLATE_WBITS).decompress(body)
+    elif encoding == ENCODING_DEFLATE_DICT:
+        for dictionary in [d[-MAX_DICTIONARY:] for d in (dictionaries or [])]:
+            if len(body) and dictionary_id(dictionary) == body[0]:
+                return zlib.decompressobj(DEFLATE_WBITS, zdict=dictionary).decompress(body[1:])
+        raise ValueError("No dictionary available with id {:#x}".format(body[0] if len(body) else -1))
+    elif encoding == ENCODING_LZMA:
+        return lzma.decompress(body, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    return bz2.decompress(body)
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY, segment=32, kmer=6):
+    """Build a preset dictionary from previously sent messages
+
+    A simplified take on the cover algorithm: samples are split into segments, each segment is scored by how many
+    samples contain each of its k-mers and the best segments are kept. The best are placed at the end of the
+    dictionary, where deflate can reach them most cheaply.
+
+    Args:
+        samples: list of bytes, the more representative the better
+        size: maximum dictionary size in bytes
+        segment: length of the segments considered for inclusion
+        kmer: length of the substrings used to score segments
+
+    Returns:
+        bytes of the dictionary
+    """
+    frequency = collections.Counter()
+    for sample in samples:
+        frequency.update(set(sample[i:i + kmer] for i in range(len(sample) - kmer + 1)))
+
+    scored = dict()
+    for sample in samples:
+        for start in range(0, max(len(sample) - kmer + 1, 1), segment):
+            chunk = bytes(sample[start:start + segment])
+            if chunk in scored:
+                continue
+            scored[chunk] = sum(frequency[chunk[i:i + kmer]] - 1 for i in range(len(chunk) - kmer + 1))
+
+    selected = []
+    total = 0
+    for chunk, score in sorted(scored.items(), key=lambda item: item[1], reverse=True):
+        if score <= 0 or total + len(chunk) > size:
+            continue
+        selected.append(chunk)
+        total += len(chunk)
+
+    logging.info("Trained {} byte dictionary from {} samples".format(total, len(samples)))
+    return b"".join(reversed(selected))
+
+
+class CompressedMessage(object):
+    """ Stands in for a Message once its content has been encoded """
+    def __init__(self, data, compressor):
+        self._encoded = compressor.encode(data)
+
+    def get_message_text(self):
+        return self._encoded
+
+    @property
+    def binary(self):
+        return True
@@ -2,13 +2,22 @@ from abc import ABCMeta, abstractmethod
 import logging
 import os
 import queue
+import random
 import re
 import threading as t
 import time as tm
 import traceback
 from datetime import datetime
 
-from pyremotenode.comms.utils import ModemLock
+from pyremotenode.comms.aio import SyncModemFacade
+from pyremotenode.comms.compression import CompressedMessage, Compressor
+from pyremotenode.comms.framing import FragmentMessage, PackedMessage, fragment, is_framed, message_bytes, \
+    packed_size
+from pyremotenode.comms.queues import MessageQueue, PersistentMessageQueue
+from pyremotenode.comms.responses import ResponseParser
+from pyremotenode.comms.transfer import ChunkSizer, TransferJournal
+from pyremotenode.comms.unsolicited import UnsolicitedDispatcher
+from pyremotenode.comms.utils import ModemPower, ModemSession
 
 import serial
 
@@ -32,19 +41,9 @@ class BaseConnection(metaclass=ABCMeta):
     priority_message_mo = 1
     priority_file_mo = 2
 
-    re_modem_resp = re.compile(b"""(OK
-                                    |ERROR
-                                    |BUSY
-                                    |NO\ DIALTONE
-                                    |NO\ CARRIER
-                                    |RING
-                                    |NO\ ANSWER
-                                    |READY
-                                    |GOFORIT
-                                    |NAMERECV
-                                    |CONNECT(?:\s\d+)?)
-                                    [\r\n]*$""", re.X)
     re_signal = re.compile(r'^\+CSQ: *(?:[\-+\d]+,)?(\d)', re.MULTILINE)
+    # Unsolicited result code notifying us of MT traffic, implementations should override this
+    re_unsolicited_mt = None
 
     def __init__(self, cfg, *args, **kwargs):
         self._thread = None
@@ -56,8 +55,13 @@ class BaseConnection(metaclass=ABCMeta):
 
         self._data_conn = None
         self._dataxfer_errors = 0
-        self._message_queue = queue.PriorityQueue()
-        self._modem_lock = ModemLock()
+        self._last_write = 0.
+        self._dispatcher = None
+        self._mt_pending = t.Event()
+        self._wakeup = t.Event()
+        self._unsolicited_handlers = []
+        self._modem_power = ModemPower()
+        self._modem_session = ModemSession(self, self._modem_power)
         self._modem_wait = float(self._modem_wait)
         # TODO: This should be synchronized, but we won't really run into those issues with it as we never switch
         #  the modem off whilst it's running
@@ -91,6 +95,61 @@ class BaseConnection(metaclass=ABCMeta):
             if 'msg_attempts' in cfg['ModemConnection'] else 3
         self.msg_gap = int(cfg['ModemConnection']['msg_gap']) \
             if 'msg_gap' in cfg['ModemConnection'] else 1
+        self.unsolicited = str(cfg['ModemConnection']['unsolicited']).lower() in ["true", "yes", "1"] \
+            if 'unsolicited' in cfg['ModemConnection'] else False
+        # "thread" reads the port from whoever is issuing a command, "asyncio" gives the port to an event loop
+        self.transport = cfg['ModemConnection']['transport'] \
+            if 'transport' in cfg['ModemConnection'] else "thread"
+        self.state_dir = cfg['ModemConnection']['state_dir'] \
+            if 'state_dir' in cfg['ModemConnection'] else (
+            os.path.join(os.sep, "data", "pyremotenode", "state"))
+        # Only send what's been appended to files that have been sent before, rather than the whole file
+        self.delta_transfers = str(cfg['ModemConnection']['delta_transfers']).lower() in ["true", "yes", "1"] \
+            if 'delta_transfers' in cfg['ModemConnection'] else False
+        # Size file chunks and packed frames from how the link is doing, rather than always at the maximum
+        self.adaptive_sizing = str(cfg['ModemConnection']['adaptive_sizing']).lower() in ["true", "yes", "1"] \
+            if 'adaptive_sizing' in cfg['ModemConnection'] else False
+        self.adaptive_min_bytes = int(cfg['ModemConnection']['adaptive_min_bytes']) \
+            if 'adaptive_min_bytes' in cfg['ModemConnection'] else 256
+        # Hand every queued file to the connection at once, eg. so RUDICS can send them all in a single call
+        self.batch_transfers = str(cfg['ModemConnection']['batch_transfers']).lower() in ["true", "yes", "1"] \
+            if 'batch_transfers' in cfg['ModemConnection'] else False
+        # Split MO messages too big for the connection into fragments, rather than truncating or dropping them
+        self.fragment_messages = str(cfg['ModemConnection']['fragment_messages']).lower() in ["true", "yes", "1"] \
+            if 'fragment_messages' in cfg['ModemConnection'] else False
+        self.persistent_queue = str(cfg['ModemConnection']['persistent_queue']).lower() in ["true", "yes", "1"] \
+            if 'persistent_queue' in cfg['ModemConnection'] else False
+
+        # Coalesce queued messages into frames of up to max_message_bytes, optionally waiting pack_window seconds
+        # for more messages to arrive before starting a session
+        self.pack_messages = str(cfg['ModemConnection']['pack_messages']).lower() in ["true", "yes", "1"] \
+            if 'pack_messages' in cfg['ModemConnection'] else False
+        self.pack_window = float(cfg['ModemConnection']['pack_window']) \
+            if 'pack_window' in cfg['ModemConnection'] else 0.
+
+        # Encode each MO message with whichever of the available compressions is smallest
+        self.compression = str(cfg['ModemConnection']['compression']).lower() in ["true", "yes", "1"] \
+            if 'compression' in cfg['ModemConnection'] else False
+        self.compression_dictionary = cfg['ModemConnection']['compression_dictionary'] \
+            if 'compression_dictionary' in cfg['ModemConnection'] else None
+
+        self._compressor = None
+        if self.compression:
+            dictionary = None
+            if self.compression_dictionary:
+                with open(self.compression_dictionary, "rb") as fh:
+                    dictionary = fh.read()
+                logging.info("Loaded {} byte compression dictionary {}".format(
+                    len(dictionary), self.compression_dictionary))
+            self._compressor = Compressor(dictionary)
+
+        self._message_queue = PersistentMessageQueue(os.path.join(self.state_dir, "message_queue.db")) \
+            if self.persistent_queue else MessageQueue()
+
+        self._transfer_journal = None
+        self._chunk_sizer = None
+        # Fragmented messages are numbered on from a random start, so ids aren't reused after the node restarts
+        self._fragment_id = random.getrandbits(32)
 
         self.terminator = "\r"
 
@@ -101,6 +160,14 @@ class BaseConnection(metaclass=ABCMeta):
         logging.debug("Creating {}".format(self.__class__.__name__))
 
     def close(self):
+        # Link statistics only hold for the session they were gathered in
+        if self._chunk_sizer:
+            self._chunk_sizer.reset()
+
+        if self._dispatcher:
+            self._dispatcher.stop()
+            self._dispatcher = None
+
         if self.data_conn and self.data_conn.is_open:
             logging.debug("Closing and removing modem serial connection")
             self.data_conn.close()
@@ -134,12 +201,41 @@ class BaseConnection(metaclass=ABCMeta):
             if not self.data_conn.is_open:
                 logging.info("Opening existing modem serial connection")
                 self.data_conn.open()
-            # TODO: Shared object now between threads, at startup, don't think this needs to be present
             else:
-                logging.warning("Modem appears to already be open, wasn't previously closed!?!")
+                logging.debug("Reusing open modem serial connection")
+
+        self._start_dispatcher()
 
         # TODO: The method for registration check could be abstracted, but probably unnecessary - review
 
+    def register_unsolicited(self, pattern, handler):
+        """Register a handler for an unsolicited result code, used when unsolicited is configured
+
+        Args:
+            pattern: compiled regular expression to match the line against
+            handler: callable receiving the line and match, called from the reader thread
+        """
+        self._unsolicited_handlers.append((pattern, handler))
+        if self._dispatcher:
+            self._dispatcher.register(pattern, handler)
+
+    def _on_unsolicited_mt(self, line, match):
+        logging.info("Modem has notified us of MT traffic")
+        self._mt_pending.set()
+        self._wakeup.set()
+
+    def _start_dispatcher(self):
+        if self._dispatcher or not (self.unsolicited or self.transport == "asyncio"):
+            return
+
+        self._dispatcher = SyncModemFacade(self.data_conn, self.terminator) \
+            if self.transport == "asyncio" else UnsolicitedDispatcher(self.data_conn)
+        if self.re_unsolicited_mt:
+            self._dispatcher.register(self.re_unsolicited_mt, self._on_unsolicited_mt)
+        for pattern, handler in self._unsolicited_handlers:
+            self._dispatcher.register(pattern, handler)
+        self._dispatcher.start()
+
     def modem_command(self,
                       message,
                       raw=False,
@@ -149,84 +245,163 @@ class BaseConnection(metaclass=ABCMeta):
         send message through data port and recieve reply. If no reply, will timeout according to the
         data_timeout config setting
 
+        Retained for callers that want the reply as a single string (or the raw bytes with dont_decode), see
+        modem_response for the parsed equivalent
+        """
+        response = self.modem_response(message, raw=raw, timeout_override=timeout_override)
+
+        if dont_decode:
+            return response.raw
+        return str(response)
+
+    def modem_response(self,
+                       message,
+                       raw=False,
+                       timeout_override=None,
+                       binary_length=None,
+                       length_prefixed=False,
+                       results=None,
+                       binary_sink=None):
+        """
+        send message through data port and parse the reply as it arrives. If no reply, will timeout according to
+        the msg_timeout config setting
+
         python 3 requires the messages to be in binary format - so encode them, and also decode response.
         'latin-1' encoding is used to allow for sending file blocks which have bytes in range 0-255,
         whereas the standard or 'ascii' encoding only allows bytes in range 0-127
 
-        readline() is used for most messages as it will block only until the full reply (a signle line) has been
-        returned, or if no reply recieved, until the timeout. However, file_transfer_messages (downloading file
-        blocks) may contain numerous newlines, and hence read() must be used (with an excessive upper limit; the
-        maximum message size is ~2000 bytes), returning at the end of the configured timeout - make sure it is long enough!
+        The reply is read with blocking reads that return as soon as the modem gives a final result code, or
+        after msg_timeout (or timeout_override) seconds of silence on the line - make sure it is long enough!
+
+        Args:
+            message: command string, or bytes if raw (a list of bytes-like objects is written in sequence)
+            raw: write message as is, without the terminator
+            timeout_override: seconds of silence to wait for instead of msg_timeout
+            binary_length: expect a binary block of this many bytes before the result
+            length_prefixed: expect a length prefixed binary block (eg. AT+SBDRB) before the result
+            results: additional lines that are a final result for this command
+            binary_sink: callable given the binary block piece by piece as it's read, instead of it being returned
+
+        Returns:
+            ModemResponse, which will have no result if the modem went quiet without one
         """
         if self.data_conn is None or not self.data_conn.is_open:
             raise ConnectionException('Cannot send message; data port is not open')
-        self.data_conn.flushInput()
-        self.data_conn.flushOutput()
 
         if not raw:
-            self.data_conn.write("{}{}".format(message.strip(), self.terminator).encode("latin-1"))
+            data = "{}{}".format(message.strip(), self.terminator).encode("latin-1")
             logging.info('Command sent: "{}"'.format(message.strip()))
         else:
-            self.data_conn.write(message)
-            logging.debug("Binary command of length {} bytes sent".format(len(message)))
-
-        # It seems possible that we don't get a response back sometimes, not sure why. Facilitate breaking comms
-        # for another attempt in this case, else we'll end up in an infinite loop
-        bytes_read = 0
-
-        reply = bytearray()
-        stale_reply_num = 0
-        modem_response = False
-        start = datetime.utcnow()
+            data = message if isinstance(message, (list, tuple)) else [message]
+            logging.debug("Binary command of length {} bytes sent".format(sum(len(d) for d in data)))
 
         msg_timeout = self.msg_timeout
         if timeout_override:
             msg_timeout = timeout_override
 
-        while not modem_response:
-            tm.sleep(0.1)
-            reply += self.data_conn.read_all()
-            bytes_read += len(reply)
-
-            duration = (datetime.utcnow() - start).total_seconds()
-            if not len(reply):
-                if duration > msg_timeout:
-                    logging.warning("We've read 0 bytes continuously for {} seconds, abandoning reads...".format(
-                        duration
-                    ))
-                    # It's up to the caller to handle this scenario, just give back what's available...
-                    raise ConnectionException("Response timeout from serial line...")
-                else:
-                    # logging.debug("Waiting for response...")
-                    tm.sleep(self.msg_wait_period)
-                    continue
+        if self._dispatcher and self._dispatcher.active:
+            # The command's own information response can look like an unsolicited one, eg. +IMTMTS
+            prefix = message.strip()[2:].split("=")[0].rstrip("?") \
+                if not raw and message.strip().upper().startswith("AT") else None
+            parser = ResponseParser(binary_length=binary_length,
+                                    length_prefixed=length_prefixed,
+                                    results=results,
+                                    binary_sink=binary_sink,
+                                    unsolicited=lambda line: not (prefix and line.startswith(prefix))
+                                    and self._dispatcher.dispatch(line))
+
+            self._last_write = tm.monotonic()
+            if not self._dispatcher.command(parser, data, msg_timeout):
+                logging.warning("We've read 0 bytes continuously for {} seconds, abandoning reads...".format(
+                    msg_timeout
+                ))
+                raise ConnectionException("Response timeout from serial line...")
+            elif not parser.complete:
+                logging.warning("We have encountered a stale reply scenario, abandoning further response reads")
+        else:
+            self.data_conn.flushInput()
+            self.data_conn.flushOutput()
+
+            parser = ResponseParser(binary_length=binary_length,
+                                    length_prefixed=length_prefixed,
+                                    results=results,
+                                    binary_sink=binary_sink)
+            for buf in data if raw else [data]:
+                self.data_conn.write(buf)
+            self._last_write = tm.monotonic()
+            self._read_response(parser, msg_timeout)
+        response = parser.response()
+
+        if response.binary is not None:
+            logging.info("Response of {} binary bytes received with result {}".format(
+                len(response.binary), response.result))
+        else:
+            logging.info('Response received: "{}"'.format(response))
+        return response
 
-            start = datetime.utcnow()
-            if not dont_decode:
-                logging.debug("Reply received: '{}'".format(reply.decode().strip()))
+    def modem_binary(self, command, buffers, timeout_override=None):
+        """Write a binary message announced by a command, eg. AT+SBDWB or AT+IMTWB
 
-            cmd_match = self.re_modem_resp.search(reply.strip())
-            if cmd_match:
-                tm.sleep(0.1)
-                if not self.data_conn.in_waiting:
-                    modem_response = True
-            else:
-                if len(reply) == 0:
-                    stale_reply_num += 1
-                else:
-                    stale_reply_num = 0
+        With the asyncio transport nothing else sharing the port can get in between the command and the binary.
+
+        Args:
+            command: announcing the binary, which the modem answers with READY
+            buffers: list of bytes-like objects making up the binary, including any checksum
+            timeout_override: seconds of silence to wait for instead of msg_timeout
 
-                if stale_reply_num > 600:
+        Returns:
+            ModemResponse to the binary, or to the command if the modem wasn't ready for it
+        """
+        if isinstance(self._dispatcher, SyncModemFacade) and self._dispatcher.active:
+            logging.info('Command sent: "{}", followed by {} bytes'.format(command, sum(len(b) for b in buffers)))
+            return self._dispatcher.send_binary(command, buffers, timeout_override or self.msg_timeout)
+
+        response = self.modem_response(command, timeout_override=timeout_override)
+        if response.result != "READY":
+            return response
+        return self.modem_response(list(buffers), raw=True, timeout_override=timeout_override)
+
+    def _read_response(self, parser, msg_timeout):
+        """Block on the serial line until the modem gives a final result code
+
+        Rather than sleeping and polling the input buffer we make blocking reads against the port, waking as soon as
+        the first byte arrives and then draining whatever else is already waiting. Each read is handed to the
+        parser, which only looks at the new bytes. The timeout is measured from the last byte received, so a modem
+        that is still talking is never cut off.
+
+        Args:
+            parser: ResponseParser to feed
+            msg_timeout: seconds of silence on the line before we give up
+        """
+        bytes_read = 0
+        previous_timeout = self.data_conn.timeout
+        deadline = tm.monotonic() + msg_timeout
+
+        try:
+            while not parser.complete:
+                remaining = deadline - tm.monotonic()
+                if remaining <= 0:
+                    if not bytes_read:
+                        logging.warning("We've read 0 bytes continuously for {} seconds, abandoning reads...".format(
+                            msg_timeout
+                        ))
+                        raise ConnectionException("Response timeout from serial line...")
+
+                    # It's up to the caller to handle this scenario, just give back what's available...
                     logging.warning("We have encountered a stale reply scenario, abandoning further response reads")
-                    modem_response = True
+                    break
 
-        if dont_decode:
-            logging.info("Response of {} bytes received".format(bytes_read))
-        else:
-            reply = reply.decode().strip()
-            logging.info('Response received: "{}"'.format(reply))
+                self.data_conn.timeout = remaining
+                data = self.data_conn.read(max(1, self.data_conn.in_waiting))
+                if not data:
+                    continue
 
-        return reply
+                bytes_read += len(data)
+                logging.debug("Read {} bytes, {} in total".format(len(data), bytes_read))
+                parser.feed(data)
+                deadline = tm.monotonic() + msg_timeout
+        finally:
+            self.data_conn.timeout = previous_timeout
 
     def output_recv_message(self,
                             recv_msg_id,
@@ -246,12 +421,7 @@ class BaseConnection(metaclass=ABCMeta):
         else:
             valid = True
 
-        msg_dt = datetime.utcnow().strftime("%d%m%Y%H%M%S")
-        msg_path = self.mt_destination if valid else os.path.join(self.mt_destination, "invalid")
-        os.makedirs(msg_path, exist_ok=True)
-        msg_filename = os.path.join(
-            msg_path,
-            "{}_{}.{}".format(recv_msg_id, msg_dt, "msg" if valid else "bak"))
+        msg_filename = self.recv_message_path(recv_msg_id, valid)
         logging.info("Received MT message, outputting to {}".format(msg_filename))
 
         try:
@@ -260,6 +430,23 @@ class BaseConnection(metaclass=ABCMeta):
         except (OSError, IOError):
             logging.error("Could not write {}, abandoning...".format(payload))
 
+    def recv_message_path(self, recv_msg_id, valid=True):
+        """
+
+        Args:
+            recv_msg_id: identifier the modem gave the MT message
+            valid: whether the message passed its length and checksum checks
+
+        Returns:
+            path to write the received message to, invalid messages being kept apart
+        """
+        msg_dt = datetime.utcnow().strftime("%d%m%Y%H%M%S")
+        msg_path = self.mt_destination if valid else os.path.join(self.mt_destination, "invalid")
+        os.makedirs(msg_path, exist_ok=True)
+        return os.path.join(
+            msg_path,
+            "{}_{}.{}".format(recv_msg_id, msg_dt, "msg" if valid else "bak"))
+
     def poll_for_messages(self):
         pass
 
@@ -275,45 +462,198 @@ class BaseConnection(metaclass=ABCMeta):
         will also check the MT SBD queue with Iridium which will pull down last, so we know all data is out before
         somebody messes with the configuration remotely
 
+        Each entry is only acknowledged, and so removed from the queue, once it's been handled. Failures put it
+        back at the head of the queue to be retried first next time around.
+
         :return: Number of messages processed
         """
         logging.debug("Processing currently queued messages...")
+        num = 0
         while not self.message_queue.empty():
-            msg = self.message_queue.get(timeout=1)
+            priority, item, entry_id = self.message_queue.get(timeout=1)
+
+            if priority == self.priority_message_mo and self.pack_messages:
+                num += self._process_packed_messages(item, entry_id)
+                continue
+            elif priority == self.priority_file_mo and self.batch_transfers:
+                num += self._process_file_batch(item, entry_id)
+                continue
+
             try:
                 ret = False
 
-                if msg[0] == self.priority_message_mo:
-                    ret = self.process_message(msg[1])
-                elif msg[0] == self.priority_file_mo:
-                    ret = self.process_transfer(msg[1])
+                if priority == self.priority_message_mo:
+                    ret = self._send_message(item)
+                elif priority == self.priority_file_mo:
+                    ret = self.process_transfer(item)
                 else:
-                    raise ConnectionException("Invalid message type submitted {}".format(msg[0]))
+                    logging.error("Invalid message type submitted {}, dropping it".format(priority))
+                    self.message_queue.ack(entry_id)
+                    continue
 
                 if not ret:
                     logging.warning("Message process method returned false for some reason")
-            except ConnectionException:
-                # TODO: We need to put this back at the start of the queue, not the end...
-                logging.warning("Failed message handling, putting back to the queue...")
-                self.message_queue.put(msg)
+            except Exception:
+                logging.warning("Failed message handling, putting back at the head of the queue...")
+                self.message_queue.requeue(entry_id)
                 raise
 
+            self.message_queue.ack(entry_id)
+            num += 1
+        return num
+
+    def _process_packed_messages(self, msg, entry_id):
+        """Gather queued messages following msg into a single frame and send it
+
+        Returns:
+            number of queued messages sent
+        """
+        records = [message_bytes(msg)]
+        entry_ids = [entry_id]
+
+        frame_bytes = self.chunk_sizer.size if self.adaptive_sizing else self.max_message_bytes
+
+        while frame_bytes and not self.message_queue.empty():
+            priority, item, next_id = self.message_queue.get(timeout=1)
+            if priority != self.priority_message_mo:
+                self.message_queue.requeue(next_id)
+                break
+
+            record = message_bytes(item)
+            # Leave room for the encoding header
+            if packed_size(records + [record]) + (1 if self._compressor else 0) > frame_bytes:
+                self.message_queue.requeue(next_id)
+                break
+            records.append(record)
+            entry_ids.append(next_id)
+
+        try:
+            # A lone message too big to pack goes as it is
+            if len(records) == 1 and self.max_message_bytes \
+                    and packed_size(records) > self.max_message_bytes:
+                ret = self._send_message(msg)
+            else:
+                ret = self.process_message(self._encode_message(PackedMessage(records)))
+
+            if not ret:
+                logging.warning("Message process method returned false for some reason")
+        except Exception:
+            logging.warning("Failed packed message handling, putting {} back at the head of the queue...".format(
+                len(entry_ids)))
+            for failed_id in reversed(entry_ids):
+                self.message_queue.requeue(failed_id)
+            raise
+
+        for sent_id in entry_ids:
+            self.message_queue.ack(sent_id)
+        return len(entry_ids)
+
+    def _process_file_batch(self, filename, entry_id):
+        """Gather the queued files following filename and transfer them together
+
+        Returns:
+            number of queued files sent
+        """
+        filenames = [filename]
+        entry_ids = [entry_id]
+
+        while not self.message_queue.empty():
+            priority, item, next_id = self.message_queue.get(timeout=1)
+            if priority != self.priority_file_mo:
+                self.message_queue.requeue(next_id)
+                break
+            filenames.append(item)
+            entry_ids.append(next_id)
+
+        sent = []
+        try:
+            self.process_transfers(filenames, sent)
+        finally:
+            # Whatever didn't make it goes back at the head of the queue, in its original order
+            for item, batch_id in reversed(list(zip(filenames, entry_ids))):
+                if item in sent:
+                    self.message_queue.ack(batch_id)
+                else:
+                    self.message_queue.requeue(batch_id)
+            if len(sent) < len(filenames):
+                logging.warning("Sent {} of a batch of {} files".format(len(sent), len(filenames)))
+        return len(sent)
+
+    def _encode_message(self, msg):
+        if not self.frames_messages:
+            return msg
+
+        data = message_bytes(msg)
+        if not isinstance(msg, PackedMessage) and is_framed(data):
+            # Anything the ground would take for framing goes in a frame of its own, even if that makes it too big
+            msg = PackedMessage([data])
+            data = message_bytes(msg)
+        if not self._compressor:
+            return msg
+
+        encoded = CompressedMessage(data, self._compressor)
+        if self.max_message_bytes and len(encoded.get_message_text()) > self.max_message_bytes >= len(data):
+            logging.debug("Encoding header would take the message over {} bytes, sending as is".format(
+                self.max_message_bytes))
+            return msg
+        return encoded
+
+    def _send_message(self, msg):
+        """Encode and send a single message, in fragments if it's too big for one MO message
+
+        Returns:
+            True if every part of the message was processed
+        """
+        msg = self._encode_message(msg)
+        if not self.fragment_messages or not self.max_message_bytes:
+            return self.process_message(msg)
+
+        data = message_bytes(msg)
+        if len(data) <= self.max_message_bytes:
+            return self.process_message(msg)
+
+        frames = fragment(data, self.max_message_bytes, self._fragment_id)
+        logging.info("Sending {} byte message as {} fragments with id {:#010x}".format(
+            len(data), len(frames), self._fragment_id))
+        self._fragment_id = (self._fragment_id + 1) & 0xffffffff
+
+        ret = True
+        for frame in frames:
+            ret = self.process_message(FragmentMessage(frame)) and ret
+        return ret
+
     @abstractmethod
     def process_transfer(self, filename):
         pass
 
+    def process_transfers(self, filenames, sent):
+        """Transfer a batch of files, by default one after another
+
+        Args:
+            filenames: list of files to send
+            sent: list that each file is appended to once it's been dealt with, so anything missing from it
+                  after a failure can be requeued
+        """
+        for filename in filenames:
+            if not self.process_transfer(filename):
+                logging.warning("Transfer method returned false for {}".format(filename))
+            sent.append(filename)
+
     def run(self):
         # TODO: this needs a refactor now that polling and processing are separated
         while self.running:
-            # TODO: this was written a long time ago and smells slightly, why are we independently
-            #  tracking the status of a re-entrant lock?
-            modem_locked = False
+            in_session = False
+            failed = False
+            num = None
 
             try:
                 if not self.message_queue.empty():
-                    if self.modem_lock.acquire(blocking=False):
-                        modem_locked = True
-                        self.initialise_modem()
+                    if self.pack_messages and self.pack_window and not self.modem_session.powered:
+                        logging.debug("Waiting {} seconds for more messages to pack".format(self.pack_window))
+                        tm.sleep(self.pack_window)
+
+                    if self.modem_session.acquire(blocking=False):
+                        in_session = True
 
                         if not self.message_queue.empty():
                             logging.debug("Current queue size approx.: {}".format(str(self.message_queue.qsize())))
@@ -322,44 +662,53 @@ class BaseConnection(metaclass=ABCMeta):
                                 num = self.process_outstanding_messages()
                                 logging.info("Processed {} outgoing messages".format(num if num is not None else 0))
 
+                                self._mt_pending.clear()
                                 self.poll_for_messages()
                             else:
                                 logging.warning("Not enough signal to perform activities")
                     else:
-                        logging.warning("Unable to acquire the modem lock, abandoning for the mo")
+                        logging.warning("Unable to acquire the modem session, abandoning for the mo")
                 else:
-                    # TODO: this is were we could respond to unsolicited messaging from modem
-                    if self.poll_periodically and self.modem_lock.acquire(blocking=False):
-                        modem_locked = True
-                        self.initialise_modem()
+                    mt_pending = self._mt_pending.is_set()
+
+                    if (self.poll_periodically or mt_pending) and self.modem_session.acquire(blocking=False):
+                        in_session = True
+                        self._mt_pending.clear()
 
                         if self.signal_check(self.min_signal_level):
                             logging.debug("Polling modem for messages")
                             self.poll_for_messages()
             except ConnectionException:
+                failed = True
                 logging.error("Out of logic modem operations, breaking to restart...")
                 logging.error(traceback.format_exc())
             except queue.Empty:
                 logging.info("{} messages processed, {} left in queue".format(num, self.message_queue.qsize()))
             except Exception:
+                failed = True
                 logging.error("Modem inoperational or another error occurred")
                 logging.error(traceback.format_exc())
             finally:
-                if modem_locked:
-                    self.close()
-
-                    try:
-                        self.modem_lock.release()
-                    except RuntimeError:
-                        logging.warning("Looks like the lock wasn't acquired, dealing with this...")
+                if in_session:
+                    # Failures end the session so the next attempt starts from a fresh modem
+                    self.modem_session.release(end=failed)
 
-            tm.sleep(self._modem_wait)
+            # Woken early if the modem tells us there's MT traffic waiting, or there's work for a live session
+            self._wakeup.wait(self._modem_wait)
+            self._wakeup.clear()
 
     def send_file(self, file, timeout=None):
         self.message_queue.put((self.priority_file_mo, file))
+        self._wake_for_session()
 
     def send_message(self, message, timeout=None):
         self.message_queue.put((self.priority_message_mo, message))
+        self._wake_for_session()
+
+    def _wake_for_session(self):
+        # Work arriving whilst the modem is still powered is merged into the live session straight away
+        if self.modem_session.powered:
+            self._wakeup.set()
 
     def signal_check(self,
                      min_signal=3):
@@ -372,16 +721,19 @@ class BaseConnection(metaclass=ABCMeta):
         """
 
         # Check we have a good enough signal to work with (>3)
-        signal_test = self.modem_command("AT+CSQ?")
-        if signal_test == "":
+        signal_test = self.modem_response("AT+CSQ?")
+        if not signal_test.complete:
             raise ConnectionException(
                 "No response received for signal quality check")
-        signal_level = self.re_signal.search(signal_test)
+        signal_level = self.re_signal.search(signal_test.text)
 
         if signal_level:
             try:
                 signal_level = int(signal_level.group(1))
                 logging.debug("Got signal level {}".format(signal_level))
+
+                if self.adaptive_sizing:
+                    self.chunk_sizer.signal(signal_level)
             except ValueError:
                 raise ConnectionException(
                     "Could not interpret signal from response: {}".format(signal_test))
@@ -415,13 +767,40 @@ class BaseConnection(metaclass=ABCMeta):
         """
         self._data_conn = data_conn
 
+    @property
+    def frames_messages(self):
+        """Whether MO messages can be packed, fragmented or compressed, as the ground then decodes all of them"""
+        return bool(self.pack_messages or self.fragment_messages or self._compressor)
+
+    @property
+    def max_message_bytes(self):
+        """Largest single MO message the connection can send, None if unknown"""
+        return None
+
+    @property
+    def chunk_sizer(self):
+        if self._chunk_sizer is None:
+            self._chunk_sizer = ChunkSizer(self.max_message_bytes, self.adaptive_min_bytes)
+        return self._chunk_sizer
+
+    @property
+    def transfer_journal(self):
+        """Journal of partially sent files, opened in the state directory on first use"""
+        if self._transfer_journal is None:
+            self._transfer_journal = TransferJournal(os.path.join(self.state_dir, "transfers.journal"))
+        return self._transfer_journal
+
     @property
     def message_queue(self):
         return self._message_queue
 
     @property
-    def modem_lock(self):
-        return self._modem_lock
+    def modem_power(self):
+        return self._modem_power
+
+    @property
+    def modem_session(self):
+        return self._modem_session
 
     @property
     def running(self):
@@ -0,0 +1,267 @@
+import collections
+import logging
+import struct
+import time as tm
+
+from pyremotenode.comms.compression import ENCODINGS, decode
+
+# Marks a frame made up of several length prefixed records, chosen as the ASCII record separator so it can't be
+# the first byte of a dated text message
+PACKED_FRAME = 0x1e
+# Likewise the ASCII unit separator marks one fragment of a message too big to send whole, followed by the
+# message id, fragment index and fragment count
+FRAGMENT = 0x1f
+FRAGMENT_HEADER = struct.Struct("!BIHH")
+
+
+def encode_varint(value):
+    """Unsigned LEB128, so lengths under 128 bytes cost a single byte"""
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def decode_varint(data, offset=0):
+    """
+
+    Args:
+        data: bytes to decode from
+        offset: position of the varint in data
+
+    Returns:
+        tuple of the value and the offset after it
+    """
+    value = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[offset]
+        except IndexError:
+            raise ValueError("Truncated length in packed frame")
+        value |= (byte & 0x7f) << shift
+        offset += 1
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def packed_size(records):
+    return 1 + sum(len(encode_varint(len(r))) + len(r) for r in records)
+
+
+def pack_records(records):
+    """Pack several messages into one frame
+
+    Args:
+        records: list of bytes
+
+    Returns:
+        bytes of the frame
+    """
+    frame = bytearray([PACKED_FRAME])
+    for record in records:
+        frame += encode_varint(len(record))
+        frame += record
+    return bytes(frame)
+
+
+def unpack_records(frame):
+    """Split a frame created by pack_records back into its messages
+
+    Args:
+        frame: bytes of a packed frame
+
+    Returns:
+        list of bytes, one per message
+    """
+    if not len(frame) or frame[0] != PACKED_FRAME:
+        raise ValueError("Not a packed frame")
+
+    records = []
+    offset = 1
+    while offset < len(frame):
+        length, offset = decode_varint(frame, offset)
+        if offset + length > len(frame):
+            raise ValueError("Record of {} bytes at {} overruns frame of {} bytes".format(
+                length, offset, len(frame)))
+        records.append(bytes(frame[offset:offset + length]))
+        offset += length
+    return records
+
+
+def fragment(data, max_bytes, message_id):
+    """Split a message into fragments that each fit in a single MO message
+
+    The message id is given by the sender, which numbers its messages in turn so that no two in flight share an
+    id, and nor does a later message that happens to have the same content.
+
+    Args:
+        data: bytes of the message
+        max_bytes: largest MO message, including the fragment header
+        message_id: 32 bit id of the message, unique to it
+
+    Returns:
+        list of bytes, one per fragment
+    """
+    size = max_bytes - FRAGMENT_HEADER.size
+    if size <= 0:
+        raise ValueError("Message size of {} bytes leaves no room for a fragment".format(max_bytes))
+
+    count = max(-(-len(data) // size), 1)
+    if count > 0xffff:
+        raise ValueError("Message of {} bytes needs more than {} fragments".format(len(data), 0xffff))
+
+    return [FRAGMENT_HEADER.pack(FRAGMENT, message_id & 0xffffffff, index, count) + bytes(data[index * size:(index + 1) * size])
+            for index in range(count)]
+
+
+def is_fragment(data):
+    return len(data) >= FRAGMENT_HEADER.size and data[0] == FRAGMENT
+
+
+class Reassembler(object):
+    """ Ground side collection of message fragments, giving back each message once all of its fragments are in
+
+    Fragments can arrive in any order and more than once, including after their message has been completed.
+    Messages still incomplete after max_age seconds are abandoned, as are the oldest once more than max_messages
+    are outstanding.
+    """
+    def __init__(self, max_age=7 * 86400, max_messages=256):
+        self._max_age = max_age
+        self._max_messages = max_messages
+        self._messages = dict()
+        self._completed = collections.deque(maxlen=max_messages)
+
+    def add(self, data):
+        """
+
+        Args:
+            data: bytes of a received fragment
+
+        Returns:
+            bytes of the whole message if this fragment completed it, otherwise None
+        """
+        if not is_fragment(data):
+            raise ValueError("Not a message fragment")
+
+        _, message_id, index, count = FRAGMENT_HEADER.unpack_from(data)
+        if index >= count:
+            raise ValueError("Fragment {} of message {:#010x} is beyond its {} fragments".format(
+                index, message_id, count))
+
+        self._expire()
+        key = (message_id, count)
+        if key in self._completed:
+            logging.debug("Fragment {} of already completed message {:#010x}".format(index, message_id))
+            return None
+
+        if key not in self._messages:
+            self._messages[key] = (tm.time(), dict())
+        fragments = self._messages[key][1]
+
+        if index in fragments:
+            logging.debug("Duplicate fragment {} of message {:#010x}".format(index, message_id))
+        fragments[index] = bytes(data[FRAGMENT_HEADER.size:])
+
+        if len(fragments) < count:
+            logging.debug("Have {} of {} fragments of message {:#010x}".format(len(fragments), count, message_id))
+            return None
+
+        del self._messages[key]
+        self._completed.append(key)
+        message = b"".join(fragments[i] for i in range(count))
+        logging.info("Reassembled {} bytes from {} fragments of message {:#010x}".format(
+            len(message), count, message_id))
+        return message
+
+    def missing(self):
+        """
+
+        Returns:
+            dict of (message id, fragment count) to the sorted list of fragment indexes still missing
+        """
+        return dict([(key, sorted(set(range(key[1])) - set(fragments.keys())))
+                     for key, (_, fragments) in self._messages.items()])
+
+    def _expire(self):
+        now = tm.time()
+        for key, (first_seen, _) in sorted(self._messages.items(), key=lambda item: item[1][0]):
+            if now - first_seen > self._max_age or len(self._messages) >= self._max_messages:
+                logging.warning("Abandoning incomplete message {:#010x}, missing fragments {}".format(
+                    key[0], self.missing()[key]))
+                del self._messages[key]
+
+
+def is_framed(data):
+    """Whether a message starts with a byte the ground would take for packing, fragmenting or compression
+
+    A node that frames its messages sends any other message starting with one of those as a packed frame of its
+    own, so the ground never mistakes one for the other.
+    """
+    return len(data) > 0 and (data[0] in (PACKED_FRAME, FRAGMENT) or data[0] in ENCODINGS)
+
+
+def decode_message(data, dictionaries=None, framed=True):
+    """Ground side decoding of a message as it was received from the node
+
+    Args:
+        data: bytes of the received message
+        dictionaries: list of compression dictionaries that may have been used
+        framed: whether the node packs, fragments or compresses its messages, otherwise every message is raw
+                and is returned as it is, whatever it starts with
+
+    Returns:
+        list of bytes, one per message originally queued on the node
+    """
+    if not framed:
+        return [bytes(data)]
+
+    if len(data) and data[0] in ENCODINGS:
+        data = decode(data, dictionaries)
+
+    if len(data) and data[0] == PACKED_FRAME:
+        return unpack_records(data)
+    return [bytes(data)]
+
+
+class PackedMessage(object):
+    """ Stands in for a Message when several have been packed into a single frame """
+    def __init__(self, records):
+        self._frame = pack_records(records)
+        self._records = len(records)
+        logging.info("Packed {} messages into a {} byte frame".format(self._records, len(self._frame)))
+
+    def get_message_text(self):
+        return self._frame
+
+    @property
+    def binary(self):
+        return True
+
+    @property
+    def records(self):
+        return self._records
+
+
+class FragmentMessage(object):
+    """ Stands in for a Message when sending one fragment of it """
+    def __init__(self, frame):
+        self._frame = frame
+
+    def get_message_text(self):
+        return self._frame
+
+    @property
+    def binary(self):
+        return True
+
+
+def message_bytes(msg):
+    text = msg.get_message_text()
+    return bytes(text) if isinstance(text, (bytes, bytearray)) else text.encode()
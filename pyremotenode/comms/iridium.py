@@ -1,7 +1,9 @@
 import binascii
-import json
+import collections
+import contextlib
 import logging
 import os
+import random
 import re
 import stat
 import struct
@@ -12,12 +14,16 @@ import serial
 import xmodem
 
 from pyremotenode.comms.connections import BaseConnection, ConnectionException
+from pyremotenode.comms.rudics import WindowedSender, WindowedTransferError
+from pyremotenode.comms.transfer import ChunkPlan, FileChunkReader
 
 
 class RudicsConnection(BaseConnection):
     re_sbdix_response = re.compile(r'^\+SBDIX:\s*(\d+), (\d+), (\d+), (\d+), (\d+), (\d+)', re.MULTILINE)
     re_creg_response = re.compile(r'^\+CREG:\s*(\d+),\s*(\d+),?.*', re.MULTILINE)
     re_msstm_response = re.compile(r'^-MSSTM: ([0-9a-f]{8}).*', re.MULTILINE | re.IGNORECASE)
+    # SBD ring alert, enabled with AT+SBDMTA=1
+    re_unsolicited_mt = re.compile(r'^\+?SBDRING$')
 
     def __init__(self, cfg, *args, **kwargs):
         super().__init__(cfg, *args, **kwargs)
@@ -35,6 +41,31 @@ class RudicsConnection(BaseConnection):
             if 'dialup_number' in cfg['ModemConnection'] else None
         self._call_timeout = cfg['ModemConnection']['call_timeout'] \
             if "call_timeout" in cfg['ModemConnection'] else 120
+        self._call_redials = int(cfg['ModemConnection']['call_redials']) \
+            if "call_redials" in cfg['ModemConnection'] else 3
+
+        # S12 escape guard time, 50 fiftieths of a second by default, and how long to allow each step of hanging up
+        self._escape_guard_time = float(cfg['ModemConnection']['escape_guard_time']) \
+            if "escape_guard_time" in cfg['ModemConnection'] else 1.
+        self._hangup_timeout = float(cfg['ModemConnection']['hangup_timeout']) \
+            if "hangup_timeout" in cfg['ModemConnection'] else 5.
+
+        # File protocol used over the data call, "xmodem" or "windowed"
+        self._rudics_protocol = cfg['ModemConnection']['rudics_protocol'] \
+            if "rudics_protocol" in cfg['ModemConnection'] else "xmodem"
+        self._rudics_block_size = int(cfg['ModemConnection']['rudics_block_size']) \
+            if "rudics_block_size" in cfg['ModemConnection'] else 1024
+        self._rudics_window = int(cfg['ModemConnection']['rudics_window']) \
+            if "rudics_window" in cfg['ModemConnection'] else 8
+
+        # Failed SBD sessions are retried after an exponentially growing, jittered delay, with a cap on how long a
+        # single call to process_message can keep the transceiver transmitting
+        self._sbdix_backoff = float(cfg['ModemConnection']['sbdix_backoff']) \
+            if "sbdix_backoff" in cfg['ModemConnection'] else 2.
+        self._sbdix_backoff_max = float(cfg['ModemConnection']['sbdix_backoff_max']) \
+            if "sbdix_backoff_max" in cfg['ModemConnection'] else 60.
+        self._sbd_airtime = float(cfg['ModemConnection']['sbd_airtime']) \
+            if "sbd_airtime" in cfg['ModemConnection'] else 300.
 
         self.terminator = "\r"
         if self.virtual or self.rockblock:
@@ -48,19 +79,17 @@ class RudicsConnection(BaseConnection):
             now = 0
             # Iridium epoch is 11-May-2014 14:23:55 (currently, IT WILL CHANGE)
             ep = datetime(2014, 5, 11, 14, 23, 55)
-            locked = False
+            in_session = False
 
             try:
-                locked = self.modem_lock.acquire()
-                if locked:
-                    self.initialise_modem()
-
+                in_session = self.modem_session.acquire()
+                if in_session:
                     # And time is measured in 90ms intervals eg. 62b95972
-                    result = self.modem_command("AT-MSSTM")
-                    if result.splitlines()[-1] != "OK":
+                    result = self.modem_response("AT-MSSTM")
+                    if not result.ok:
                         raise ConnectionException("Error code response from modem, cannot continue")
 
-                    result = self.re_msstm_response.match(result).group(1)
+                    result = self.re_msstm_response.match(result.text).group(1)
 
                     now = timedelta(seconds=int(result, 16) / (1. / 0.09))
                 else:
@@ -78,8 +107,8 @@ class RudicsConnection(BaseConnection):
                 logging.exception("Cannot cast value for Iridium time")
                 return False
             finally:
-                if locked:
-                    self.modem_lock.release()
+                if in_session:
+                    self.modem_session.release()
             return now + ep
 
     def initialise_modem(self):
@@ -115,16 +144,16 @@ class RudicsConnection(BaseConnection):
             if not self.data_conn.is_open:
                 logging.info("Opening existing modem serial connection")
                 self.data_conn.open()
-            # TODO: Shared object now between threads, at startup, don't think this needs to be present
             else:
-                logging.warning("Modem appears to already be open, wasn't previously closed!?!")
-#                    raise ConnectionException(
-#                        "Modem appears to already be open, wasn't previously closed!?!")
+                logging.debug("Reusing open modem serial connection")
+
+        self._start_dispatcher()
 
-        self.modem_command("AT")
-        self.modem_command("ATE0\n")
-        self.modem_command("AT+SBDC")
-        self.modem_command("AT+SBDMTA=0")
+        self.modem_response("AT")
+        self.modem_response("ATE0\n")
+        self.modem_response("AT+SBDC")
+        # Ring alerts are only useful if we're listening for unsolicited result codes
+        self.modem_response("AT+SBDMTA={}".format(1 if self.unsolicited else 0))
 
         if not self.rockblock:
             reg_checks = 0
@@ -132,16 +161,16 @@ class RudicsConnection(BaseConnection):
 
             while reg_checks < self.max_reg_checks:
                 logging.info("Checking registration on Iridium: attempt {} of {}".format(reg_checks, self.max_reg_checks))
-                registration = self.modem_command("AT+CREG?")
+                registration = self.modem_response("AT+CREG?")
                 check = True
 
-                if registration.splitlines()[-1] != "OK":
+                if not registration.ok:
                     logging.warning("There's an issue with the registration response, won't parse: {}".
                                     format(registration))
                     check = False
 
                 if check:
-                    (reg_type, reg_stat) = self.re_creg_response.search(registration).groups()
+                    (reg_type, reg_stat) = self.re_creg_response.search(registration.text).groups()
                     if int(reg_stat) not in [1, 5]:
                         logging.info("Not currently registered on network: status {}".format(int(reg_stat)))
                     else:
@@ -159,122 +188,239 @@ class RudicsConnection(BaseConnection):
         logging.info("Outstanding MT messages, collecting...")
         self.process_message(None)
 
-    # TODO: All this logic needs a rewrite, it's too dependent on MO message initiation
     def process_message(self, msg):
         if msg is not None:
             text = msg.get_message_text()
+            payload = text.encode() if not msg.binary else text
 
-            response = self.modem_command("AT+SBDWB={}".format(len(text)))
-            if response.splitlines()[-1] != "READY":
-                raise ConnectionException("Error preparing for binary message: {}".format(response))
+            response = self.modem_binary("AT+SBDWB={}".format(len(payload)),
+                                         [payload, RudicsConnection.calculate_sbd_checksum(payload)])
+            if not response.ok or response.lines[-1:] != ["0"]:
+                raise ConnectionException("Error writing output binary for SBD: {}".format(response))
 
-            payload = text.encode() if not msg.binary else text
-            payload += RudicsConnection.calculate_sbd_checksum(payload)
-            response = self.modem_command(payload, raw=True)
+        deadline = tm.monotonic() + self._sbd_airtime
+        mo_status, mt_queued = self._sbd_session(deadline, msg is not None)
+
+        if mo_status <= 4:
+            if msg is not None:
+                # Otherwise every following session would send the same MO message again
+                self.modem_response("AT+SBDD0")
+
+            # Each session only brings down a single MT message, so keep going until the gateway has no more
+            while mt_queued > 0 and tm.monotonic() < deadline:
+                logging.info("{} MT messages still queued at the gateway, starting another session".format(mt_queued))
+                status, mt_queued = self._sbd_session(deadline)
+                if status > 4:
+                    break
+
+            if mt_queued > 0:
+                logging.warning("Leaving {} MT messages queued at the gateway until the next session".format(
+                    mt_queued))
+
+        response = self.modem_response("AT+SBDD2")
+        if response.ok:
+            logging.debug("Message buffers cleared")
+
+        if mo_status > 4:
+            # Raising puts the message back at the head of the queue
+            raise ConnectionException(
+                "Failed to send message with MO Status: {}, breaking...".format(mo_status))
+        return True
+
+    def _sbd_session(self, deadline, mo_pending=False):
+        """Run AT+SBDIX until the MO buffer has been sent, backing off between failed attempts
+
+        Any MT message brought down by an attempt is read out straight away, before the next attempt can
+        overwrite the receive buffer.
 
-            if response.splitlines()[-2] != "0" \
-                and response.splitlines()[-1] != "OK":
-                raise ConnectionException("Error writing output binary for SBD".format(response))
+        Args:
+            deadline: monotonic time after which no further attempts are started
+            mo_pending: whether the MO buffer holds a message, rather than this being a mailbox check
 
-        mo_status, mo_msn, mt_status, mt_msn, mt_len, mt_queued = None, 0, None, None, 0, 0
+        Returns:
+            tuple of the MO status of the last attempt and the number of MT messages still queued at the gateway
+        """
+        attempt = 0
 
-        # TODO: BEGIN: this block with repeated SBDIX can overwrite the receiving message buffers
-        while not mo_status or int(mo_status) > 4:
-            response = self.modem_command("AT+SBDIX", timeout_override=self.msg_xfer_timeout)
-            if response.splitlines()[-1] != "OK":
+        while True:
+            response = self.modem_response("AT+SBDIX", timeout_override=self.msg_xfer_timeout)
+            if not response.ok:
                 raise ConnectionException("Error submitting message: {}".format(response))
 
             mo_status, mo_msn, mt_status, mt_msn, mt_len, mt_queued = \
-                self.re_sbdix_response.search(response).groups()
+                [int(v) for v in self.re_sbdix_response.search(response.text).groups()]
+
+            if mo_pending and self.adaptive_sizing:
+                if mo_status > 4:
+                    self.chunk_sizer.failure()
+                else:
+                    self.chunk_sizer.success()
+
+            # NOTE: Configure modems to not have ring alerts on SBD
+            if mt_status == 1:
+                self._read_sbd_message(mt_msn, mt_len)
+            elif mt_status == 2:
+                logging.warning("Error checking the MT mailbox during SBD session")
+
+            if mo_status <= 4:
+                return mo_status, mt_queued
+
+            delay = min(self._sbdix_backoff * 2 ** attempt, self._sbdix_backoff_max) * random.uniform(0.5, 1.)
+            attempt += 1
 
-        # NOTE: Configure modems to not have ring alerts on SBD
-        if int(mt_status) == 1:
-            mt_message = self.modem_command("AT+SBDRB", dont_decode=True)
+            if tm.monotonic() + delay >= deadline:
+                logging.warning("SBD airtime of {} seconds used up after {} attempts, last MO status {}".format(
+                    self._sbd_airtime, attempt, mo_status))
+                return mo_status, mt_queued
+
+            logging.info("SBD session failed with MO status {}, retrying in {:.1f} seconds".format(mo_status, delay))
+            tm.sleep(delay)
+
+    def _read_sbd_message(self, mt_msn, mt_len):
+        mt_message = self.modem_response("AT+SBDRB", length_prefixed=True).binary
+
+        if mt_message:
+            try:
+                mt_message = mt_message[0:int(mt_len)+4]
+                length = mt_message[0:2]
+                message = mt_message[2:-2]
+                chksum = mt_message[-2:]
+            except IndexError:
+                raise ConnectionException(
+                    "Message indexing was not successful for message ID {} length {}".format(
+                        mt_msn, mt_len))
+            else:
+                calcd_chksum = sum(message) & 0xFFFF
 
-            if mt_message:
                 try:
-                    mt_message = mt_message[0:int(mt_len)+4]
-                    length = mt_message[0:2]
-                    message = mt_message[2:-2]
-                    chksum = mt_message[-2:]
-                except IndexError:
+                    length = struct.unpack(">H", length)[0]
+                    chksum = struct.unpack(">H", chksum)[0]
+                except (struct.error, IndexError) as e:
                     raise ConnectionException(
-                        "Message indexing was not successful for message ID {} length {}".format(
-                            mt_msn, mt_len))
+                        "Could not decompose the values from the incoming SBD message: {}".format(e))
+
+                if length != len(message):
+                    logging.warning("Message length indicated {} is not the same as actual message: {}".format(
+                        length, len(message)
+                    ))
+                elif chksum != calcd_chksum:
+                    logging.warning("Message checksum {} is not the same as calculated checksum: {}".format(
+                        chksum, calcd_chksum
+                    ))
                 else:
-                    calcd_chksum = sum(message) & 0xFFFF
+                    msg_dt = datetime.utcnow().strftime("%d%m%Y%H%M%S")
+                    msg_filename = os.path.join(self.mt_destination, "{}_{}.msg".format(
+                        mt_msn, msg_dt))
+                    logging.info("Received MT message, outputting to {}".format(msg_filename))
 
                     try:
-                        length = struct.unpack(">H", length)[0]
-                        chksum = struct.unpack(">H", chksum)[0]
-                    except (struct.error, IndexError) as e:
-                        raise ConnectionException(
-                            "Could not decompose the values from the incoming SBD message: {}".format(e.message))
-
-                    if length != len(message):
-                        logging.warning("Message length indicated {} is not the same as actual message: {}".format(
-                            length, len(message)
-                        ))
-                    elif chksum != calcd_chksum:
-                        logging.warning("Message checksum {} is not the same as calculated checksum: {}".format(
-                            chksum, calcd_chksum
-                        ))
-                    else:
-                        msg_dt = datetime.utcnow().strftime("%d%m%Y%H%M%S")
-                        msg_filename = os.path.join(self.mt_destination, "{}_{}.msg".format(
-                            mt_msn, msg_dt))
-                        logging.info("Received MT message, outputting to {}".format(msg_filename))
+                        with open(msg_filename, "wb") as fh:
+                            fh.write(message)
+                    except (OSError, IOError):
+                        logging.error("Could not write {}, abandoning...".format(message))
 
-                        try:
-                            with open(msg_filename, "wb") as fh:
-                                fh.write(message)
-                        except (OSError, IOError):
-                            logging.error("Could not write {}, abandoning...".format(message))
+    def process_transfer(self, filename):
+        """ Take a file and process it across the link via XMODEM
 
-        # TODO: END: this block with repeated SBDIX can overwrite the receiving message buffers
+        TODO: This and all modem integration should be extrapolated to it's own library """
+        sent = []
+        self.process_transfers([filename], sent)
+        return len(sent) > 0
 
-        response = self.modem_command("AT+SBDD2")
-        if response.splitlines()[-1] == "OK":
-            logging.debug("Message buffers cleared")
+    def process_transfers(self, filenames, sent):
+        """ Send files one after another over a single data call
 
-        if int(mo_status) > 4:
-            logging.warning("Adding message back into queue due to persistent MO status {}".format(mo_status))
-            self.send_message(msg, 5)
+        Each file is introduced by the FILENAME preamble as always. A dropped call is redialled, up to call_redials
+        times, and picks up again with the file that was being sent. In batch mode the end of the batch is marked
+        so the other end knows the call is done with.
+        """
+        remaining = list(filenames)
+        redials = 0
+        in_call = False
 
-            raise ConnectionException(
-                "Failed to send message with MO Status: {}, breaking...".format(mo_status))
-        return True
+        # The data call needs the serial line to itself
+        with self._dispatcher.paused() if self._dispatcher else contextlib.suppress():
+            try:
+                while len(remaining):
+                    filename = remaining[0]
+                    if not os.path.exists(filename):
+                        logging.warning("{} does not exist, we will not try and send it".format(filename))
+                        sent.append(remaining.pop(0))
+                        continue
+
+                    if not in_call:
+                        # TODO: Call thread needs to be separate to maintain uplink
+                        if not self._start_data_call():
+                            sent.extend(remaining)
+                            return
+                        in_call = True
 
-    def process_transfer(self, filename):
-        """ Take a file and process it across the link via XMODEM
+                    try:
+                        self._send_file(filename)
+                    except (ConnectionException, serial.SerialException) as e:
+                        if redials >= self._call_redials:
+                            raise
+                        redials += 1
+                        logging.warning("Data call failed sending {}, redialling ({} of {}): {}".format(
+                            filename, redials, self._call_redials, e))
+                        self._drop_data_call()
+                        in_call = False
+                        continue
+
+                    sent.append(remaining.pop(0))
+
+                if in_call and self.batch_transfers:
+                    self._send_end_of_batch()
+            finally:
+                if in_call:
+                    self._drop_data_call()
 
-        TODO: This and all modem integration should be extrapolated to it's own library """
+    def _send_file(self, filename):
+        # FIXME 2021: Try without preamble, make this optional
+        self._send_filename(filename)
 
-        def _callback(total_packets, success_count, error_count):
-            logging.debug("{} packets, {} success, {} errors".format(total_packets, success_count, error_count))
-            logging.debug("CD STATE: {}".format(self._data.cd))
+        if self._rudics_protocol == "windowed":
+            self._send_windowed(filename)
+        else:
+            self._send_xmodem(filename)
+        self.transfer_journal.finish(self.transfer_journal.file_key(filename))
+        logging.debug("Finished transfer of {}".format(filename))
 
-            if error_count > self._dataxfer_errors:
-                logging.warning("Increase in error count")
-                self._dataxfer_errors = error_count
-            # TODO: NAKs and error recall thresholds need to be configurable
-            # if error_count > 0 and error_count % 3 == 0:
-            #     logging.info("Third error response, re-establishing
-            #     uplink")
-                try:
-                    self._end_data_call()
-                except ConnectionException as e:
-                    logging.warning("Unable to cleanly kill the call, will attempt a startup anyway: {}".format(e))
-                finally:
-                    # If this doesn't work, we're likely down and might as
-                    # well have the whole process restart again
-                    self._start_data_call()
+    def _send_windowed(self, filename):
+        def _read(timeout):
+            self.data_conn.timeout = timeout
+            return self.data_conn.read(max(1, self.data_conn.in_waiting))
+
+        def _write(data):
+            self.data_conn.write(data)
+            self._last_write = tm.monotonic()
 
+        sender = WindowedSender(_read, _write,
+                                block_size=self._rudics_block_size,
+                                window=self._rudics_window)
+        previous_timeout = self.data_conn.timeout
+        journal = self.transfer_journal
+        key = journal.file_key(filename)
+
+        try:
+            with FileChunkReader(filename) as reader:
+                # The receiver tells us where to resume from, the journal keeps our own record of how far we got.
+                # That moves on with every acknowledgement, so it's only synced once the file is done with
+                blocks = sender.send(reader,
+                                     progress=lambda offset: journal.record(key, 0, offset, sync=False))
+            logging.info("Sent {} in {} blocks".format(filename, blocks))
+        except WindowedTransferError as e:
+            raise ConnectionException("Windowed transfer of {} failed: {}".format(filename, e))
+        finally:
+            self.data_conn.timeout = previous_timeout
+            journal.sync()
+
+    def _send_xmodem(self, filename):
         def _getc(size, timeout=self.data_conn.timeout):
             self.data_conn.timeout = timeout
             read = self.data_conn.read(size=size) or None
             logging.debug("_getc read {} bytes from data line".format(
-                len(read)
+                len(read) if read else 0
             ))
             return read
 
@@ -293,34 +439,49 @@ class RudicsConnection(BaseConnection):
                 len(data)
             ))
             size = self.data_conn.write(data=data)
+            self._last_write = tm.monotonic()
             return size
 
-        # TODO: Catch errors and hangup the call!
-        # TODO: Call thread needs to be separate to maintain uplink
-        if self._start_data_call():
-            # FIXME 2021: Try without preamble, make this optional
-            self._send_filename(filename)
+        def _callback(total_packets, success_count, error_count):
+            logging.debug("{} packets, {} success, {} errors".format(total_packets, success_count, error_count))
+
+            if error_count > self._dataxfer_errors:
+                logging.warning("Increase in error count")
+            self._dataxfer_errors = error_count
 
-            xfer = xmodem.XMODEM(_getc, _putc)
+        xfer = xmodem.XMODEM(_getc, _putc)
+        self._dataxfer_errors = 0
 
-            stream = open(filename, 'rb')
-            xfer.send(stream, callback=_callback)
-            logging.debug("Finished transfer")
+        with open(filename, 'rb') as stream:
+            # A failed send has the call dropped and redialled by process_transfers
+            if not xfer.send(stream, callback=_callback):
+                raise ConnectionException("XMODEM transfer of {} failed".format(filename))
+
+    def _drop_data_call(self):
+        try:
             self._end_data_call()
+        except ConnectionException as e:
+            logging.warning("Unable to cleanly end the call: {}".format(e))
 
-            return True
-        return False
+    def _send_end_of_batch(self):
+        self._attention()
 
-    def _send_filename(self, filename):
-        buffer = bytearray()
+        res = self.modem_response("ENDBATCH")
+        if res.result != "BATCHRECV":
+            logging.warning("End of batch not acknowledged: {}".format(res))
+
+    def _attention(self):
         res = None
 
-        while not res or res.splitlines()[-1] != "A":
-            res = self.modem_command("@")
+        while not res or res.result != "A":
+            res = self.modem_response("@", results=("A",))
 
-        res = self.modem_command("FILENAME")
-        # TODO: abstract the responses from being always a split and subscript
-        if res.splitlines()[-1] != "GOFORIT":
+    def _send_filename(self, filename):
+        buffer = bytearray()
+        self._attention()
+
+        res = self.modem_response("FILENAME")
+        if res.result != "GOFORIT":
             raise ConnectionException("Required response for FILENAME command not received")
 
         # We can only have two byte lengths, and we don't escape the two
@@ -339,8 +500,8 @@ class RudicsConnection(BaseConnection):
                               binascii.crc32(bfile) & 0xffff,
                               0x1b)
 
-        res = self.modem_command(buffer, raw=True)
-        if res.splitlines()[-1] != "NAMERECV":
+        res = self.modem_response(buffer, raw=True)
+        if res.result != "NAMERECV":
             raise ConnectionException("Could not transfer filename first: {}".format(res))
 
     def _start_data_call(self):
@@ -348,34 +509,63 @@ class RudicsConnection(BaseConnection):
             logging.warning("No dialup number configured, will drop this message")
             return False
 
-        response = self.modem_command(
+        response = self.modem_response(
             "ATDT{}".format(self.dialup_number),
             timeout_override=self._call_timeout,
         )
-        if not response.splitlines()[-1].startswith("CONNECT "):
+        if not (response.result or "").startswith("CONNECT"):
             raise ConnectionException("Error opening call: {}".format(response))
         return True
 
-    # TODO: Too much sleeping, use state based logic
     def _end_data_call(self):
-        logging.debug("Two second sleep")
-        tm.sleep(2)
-        logging.debug("Two second sleep complete")
-        response = self.modem_command("+++".encode(), raw=True)
-        logging.debug("One second sleep")
-        tm.sleep(1)
-        logging.debug("One second sleep complete")
+        """ Escape from the data call to command mode and hang up
 
-        if response.splitlines()[-1] != "OK":
-            raise ConnectionException("Did not switch to command mode to end call")
+        Each state lasts only as long as the modem needs: the guard time ahead of the escape sequence runs from the
+        last byte we actually wrote, the escape and hangup finish on the modem's result rather than after a fixed
+        sleep, and a call that has already dropped skips straight to the end. Every state has a deadline.
+        """
+        state = "guard"
+
+        while state != "done":
+            if state == "guard":
+                # The modem only honours +++ after escape_guard_time (S12) seconds without data from us. write()
+                # returns once the bytes are with the driver rather than on the line, so if flush() had anything to
+                # wait on, the last of it only went out once flush() returned
+                pending = getattr(self.data_conn, "out_waiting", 1)
+                self.data_conn.flush()
+                last_byte = max(self._last_write, tm.monotonic()) if pending else self._last_write
+
+                waiting = self.data_conn.in_waiting
+                if waiting and b"NO CARRIER" in self.data_conn.read(waiting):
+                    logging.info("Call has already ended")
+                    state = "done"
+                    continue
 
-        response = self.modem_command("ATH0")
+                guard = last_byte + self._escape_guard_time - tm.monotonic()
+                if guard > 0:
+                    logging.debug("Waiting {:.2f} seconds of guard time before escaping".format(guard))
+                    tm.sleep(guard)
+                state = "escape"
+            elif state == "escape":
+                # OK comes back once the modem has seen the trailing guard time, so that needs allowing for too
+                response = self.modem_response("+++".encode(), raw=True,
+                                               timeout_override=self._escape_guard_time + self._hangup_timeout)
+                if response.result == "NO CARRIER":
+                    logging.info("Call ended whilst escaping to command mode")
+                    state = "done"
+                elif response.ok:
+                    state = "hangup"
+                else:
+                    raise ConnectionException("Did not switch to command mode to end call")
+            elif state == "hangup":
+                response = self.modem_response("ATH0", timeout_override=self._hangup_timeout)
+                if not response.ok and response.result != "NO CARRIER":
+                    raise ConnectionException("Did not hang up the call")
+                state = "done"
 
-        if response.splitlines()[-1] != "OK":
-            raise ConnectionException("Did not hang up the call")
-        else:
-            logging.debug("Sleeping another second to wait for the line")
-            tm.sleep(1)
+    @property
+    def max_message_bytes(self):
+        return 1920 if self.rockblock else 340
 
     @property
     def rockblock(self):
@@ -391,78 +581,60 @@ class RudicsConnection(BaseConnection):
 
 
 class CertusConnection(BaseConnection):
-    CRC_TABLE = [
-        0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50a5, 0x60c6, 0x70e7,
-        0x8108, 0x9129, 0xa14a, 0xb16b, 0xc18c, 0xd1ad, 0xe1ce, 0xf1ef,
-        0x1231, 0x0210, 0x3273, 0x2252, 0x52b5, 0x4294, 0x72f7, 0x62d6,
-        0x9339, 0x8318, 0xb37b, 0xa35a, 0xd3bd, 0xc39c, 0xf3ff, 0xe3de,
-        0x2462, 0x3443, 0x0420, 0x1401, 0x64e6, 0x74c7, 0x44a4, 0x5485,
-        0xa56a, 0xb54b, 0x8528, 0x9509, 0xe5ee, 0xf5cf, 0xc5ac, 0xd58d,
-        0x3653, 0x2672, 0x1611, 0x0630, 0x76d7, 0x66f6, 0x5695, 0x46b4,
-        0xb75b, 0xa77a, 0x9719, 0x8738, 0xf7df, 0xe7fe, 0xd79d, 0xc7bc,
-        0x48c4, 0x58e5, 0x6886, 0x78a7, 0x0840, 0x1861, 0x2802, 0x3823,
-        0xc9cc, 0xd9ed, 0xe98e, 0xf9af, 0x8948, 0x9969, 0xa90a, 0xb92b,
-        0x5af5, 0x4ad4, 0x7ab7, 0x6a96, 0x1a71, 0x0a50, 0x3a33, 0x2a12,
-        0xdbfd, 0xcbdc, 0xfbbf, 0xeb9e, 0x9b79, 0x8b58, 0xbb3b, 0xab1a,
-        0x6ca6, 0x7c87, 0x4ce4, 0x5cc5, 0x2c22, 0x3c03, 0x0c60, 0x1c41,
-        0xedae, 0xfd8f, 0xcdec, 0xddcd, 0xad2a, 0xbd0b, 0x8d68, 0x9d49,
-        0x7e97, 0x6eb6, 0x5ed5, 0x4ef4, 0x3e13, 0x2e32, 0x1e51, 0x0e70,
-        0xff9f, 0xefbe, 0xdfdd, 0xcffc, 0xbf1b, 0xaf3a, 0x9f59, 0x8f78,
-        0x9188, 0x81a9, 0xb1ca, 0xa1eb, 0xd10c, 0xc12d, 0xf14e, 0xe16f,
-        0x1080, 0x00a1, 0x30c2, 0x20e3, 0x5004, 0x4025, 0x7046, 0x6067,
-        0x83b9, 0x9398, 0xa3fb, 0xb3da, 0xc33d, 0xd31c, 0xe37f, 0xf35e,
-        0x02b1, 0x1290, 0x22f3, 0x32d2, 0x4235, 0x5214, 0x6277, 0x7256,
-        0xb5ea, 0xa5cb, 0x95a8, 0x8589, 0xf56e, 0xe54f, 0xd52c, 0xc50d,
-        0x34e2, 0x24c3, 0x14a0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
-        0xa7db, 0xb7fa, 0x8799, 0x97b8, 0xe75f, 0xf77e, 0xc71d, 0xd73c,
-        0x26d3, 0x36f2, 0x0691, 0x16b0, 0x6657, 0x7676, 0x4615, 0x5634,
-        0xd94c, 0xc96d, 0xf90e, 0xe92f, 0x99c8, 0x89e9, 0xb98a, 0xa9ab,
-        0x5844, 0x4865, 0x7806, 0x6827, 0x18c0, 0x08e1, 0x3882, 0x28a3,
-        0xcb7d, 0xdb5c, 0xeb3f, 0xfb1e, 0x8bf9, 0x9bd8, 0xabbb, 0xbb9a,
-        0x4a75, 0x5a54, 0x6a37, 0x7a16, 0x0af1, 0x1ad0, 0x2ab3, 0x3a92,
-        0xfd2e, 0xed0f, 0xdd6c, 0xcd4d, 0xbdaa, 0xad8b, 0x9de8, 0x8dc9,
-        0x7c26, 0x6c07, 0x5c64, 0x4c45, 0x3ca2, 0x2c83, 0x1ce0, 0x0cc1,
-        0xef1f, 0xff3e, 0xcf5d, 0xdf7c, 0xaf9b, 0xbfba, 0x8fd9, 0x9ff8,
-        0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0x0ed1, 0x1ef0,
-    ]
+    # MT arrival notification when unsolicited messages are enabled with AT+UNS=1, see
+    # https://docs.rockremote.io/serial-interface#status-of-mt-imt
+    re_unsolicited_mt = re.compile(r'^\+IMTMTS:\s*\d+,')
+
+    # AT+IMTMOS status of a message that has gone out over the air
+    IMT_MO_SENT = 5
 
     def __init__(self, cfg, *args, **kwargs):
         super().__init__(cfg, *args, **kwargs)
 
-        self._imt_max_bytes = bool(cfg['ModemConnection']['imt_max_bytes']) \
+        self._imt_max_bytes = int(cfg['ModemConnection']['imt_max_bytes']) \
             if 'imt_max_bytes' in cfg['ModemConnection'] else 99990
+        # Number of file chunks kept in the modem MO queue at once, 1 being stop and wait
+        self._imt_window = int(cfg['ModemConnection']['imt_window']) \
+            if 'imt_window' in cfg['ModemConnection'] else 1
+        self._imt_poll_interval = float(cfg['ModemConnection']['imt_poll_interval']) \
+            if 'imt_poll_interval' in cfg['ModemConnection'] else 2.
+        self._imt_poll_max = float(cfg['ModemConnection']['imt_poll_max']) \
+            if 'imt_poll_max' in cfg['ModemConnection'] else 30.
+        self._imt_mo_timeout = float(cfg['ModemConnection']['imt_mo_timeout']) \
+            if 'imt_mo_timeout' in cfg['ModemConnection'] else 600.
+        self._imt_retransmits = int(cfg['ModemConnection']['imt_retransmits']) \
+            if 'imt_retransmits' in cfg['ModemConnection'] else 3
 
     @staticmethod
     def calculate_crc16(payload, crc=0):
         """
 
-        Lifted from https://github.com/tehmaze/xmodem/blob/74fad59be70b6ea173484f52f08bbcfc374b9026/xmodem/__init__.py#L663
-        The GroundControl CRC algorithm is the equivalent of the XMODEM implementation so
-        might as well use that
+        The GroundControl CRC algorithm is the equivalent of CRC16 XMODEM, which binascii provides in C
 
         Args:
-            payload:
-            crc:
+            payload: bytes-like object
+            crc: running CRC to continue from, for payloads written in pieces
 
         Returns:
-            data:
+            int CRC
         """
-        for char in bytearray(payload):
-            crctbl_idx = ((crc >> 8) ^ char) & 0xff
-            crc = ((crc << 8) ^ CertusConnection.CRC_TABLE[crctbl_idx]) & 0xffff
-        return crc & 0xffff
+        return binascii.crc_hqx(payload, crc)
 
     def get_system_time(self):
         return None
 
+    @property
+    def max_message_bytes(self):
+        return self._imt_max_bytes
+
     def initialise_modem(self):
         super().initialise_modem()
 
         devices = ['"Mini"']
-        reply = self.modem_command("AT+CGMM")
+        reply = self.modem_response("AT+CGMM")
 
         try:
-            device = reply.split(self.terminator)[0].split(":")[1].strip()
+            device = reply.lines[0].split(":")[1].strip()
         except (IndexError, ValueError):
             raise ConnectionException("Could not parse device response")
 
@@ -470,87 +642,156 @@ class CertusConnection(BaseConnection):
             raise ConnectionException("{} can only be used with {}, but we got {}".
                                       format(self.__class__.__name__, " or ".join(devices), device))
 
-        # TODO: https://docs.rockremote.io/serial-interface#status-of-mt-imt
-        #  this will need to be run periodically as here we switch off unsolicited messages
-        # TODO: handle unsolicited messages and avoid turning them off
-        reply = self.modem_command("AT+UNS=0")
+        # Unless we're listening for them, switch off unsolicited messages and rely on polling, see
+        #  https://docs.rockremote.io/serial-interface#status-of-mt-imt
+        reply = self.modem_response("AT+UNS={}".format(1 if self.unsolicited else 0))
 
-        if reply.split()[-1] != "OK":
-            raise ConnectionException("Cannot switch Certus modem to solicited messaging mode")
+        if not reply.ok:
+            raise ConnectionException("Cannot switch Certus modem to {}solicited messaging mode".format(
+                "un" if self.unsolicited else ""))
 
     def poll_for_messages(self):
-        response = self.modem_command("AT+IMTMTS")
-        mt_queued = response.splitlines()[0].startswith("+IMTMTS: ")
+        """Collect every MT message waiting on the modem, across all topics
 
-        if mt_queued:
-            msg_info = response.splitlines()[0].replace("+IMTMTS: ", "").strip()
-            topic_id, mt_msg_id, mt_msg_len = msg_info.split(",")
+        Each message is acknowledged as soon as it's been read, which removes it from the modem so the next on the
+        same topic can be read. The queue is listed again once all the listed messages have been read, until the
+        modem has nothing left for us.
+        """
+        collected = set()
 
-            mt_message = self.modem_command("AT+IMTRB={}".format(topic_id), dont_decode=True)
+        while True:
+            response = self.modem_response("AT+IMTMTS")
+            queued = [[v.strip() for v in info.split(",")] for info in response.values("+IMTMTS")]
+            queued = [q for q in queued if len(q) == 3 and q[1] not in collected]
 
-            if mt_message:
-                mt_message = mt_message.rstrip("\rOK\r".encode("ascii"))
-                try:
-                    message = mt_message[0:-2]
-                    chksum = mt_message[-2:]
-                except IndexError:
-                    raise ConnectionException(
-                        "Message indexing was not successful for message ID {} length {}".format(
-                            mt_msg_id, mt_msg_len))
+            if not len(queued):
+                break
+
+            logging.info("{} MT messages queued on the modem".format(len(queued)))
+            for topic_id, mt_msg_id, mt_msg_len in queued:
+                self._read_imt_message(topic_id, mt_msg_id, int(mt_msg_len))
+                collected.add(mt_msg_id)
+
+                response = self.modem_response("AT+IMTA={}".format(mt_msg_id))
+                if response.ok:
+                    logging.info("Acknowledged IMT message ID {}".format(mt_msg_id))
                 else:
-                    calcd_chksum = CertusConnection.calculate_crc16(message)
+                    logging.warning("Could not acknowledge IMT message ID {}: {}".format(mt_msg_id, response))
 
-                    try:
-                        recv_chksum = struct.unpack(">H", chksum)[0]
-                    except (struct.error, IndexError) as e:
-                        raise ConnectionException(
-                            "Could not decompose the values from the incoming SBD message: {}".format(e.message))
-
-                    self.output_recv_message(mt_msg_id,
-                                             # Remove the unnecessary checksum inclusion
-                                             int(mt_msg_len),
-                                             message,
-                                             calcd_chksum,
-                                             recv_chksum)
-                    response = self.modem_command("AT+IMTA={}".format(mt_msg_id))
-                    if response.splitlines()[-1] == "OK":
-                        logging.info("Acknowledged IMT message ID {}".format(mt_msg_id))
+        if len(collected):
+            logging.info("Collected {} MT messages".format(len(collected)))
+
+    def _read_imt_message(self, topic_id, mt_msg_id, mt_msg_len):
+        """Stream the next MT message on a topic into the message destination
+
+        The message is written out as it comes off the serial line, with its CRC calculated on the way, so large
+        messages are never held in memory.
+        """
+        part_filename = os.path.join(self.mt_destination, ".{}.part".format(mt_msg_id))
+        state = {"read": 0, "crc": 0, "chksum": bytearray()}
+
+        with open(part_filename, "wb") as fh:
+            def _sink(data):
+                # The message is followed by its two byte CRC
+                body = data[:max(mt_msg_len - state["read"], 0)]
+                fh.write(body)
+                state["crc"] = CertusConnection.calculate_crc16(body, state["crc"])
+                state["chksum"] += data[len(body):]
+                state["read"] += len(data)
+
+            try:
+                self.modem_response("AT+IMTRB={}".format(topic_id),
+                                    binary_length=mt_msg_len + 2,
+                                    binary_sink=_sink)
+            except ConnectionException:
+                fh.close()
+                os.unlink(part_filename)
+                raise
+
+        received = state["read"] - len(state["chksum"])
+        if received != mt_msg_len or len(state["chksum"]) != 2:
+            logging.warning("Message length indicated {} is not the same as actual message: {}".format(
+                mt_msg_len, received))
+            valid = False
+        else:
+            recv_chksum = struct.unpack(">H", bytes(state["chksum"]))[0]
+            valid = recv_chksum == state["crc"]
+            if not valid:
+                logging.warning("Message checksum {} is not the same as calculated checksum: {}".format(
+                    state["crc"], recv_chksum))
+
+        msg_filename = self.recv_message_path(mt_msg_id, valid)
+        logging.info("Received MT message, outputting to {}".format(msg_filename))
+        os.replace(part_filename, msg_filename)
 
     def process_message(self, msg):
         if msg:
             text = msg.get_message_text()
+            if self._write_imt_message([text.encode() if not msg.binary else text]) is None \
+                    and not self.fragment_messages:
+                logging.warning("Dropping message of {} bytes, set fragment_messages to send messages this big".format(
+                    len(text)))
 
-            response = self.modem_command("AT+IMTWB={}".format(len(text)))
-            if response.startswith("+IMTWB ERROR: 2"):
-                logging.warning("Message is too big")
-                return True
-            elif not response.splitlines()[-1].strip().endswith("READY"):
-                raise ConnectionException("Error preparing for binary message: {}".format(response))
+        return True
 
-            payload = text.encode() if not msg.binary else text
-            payload += CertusConnection.calculate_crc16(payload).to_bytes(2, "big")
-            response = self.modem_command(payload, raw=True)
+    def _write_imt_message(self, buffers):
+        """Write a message into the modem MO queue
 
-            if response.splitlines()[-1] != "OK":
-                raise ConnectionException("Error writing output binary for SBD".format(response))
-            message_id = response.splitlines()[0].split(":")[1]
-            logging.info("Sent {} bytes with message ID {}".format(len(payload), message_id))
+        Args:
+            buffers: list of bytes-like objects making up the message, written in sequence
 
-        return True
+        Returns:
+            message ID assigned by the modem, or None if the message is too big to send
+        """
+        length = sum(len(b) for b in buffers)
+        crc = 0
+        for buf in buffers:
+            crc = CertusConnection.calculate_crc16(buf, crc)
+
+        response = self.modem_binary("AT+IMTWB={}".format(length), list(buffers) + [crc.to_bytes(2, "big")])
+        if (response.result or "").startswith("+IMTWB ERROR: 2"):
+            logging.warning("Message is too big")
+            return None
+        elif not response.ok:
+            raise ConnectionException("Error writing output binary for IMT: {}".format(response))
+        message_id = response.lines[0].split(":")[1].strip()
+        logging.info("Sent {} bytes with message ID {}".format(length + 2, message_id))
+        return message_id
+
+    def _imt_mo_status(self, message_id):
+        """
+
+        Args:
+            message_id: ID returned when the message was written
+
+        Returns:
+            int status, 0 if it couldn't be read, or None if the modem no longer knows the message
+        """
+        response = self.modem_response("AT+IMTMOS={}".format(message_id))
+        if not response.ok:
+            return None
+
+        status = 0
+        try:
+            message_response = response.lines[0].split(":")[1]
+            status = int(message_response.strip().split(",")[1])
+        except (IndexError, TypeError, ValueError) as e:
+            logging.error("Something wrong converting IMTMOS status value {} - {}".
+                          format(status, e))
+        return status
 
     def process_transfer(self, filename):
         if not os.path.exists(filename):
             logging.warning("{} does not exist, we will not try and send it".format(filename))
             return False
 
-        previous_files = dict()
-        cache_name = "filesender.cache"
-        if os.path.exists(cache_name):
-            logging.debug("Opening cache {}".format(cache_name))
-            with open(cache_name, "r") as fs:
-                previous_files = json.load(fs)
+        journal = self.transfer_journal
+        key = journal.file_key(filename)
+        if journal.is_done(key):
+            logging.warning("Not file sending {} as it has already been sent".format(filename))
+            return True
 
-        file_length = os.stat(filename)[stat.ST_SIZE]
+        file_length = key[1]
         file_basename = os.path.basename(filename).encode("latin-1")[:255]
         logging.debug("Opening {} for transfer, {} bytes long".format(file_basename, file_length))
         length = len(file_basename)
@@ -566,78 +807,89 @@ class CertusConnection(BaseConnection):
         continuation += struct.pack("!iLLL",
                                     binascii.crc32(file_basename) & 0xffff,
                                     file_length, 0, 0)
-        #
-        chunks = list()
-        while sum(chunks) < file_length:
-            print(sum(chunks))
-            chunks.append(min(self._imt_max_bytes - (len(header) if len(chunks) == 0 else len(continuation)),
-                              file_length - sum(chunks)))
-        logging.debug("Calculated chunks of length: {}".format(", ".join([str(c) for c in chunks])))
-
-        if (filename in previous_files.keys()
-                and type(previous_files[filename]) is list
-                and len(chunks) == len(previous_files[filename])):
-            logging.warning("Not file sending {} as it's in the cache and {} chunks "
-                            "sent already".format(filename, len(chunks)))
-            return True
-
-        with open(filename, "rb") as fh:
-            if filename not in previous_files:
-                previous_files[filename] = list()
-
-            for i, chunk in enumerate(chunks):
-                message_header = header if i == 0 else continuation
-                start = sum(chunks[:i])
-                if start in previous_files[filename]:
-                    # We are skipping this chunk as it's been recorded on disk
-                    continue
-                file_data = fh.read(chunk)
-                end = min(sum(chunks[:i])+chunk, file_length)
-                logging.debug("Sending {} bytes from {} between {} and {}".format(
-                    len(file_data), filename, start, end))
-                message_header[-struct.calcsize("!LL"):] = struct.pack("!LL", start, end)
-
-                message = message_header + file_data
-                response = self.modem_command("AT+IMTWB={}".format(len(message)))
-                if response.startswith("+IMTWB ERROR: 2"):
-                    logging.warning("Message is too big")
-                    return True
-                elif not response.splitlines()[-1].strip().endswith("READY"):
-                    raise ConnectionException("Error preparing for binary message: {}".format(response))
-
-                message += CertusConnection.calculate_crc16(message).to_bytes(2, "big")
-                response = self.modem_command(message, raw=True)
-
-                if response.splitlines()[-1] != "OK":
-                    raise ConnectionException("Error writing output binary for Certus".format(response))
-                message_id = response.splitlines()[0].split(":")[1]
-                logging.info("Sent {} bytes with message ID {}".format(len(message), message_id))
-
-                sent = False
-                retries = 0
-
-                while not sent:
-                    response = self.modem_command("AT+IMTMOS={}".format(message_id))
-                    status = 0
-
-                    try:
-                        message_response = response.splitlines()[0].split(":")[1]
-                        status = int(message_response.strip().split(",")[1])
-                    except (IndexError, TypeError, ValueError) as e:
-                        logging.error("Something wrong converting IMTMOS status value {} - {}".
-                                      format(status, e))
 
-                    if status == 5:
+        with FileChunkReader(filename) as reader:
+            # Only plan the byte ranges that haven't made it across in an earlier session, or that have been
+            # appended since the file was last sent
+            offset = self._delta_offset(filename, file_length, reader) if self.delta_transfers else 0
+            plan = ChunkPlan(file_length, len(header), len(continuation),
+                             ranges=journal.missing(key, file_length, offset))
+            logging.debug("Planned {} bytes to send: {}".format(
+                plan.remaining, ", ".join(["{}-{}".format(start, end) for start, end in plan.ranges])))
+
+            # Message IDs of the chunks in the modem MO queue, with attempts counted by chunk start offset
+            in_flight = dict()
+            attempts = collections.Counter()
+            interval = self._imt_poll_interval
+
+            while plan or in_flight:
+                while plan and len(in_flight) < self._imt_window:
+                    # Never below what the full header needs to carry some data, or a long file name stalls forever
+                    start, end = plan.take(max(self.chunk_sizer.size if self.adaptive_sizing else self._imt_max_bytes,
+                                               len(header) + 1))
+                    message_header = header if plan.is_first(start) else continuation
+                    file_data = reader.chunk(start, end)
+                    logging.debug("Sending {} bytes from {} between {} and {}".format(
+                        len(file_data), filename, start, end))
+                    message_header[-struct.calcsize("!LL"):] = struct.pack("!LL", start, end)
+
+                    # Header and file data go to the port as they are, without joining them up
+                    message_id = self._write_imt_message([bytes(message_header), file_data])
+                    if message_id is None:
+                        return True
+
+                    in_flight[message_id] = (start, end, tm.monotonic())
+                    attempts[start] += 1
+                    interval = self._imt_poll_interval
+
+                tm.sleep(interval)
+                progressed = False
+
+                # One pass over everything outstanding, rather than waiting on each message in turn
+                for message_id, (start, end, submitted) in list(in_flight.items()):
+                    status = self._imt_mo_status(message_id)
+
+                    if status == CertusConnection.IMT_MO_SENT:
                         logging.debug("Message id {} successfully sent".format(message_id))
-                        previous_files[filename].append(chunk)
-                        with open(cache_name, "w") as fs:
-                            json.dump(previous_files, fs)
-                        sent = True
-                    elif retries < 60:
-                        retries += 1
-                        tm.sleep(10)
-                    else:
-                        # TODO: record failed scenario for chunk?
-                        break
-        # We've ended for some reason or another, so assume we're good
+                        del in_flight[message_id]
+                        journal.record(key, start, end)
+                        if self.adaptive_sizing:
+                            self.chunk_sizer.success()
+                        progressed = True
+                    elif status is None or tm.monotonic() - submitted > self._imt_mo_timeout:
+                        del in_flight[message_id]
+                        if self.adaptive_sizing:
+                            self.chunk_sizer.failure()
+                        if attempts[start] > self._imt_retransmits:
+                            raise ConnectionException("Chunk at {} of {} not sent after {} attempts".format(
+                                start, filename, attempts[start]))
+                        logging.warning("Message id {} for {}-{} of {} has not been sent, will retransmit".format(
+                            message_id, start, end, filename))
+                        # Back in the plan, to be cut again at whatever size the link now warrants
+                        plan.put_back(start, end)
+                        progressed = True
+
+                # Poll quickly while messages are going out, backing off while the modem is waiting on the network
+                interval = self._imt_poll_interval if progressed else min(interval * 2, self._imt_poll_max)
+
+            journal.finish(key, reader.crc32(file_length) if self.delta_transfers else None)
         return True
+
+    def _delta_offset(self, filename, file_length, reader):
+        """Work out where to start sending a file that may only have been appended to since it was last sent
+
+        Returns:
+            offset of the first byte not already sent, 0 if the file needs sending in full
+        """
+        baseline = self.transfer_journal.baseline(filename)
+        if not baseline:
+            return 0
+
+        sent_length, sent_crc = baseline
+        if sent_length > file_length or reader.crc32(sent_length) != sent_crc:
+            logging.info("{} has changed since it was last sent, sending in full".format(filename))
+            return 0
+
+        logging.info("{} was sent up to {} bytes, sending the {} bytes appended since".format(
+            filename, sent_length, file_length - sent_length))
+        return sent_length
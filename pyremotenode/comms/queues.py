@@ -0,0 +1,137 @@
+import logging
+import os
+import pickle
+import queue
+import sqlite3
+import threading as t
+
+
+class MessageQueue(object):
+    """ In memory outbound queue, ordered by priority then submission
+
+    Entries handed out by get() stay outstanding until they're either acknowledged, at which point they're gone,
+    or requeued, which puts them back at the head of their priority so they're retried before anything newer.
+    """
+    def __init__(self):
+        self._queue = queue.PriorityQueue()
+        self._lock = t.Lock()
+        self._outstanding = dict()
+        self._next_id = 0
+        self._head = 0
+
+    def put(self, entry):
+        """Queue an entry
+
+        Args:
+            entry: tuple of (priority, item)
+        """
+        priority, item = entry
+        with self._lock:
+            self._next_id += 1
+            self._queue.put((priority, self._next_id, self._next_id, item))
+
+    def get(self, timeout=None):
+        """Take the next entry
+
+        Returns:
+            tuple of (priority, item, entry_id), use the entry_id to ack or requeue it
+
+        Raises:
+            queue.Empty if nothing is queued
+        """
+        priority, _, entry_id, item = self._queue.get(timeout=timeout)
+        with self._lock:
+            self._outstanding[entry_id] = (priority, item)
+        return priority, item, entry_id
+
+    def ack(self, entry_id):
+        with self._lock:
+            self._outstanding.pop(entry_id, None)
+
+    def requeue(self, entry_id):
+        with self._lock:
+            if entry_id in self._outstanding:
+                priority, item = self._outstanding.pop(entry_id)
+                self._head -= 1
+                self._queue.put((priority, self._head, entry_id, item))
+
+    def empty(self):
+        return self._queue.empty()
+
+    def qsize(self):
+        with self._lock:
+            return self._queue.qsize() + len(self._outstanding)
+
+
+class PersistentMessageQueue(object):
+    """ SQLite backed outbound queue that survives sleeps, reboots and crashes
+
+    Each entry is written and synced before put() returns and is only removed when it's acknowledged, so delivery
+    is at least once: anything outstanding when the process died is put back at the head of the queue on startup.
+    Items are pickled, so they need to be plain data or Message instances.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._lock = t.Lock()
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                priority INTEGER NOT NULL,
+                                seq INTEGER NOT NULL,
+                                outstanding INTEGER NOT NULL DEFAULT 0,
+                                item BLOB NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_order ON entries (outstanding, priority, seq)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_seq ON entries (seq)")
+
+        with self._lock:
+            recovered = self._db.execute("SELECT COUNT(*) FROM entries WHERE outstanding = 1").fetchone()[0]
+            if recovered:
+                logging.warning("Recovering {} unacknowledged messages to the head of the queue".format(recovered))
+                self._db.execute("UPDATE entries SET outstanding = 0, seq = seq - "
+                                 "(SELECT MAX(seq) - MIN(seq) + 1 FROM entries) WHERE outstanding = 1")
+        logging.info("Opened persistent message queue {} with {} entries".format(path, self.qsize()))
+
+    def put(self, entry):
+        priority, item = entry
+        with self._lock:
+            self._db.execute("INSERT INTO entries (priority, seq, item) "
+                             "VALUES (?, (SELECT IFNULL(MAX(seq), 0) + 1 FROM entries), ?)",
+                             (priority, pickle.dumps(item)))
+
+    def get(self, timeout=None):
+        with self._lock:
+            row = self._db.execute("SELECT id, priority, item FROM entries WHERE outstanding = 0 "
+                                   "ORDER BY priority, seq LIMIT 1").fetchone()
+            if row is None:
+                raise queue.Empty
+
+            entry_id, priority, item = row
+            self._db.execute("UPDATE entries SET outstanding = 1 WHERE id = ?", (entry_id, ))
+        return priority, pickle.loads(item), entry_id
+
+    def ack(self, entry_id):
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE id = ?", (entry_id, ))
+
+    def requeue(self, entry_id):
+        with self._lock:
+            self._db.execute("UPDATE entries SET outstanding = 0, "
+                             "seq = (SELECT MIN(seq) - 1 FROM entries) WHERE id = ?", (entry_id, ))
+
+    def empty(self):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM entries WHERE outstanding = 0 LIMIT 1").fetchone() is None
+
+    def qsize(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
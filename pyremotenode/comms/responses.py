@@ -0,0 +1,214 @@
+import logging
+import re
+import struct
+
+
+class ModemResponse(object):
+    """ A single parsed response from the modem to a command
+
+    Holds the final result code along with any intermediate lines and binary block that preceded it, so
+    callers don't need to split and subscript the decoded reply themselves.
+    """
+    def __init__(self, result=None, lines=None, binary=None, raw=None):
+        self._result = result
+        self._lines = lines if lines is not None else []
+        self._binary = binary
+        self._raw = raw if raw is not None else bytearray()
+
+    def value(self, prefix):
+        """Get the value of the first intermediate line starting with prefix, eg. +SBDIX
+
+        Args:
+            prefix: information response prefix, without the trailing colon
+
+        Returns:
+            the stripped text after the colon, or None if no such line was received
+        """
+        values = self.values(prefix)
+        return values[0] if len(values) else None
+
+    def values(self, prefix):
+        return [line[len(prefix):].lstrip(":").strip() for line in self._lines
+                if line.startswith(prefix)]
+
+    @property
+    def binary(self):
+        return self._binary
+
+    @property
+    def complete(self):
+        return self._result is not None
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @property
+    def ok(self):
+        return self._result == "OK"
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @property
+    def result(self):
+        return self._result
+
+    @property
+    def text(self):
+        return "\n".join(self._lines)
+
+    def __str__(self):
+        return "\n".join(self._lines + ([self._result] if self._result else []))
+
+
+class ResponseParser(object):
+    """ Incremental tokenizer for modem replies
+
+    Bytes are handed to feed() as they come off the serial line and only the newly arrived bytes are examined.
+    Lines are split on CR/LF, intermediate lines are collected and the response is complete once a final result
+    code line is seen. Binary blocks can be expected ahead of the textual response, either of a known length or
+    prefixed with a two byte big endian length (with a two byte checksum following the body) as per AT+SBDRB.
+    """
+    RESULT_CODES = (
+        "OK",
+        "ERROR",
+        "BUSY",
+        "NO DIALTONE",
+        "NO CARRIER",
+        "RING",
+        "NO ANSWER",
+        "READY",
+        "GOFORIT",
+        "NAMERECV",
+        "BATCHRECV",
+    )
+
+    re_error_result = re.compile(r'^\+[A-Z]+ ERROR(?::.*)?$')
+    re_connect_result = re.compile(r'^CONNECT(?:\s\d+)?$')
+    re_line_end = re.compile(b'[\r\n]')
+
+    STATE_LENGTH = 0
+    STATE_BINARY = 1
+    STATE_LINE = 2
+
+    def __init__(self,
+                 binary_length=None,
+                 length_prefixed=False,
+                 results=None,
+                 unsolicited=None,
+                 binary_sink=None):
+        """
+
+        Args:
+            binary_length: number of bytes of binary to read before the textual response
+            length_prefixed: the binary block is prefixed with a two byte length and followed by a checksum
+            results: additional lines to treat as a final result for this command
+            unsolicited: callable given each line, returning True if it consumed it as an unsolicited result code
+            binary_sink: callable given each piece of the binary block as it arrives, rather than it being kept
+                in the response, so large blocks needn't be held in memory
+        """
+        self._results = self.RESULT_CODES + (tuple(results) if results else ())
+        self._unsolicited = unsolicited
+        self._sink = binary_sink
+        self._lines = []
+        self._line = bytearray()
+        self._binary = None
+        self._raw = bytearray()
+        self._result = None
+
+        self._remaining = 0
+        self._state = self.STATE_LINE
+
+        if length_prefixed:
+            self._state = self.STATE_LENGTH
+            self._binary = bytearray()
+            self._remaining = 2
+        elif binary_length is not None:
+            self._state = self.STATE_BINARY
+            self._binary = bytearray()
+            self._remaining = int(binary_length)
+
+    def feed(self, data):
+        """Consume newly read bytes
+
+        Args:
+            data: bytes just read from the modem
+
+        Returns:
+            the number of bytes consumed, anything after the final result is left unconsumed
+        """
+        data = bytes(data)
+        if self._sink is None:
+            self._raw += data
+        offset = 0
+
+        while offset < len(data) and not self.complete:
+            if self._state == self.STATE_LINE:
+                start = offset
+                offset = self._feed_line(data, offset)
+                if self._sink is not None:
+                    self._raw += memoryview(data)[start:offset]
+            else:
+                take = min(self._remaining, len(data) - offset)
+                if self._sink is not None and self._state == self.STATE_BINARY:
+                    self._sink(memoryview(data)[offset:offset + take])
+                else:
+                    self._binary += memoryview(data)[offset:offset + take]
+                self._remaining -= take
+                offset += take
+
+                if self._remaining == 0:
+                    if self._state == self.STATE_LENGTH:
+                        # Body length plus the trailing two byte checksum
+                        self._remaining = struct.unpack(">H", bytes(self._binary[0:2]))[0] + 2
+                        self._state = self.STATE_BINARY
+                    else:
+                        self._state = self.STATE_LINE
+        return offset
+
+    def _feed_line(self, data, offset):
+        end = self.re_line_end.search(data, offset)
+
+        if not end:
+            self._line += memoryview(data)[offset:]
+            return len(data)
+
+        self._line += memoryview(data)[offset:end.start()]
+        self._end_line()
+        return end.end()
+
+    def _end_line(self):
+        line = self._line.decode("latin-1").strip()
+        self._line = bytearray()
+
+        if not len(line):
+            return
+
+        if self._unsolicited is not None and self._unsolicited(line):
+            return
+
+        if line in self._results \
+                or self.re_error_result.match(line) \
+                or self.re_connect_result.match(line):
+            self._result = line
+        else:
+            self._lines.append(line)
+
+    def response(self):
+        """Get the response parsed so far, which will have no result if it was never completed"""
+        if not self.complete and len(self._line):
+            logging.debug("Incomplete line left in response buffer: {}".format(self._line))
+        return ModemResponse(self._result,
+                             self._lines,
+                             bytes(self._binary) if self._binary is not None else None,
+                             self._raw)
+
+    @property
+    def complete(self):
+        return self._result is not None
+
+    @property
+    def partial(self):
+        return len(self._line) > 0
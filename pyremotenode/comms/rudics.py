@@ -0,0 +1,384 @@
+import binascii
+import json
+import logging
+import os
+import struct
+import time as tm
+
+# Every frame is MAGIC, type, sequence and payload length, then the payload and a CRC32 of everything after the
+# magic byte. A frame that fails its CRC is skipped by rescanning from the byte after its magic.
+FRAME_MAGIC = 0xa5
+FRAME_START = 0x01
+FRAME_DATA = 0x02
+FRAME_ACK = 0x03
+FRAME_END = 0x04
+FRAME_DONE = 0x05
+
+FRAME_HEADER = struct.Struct("!BBIH")
+FRAME_CRC = struct.Struct("!I")
+MAX_PAYLOAD = 8192
+
+DONE_OK = 0
+DONE_BAD_CRC = 1
+
+
+def encode_frame(frame_type, seq, payload=b""):
+    header = FRAME_HEADER.pack(FRAME_MAGIC, frame_type, seq, len(payload))
+    crc = binascii.crc32(payload, binascii.crc32(header[1:]))
+    return header + bytes(payload) + FRAME_CRC.pack(crc & 0xffffffff)
+
+
+def encode_ack(base, received):
+    """
+
+    Args:
+        base: number of blocks received contiguously from the start of the file
+        received: block numbers received beyond base
+
+    Returns:
+        bytes of an ACK frame with a bitmap of blocks received after base
+    """
+    bitmap = bytearray()
+    for block in received:
+        bit = block - base - 1
+        if bit < 0:
+            continue
+        while len(bitmap) <= bit // 8:
+            bitmap.append(0)
+        bitmap[bit // 8] |= 1 << (bit % 8)
+    return encode_frame(FRAME_ACK, base, bitmap)
+
+
+def decode_ack(base, bitmap):
+    return set(base + 1 + i * 8 + b for i, byte in enumerate(bitmap) for b in range(8) if byte & (1 << b))
+
+
+class FrameDecoder(object):
+    """ Picks frames out of the byte stream, skipping anything that isn't one such as modem result codes """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+
+        Args:
+            data: bytes read from the line
+
+        Returns:
+            list of (type, seq, payload) tuples for the complete frames now available
+        """
+        self._buffer += data
+        frames = []
+
+        while True:
+            start = self._buffer.find(bytes([FRAME_MAGIC]))
+            if start < 0:
+                del self._buffer[:]
+                break
+            del self._buffer[:start]
+
+            if len(self._buffer) < FRAME_HEADER.size:
+                break
+            _, frame_type, seq, length = FRAME_HEADER.unpack_from(self._buffer)
+            if length > MAX_PAYLOAD:
+                del self._buffer[:1]
+                continue
+
+            end = FRAME_HEADER.size + length + FRAME_CRC.size
+            if len(self._buffer) < end:
+                break
+
+            crc = FRAME_CRC.unpack_from(self._buffer, end - FRAME_CRC.size)[0]
+            if binascii.crc32(self._buffer[1:end - FRAME_CRC.size]) & 0xffffffff != crc:
+                logging.debug("Discarding corrupt frame")
+                del self._buffer[:1]
+                continue
+
+            frames.append((frame_type, seq, bytes(self._buffer[FRAME_HEADER.size:end - FRAME_CRC.size])))
+            del self._buffer[:end]
+        return frames
+
+
+class WindowedSender(object):
+    """ Sliding window file sender for a RUDICS data call
+
+    Blocks are streamed without waiting for each to be acknowledged, keeping up to window blocks outstanding so
+    the circuit is never idle for a round trip. The receiver acknowledges with the number of blocks it has in
+    sequence plus a bitmap of any it has beyond them, so only blocks that were actually lost are sent again.
+    The whole file is finally checked against its CRC32 by the receiver.
+
+    The receiver answers the start of a transfer with the number of blocks it already holds for the same file,
+    so a transfer cut off by a dropped call carries on from there once the call is back up.
+    """
+    def __init__(self, read, write, block_size=1024, window=8, timeout=10., max_retries=8):
+        """
+
+        Args:
+            read: callable taking a timeout in seconds and returning whatever bytes arrived, if any
+            write: callable writing bytes to the line
+            block_size: bytes of file data in each block
+            window: number of blocks that can be unacknowledged
+            timeout: initial retransmission timeout, adapted to the measured round trip
+            max_retries: times a block can time out before the transfer is abandoned
+        """
+        self._read = read
+        self._write = write
+        self._block_size = block_size
+        self._window = window
+        self._rto = timeout
+        self._max_retries = max_retries
+        self._decoder = FrameDecoder()
+        self._srtt = None
+
+    def send(self, data, progress=None):
+        """Send a file
+
+        Args:
+            data: bytes-like object of the file content, or a FileChunkReader to read blocks as they're sent
+            progress: callable given the number of bytes the receiver has confirmed, as that grows
+
+        Returns:
+            number of blocks sent, including retransmissions
+
+        Raises:
+            WindowedTransferError if the receiver stops responding or rejects the file
+        """
+        length = len(data)
+        total = (length + self._block_size - 1) // self._block_size
+        file_crc = 0
+        for offset in range(0, length, 65536):
+            file_crc = binascii.crc32(data[offset:offset + 65536], file_crc)
+        file_crc &= 0xffffffff
+
+        base = min(self._handshake(encode_frame(FRAME_START, self._block_size, struct.pack("!QI", length, file_crc))),
+                   total)
+        if base:
+            logging.info("Receiver already has {} bytes, resuming".format(min(base * self._block_size, length)))
+        logging.info("Sending {} blocks of {} bytes, starting at block {}".format(total, self._block_size, base))
+
+        received = set()
+        sent_at = dict()
+        retries = dict()
+        next_block = base
+        blocks_sent = 0
+        end_sent_at = None
+
+        while True:
+            while next_block < total and next_block < base + self._window:
+                self._send_block(data, next_block, sent_at)
+                next_block += 1
+                blocks_sent += 1
+
+            if base >= total and (end_sent_at is None or tm.monotonic() - end_sent_at > self._rto):
+                if end_sent_at is not None:
+                    retries[total] = retries.get(total, 0) + 1
+                    if retries[total] > self._max_retries:
+                        raise WindowedTransferError("No response to end of file")
+                self._write(encode_frame(FRAME_END, total))
+                end_sent_at = tm.monotonic()
+
+            for frame_type, seq, payload in self._poll(0.5):
+                if frame_type == FRAME_DONE and seq == total:
+                    if payload[:1] != bytes([DONE_OK]):
+                        raise WindowedTransferError("Receiver rejected the file with status {}".format(
+                            payload[0] if len(payload) else None))
+                    return blocks_sent
+                elif frame_type != FRAME_ACK:
+                    continue
+
+                if seq > base:
+                    # Karn's algorithm, only blocks sent the once give a meaningful round trip
+                    if seq - 1 in sent_at and not retries.get(seq - 1):
+                        self._measure(tm.monotonic() - sent_at[seq - 1])
+                    base = min(seq, total)
+                    if progress:
+                        progress(min(base * self._block_size, length))
+                next_block = max(next_block, base)
+
+                received = set([b for b in received | decode_ack(seq, payload) if base <= b < total])
+                if len(received):
+                    newest = max(received)
+                    for block in range(base, newest):
+                        # Anything sent before a block that's since arrived has been lost
+                        if block not in received and block in sent_at and sent_at[block] <= sent_at.get(newest, 0):
+                            logging.debug("Selectively retransmitting block {}".format(block))
+                            retries[block] = retries.get(block, 0) + 1
+                            self._send_block(data, block, sent_at)
+                            blocks_sent += 1
+
+            if base < total and base in sent_at and tm.monotonic() - sent_at[base] > self._rto:
+                retries[base] = retries.get(base, 0) + 1
+                if retries[base] > self._max_retries:
+                    raise WindowedTransferError("Block {} timed out {} times".format(base, retries[base]))
+                logging.debug("Block {} timed out after {:.1f} seconds, retransmitting".format(base, self._rto))
+                self._rto = min(self._rto * 2, 120.)
+                self._send_block(data, base, sent_at)
+                blocks_sent += 1
+
+    def _handshake(self, start):
+        for attempt in range(self._max_retries + 1):
+            if attempt:
+                logging.debug("No response to the start of the transfer, resending ({})".format(attempt))
+            self._write(start)
+            deadline = tm.monotonic() + self._rto * 2
+            while tm.monotonic() < deadline:
+                for frame_type, seq, _ in self._poll(deadline - tm.monotonic()):
+                    if frame_type == FRAME_ACK:
+                        return seq
+        raise WindowedTransferError("Receiver did not respond to the start of the transfer")
+
+    def _measure(self, rtt):
+        self._srtt = rtt if self._srtt is None else 0.875 * self._srtt + 0.125 * rtt
+        self._rto = min(max(2 * self._srtt, 2.), 120.)
+
+    def _poll(self, timeout):
+        data = self._read(max(timeout, 0.01))
+        return self._decoder.feed(data) if data else []
+
+    def _send_block(self, data, block, sent_at):
+        start = block * self._block_size
+        self._write(encode_frame(FRAME_DATA, block, data[start:start + self._block_size]))
+        sent_at[block] = tm.monotonic()
+
+
+class WindowedReceiver(object):
+    """ Ground side of WindowedSender, writing blocks into a file at their offsets as they arrive
+
+    With a state path, the blocks held in sequence are recorded alongside the file so that a later transfer of
+    the same file, identified by its length and CRC32, resumes rather than starting again.
+    """
+    def __init__(self, read, write, timeout=60., state_path=None, sync_every=8):
+        """
+
+        Args:
+            read: callable taking a timeout in seconds and returning whatever bytes arrived, if any
+            write: callable writing bytes to the line
+            timeout: seconds without a frame before the transfer is abandoned
+            state_path: where to record progress for resuming
+            sync_every: blocks between progress records
+        """
+        self._read = read
+        self._write = write
+        self._timeout = timeout
+        self._state_path = state_path
+        self._sync_every = sync_every
+        self._decoder = FrameDecoder()
+        self._total = None
+
+    def receive(self, fh, data=b""):
+        """Receive a file
+
+        Args:
+            fh: file opened for binary writing and reading
+            data: bytes already read from the line after the preamble
+
+        Returns:
+            length of the file received
+
+        Raises:
+            WindowedTransferError if the sender goes quiet or the file fails its CRC
+        """
+        frames = self._decoder.feed(data)
+        block_size, length, file_crc = None, None, None
+        base, total = 0, None
+        synced = 0
+        received = set()
+        last_frame = tm.monotonic()
+
+        while True:
+            if not len(frames):
+                if tm.monotonic() - last_frame > self._timeout:
+                    raise WindowedTransferError("Nothing heard from the sender for {} seconds".format(self._timeout))
+                chunk = self._read(1.)
+                frames = self._decoder.feed(chunk) if chunk else []
+                continue
+            last_frame = tm.monotonic()
+            frame_type, seq, payload = frames.pop(0)
+
+            if frame_type == FRAME_START:
+                block_size = seq
+                length, file_crc = struct.unpack("!QI", payload)
+                total = (length + block_size - 1) // block_size
+                self._total = total
+
+                base = synced = self._load_state(length, file_crc, block_size)
+                received = set()
+                logging.info("Receiving {} bytes in {} blocks of {}, starting at block {}".format(
+                    length, total, block_size, base))
+                fh.truncate(length)
+                self._write(encode_ack(base, received))
+            elif total is None:
+                continue
+            elif frame_type == FRAME_DATA:
+                if seq >= base and seq not in received and seq < total:
+                    fh.seek(seq * block_size)
+                    fh.write(payload)
+                    received.add(seq)
+                    while base in received:
+                        received.remove(base)
+                        base += 1
+
+                    if base - synced >= self._sync_every:
+                        self._save_state(fh, length, file_crc, block_size, base)
+                        synced = base
+                self._write(encode_ack(base, received))
+            elif frame_type == FRAME_END:
+                if base < total:
+                    self._write(encode_ack(base, received))
+                    continue
+
+                fh.flush()
+                fh.seek(0)
+                crc = 0
+                for chunk in iter(lambda: fh.read(65536), b""):
+                    crc = binascii.crc32(chunk, crc)
+
+                status = DONE_OK if crc & 0xffffffff == file_crc else DONE_BAD_CRC
+                # Either way there's nothing worth resuming from now
+                self._clear_state()
+                self._write(encode_frame(FRAME_DONE, total, bytes([status])))
+                if status != DONE_OK:
+                    raise WindowedTransferError("Received file failed its CRC check")
+                return length
+
+    def _load_state(self, length, file_crc, block_size):
+        if not self._state_path or not os.path.exists(self._state_path):
+            return 0
+
+        try:
+            with open(self._state_path, "r") as fh:
+                state = json.load(fh)
+        except ValueError:
+            logging.warning("Could not read transfer state {}, starting afresh".format(self._state_path))
+            return 0
+
+        if (state["length"], state["crc"], state["block_size"]) != (length, file_crc, block_size):
+            logging.info("Transfer state {} is for a different file, starting afresh".format(self._state_path))
+            return 0
+        return state["base"]
+
+    def _save_state(self, fh, length, file_crc, block_size, base):
+        if not self._state_path:
+            return
+
+        # The blocks have to be on disk before we claim to have them
+        fh.flush()
+        os.fsync(fh.fileno())
+
+        tmp_path = "{}.tmp".format(self._state_path)
+        with open(tmp_path, "w") as state:
+            json.dump({"length": length, "crc": file_crc, "block_size": block_size, "base": base}, state)
+        os.replace(tmp_path, self._state_path)
+
+    def _clear_state(self):
+        if self._state_path and os.path.exists(self._state_path):
+            os.unlink(self._state_path)
+
+    @property
+    def total(self):
+        """Number of blocks in the file being received"""
+        return self._total
+
+
+class WindowedTransferError(Exception):
+    pass
@@ -0,0 +1,404 @@
+import collections
+import json
+import logging
+import os
+import threading as t
+import zlib
+
+
+class ChunkPlan(object):
+    """ Byte ranges of a file still to be sent, cut into chunks as they're taken
+
+    Cutting each chunk as it's taken lets it be sized for the link at that moment, and a chunk that fails goes back
+    to be cut again. The chunk at the start of the transfer carries the full file header and the rest a shorter
+    continuation header, both of which count towards the message size. Only the given ranges are planned, so a
+    resumed or appended transfer covers exactly the bytes that are missing.
+    """
+    def __init__(self, file_length, header_length, continuation_length, ranges=None):
+        self._file_length = file_length
+        self._header_length = header_length
+        self._continuation_length = continuation_length
+        self._ranges = collections.deque([(start, end) for start, end in
+                                          (ranges if ranges is not None else [(0, file_length)]) if end > start])
+        self._first = self._ranges[0][0] if len(self._ranges) else None
+
+    def take(self, max_bytes):
+        """Cut the next chunk
+
+        Args:
+            max_bytes: largest message, including the header, the chunk will be sent in
+
+        Returns:
+            tuple of the start and end offsets of the chunk
+        """
+        start, range_end = self._ranges.popleft()
+        overhead = self._header_length if self.is_first(start) else self._continuation_length
+        end = min(start + max_bytes - overhead, range_end)
+        if end <= start:
+            self._ranges.appendleft((start, range_end))
+            raise ValueError("Message size of {} bytes leaves no room for data after a {} byte header".format(
+                max_bytes, overhead))
+
+        if end < range_end:
+            self._ranges.appendleft((end, range_end))
+        return start, end
+
+    def put_back(self, start, end):
+        """Return a chunk that didn't make it, to be cut again"""
+        merged = []
+        for r_start, r_end in sorted(list(self._ranges) + [(start, end)]):
+            if len(merged) and r_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(r_end, merged[-1][1]))
+            else:
+                merged.append((r_start, r_end))
+        self._ranges = collections.deque(merged)
+
+    def is_first(self, start):
+        return start == self._first
+
+    @property
+    def file_length(self):
+        return self._file_length
+
+    @property
+    def ranges(self):
+        return list(self._ranges)
+
+    @property
+    def remaining(self):
+        return sum(end - start for start, end in self._ranges)
+
+    def __bool__(self):
+        return len(self._ranges) > 0
+
+
+class ChunkSizer(object):
+    """ Sizes chunks from how the link has behaved during the current modem session
+
+    The size halves after every failure and doubles after grow_after successes in a row. It is also capped in
+    proportion to the last signal quality, so a marginal sky view starts small rather than losing a large chunk
+    to find out.
+    """
+    def __init__(self, max_bytes, min_bytes=256, grow_after=3):
+        self._max = max_bytes
+        self._min = min(min_bytes, max_bytes)
+        self._grow_after = grow_after
+        self._successes = 0
+        self._failures = 0
+        self.reset()
+
+    def reset(self):
+        """Start afresh for a new session"""
+        if self._successes or self._failures:
+            logging.info("Chunk sizing finished at {} bytes after {} successes and {} failures".format(
+                self._size, self._successes, self._failures))
+        self._size = self._max
+        self._ceiling = self._max
+        self._run = 0
+        self._successes = 0
+        self._failures = 0
+
+    def signal(self, level, best=5):
+        """
+
+        Args:
+            level: signal quality, as reported by AT+CSQ
+            best: highest signal quality the modem reports
+        """
+        self._ceiling = max(self._min, self._max * max(level, 0) // best)
+        if self._size > self._ceiling:
+            logging.info("Reducing chunk size from {} to {} bytes for signal level {}".format(
+                self._size, self._ceiling, level))
+            self._size = self._ceiling
+
+    def success(self):
+        self._successes += 1
+        self._run += 1
+
+        if self._run >= self._grow_after and self._size < self._ceiling:
+            self._size = min(self._size * 2, self._ceiling)
+            self._run = 0
+            logging.debug("Increased chunk size to {} bytes".format(self._size))
+
+    def failure(self):
+        self._failures += 1
+        self._run = 0
+
+        if self._size > self._min:
+            self._size = max(self._size // 2, self._min)
+            logging.info("Reduced chunk size to {} bytes after a failure".format(self._size))
+
+    @property
+    def size(self):
+        return self._size
+
+
+class FileChangedError(IOError):
+    """ The file being sent is no longer as long as when its transfer was planned """
+    pass
+
+
+class FileChunkReader(object):
+    """ Reads chunks of a file by their offsets as a transfer needs them
+
+    Chunks are read with pread rather than sliced from a memory map. A transfer can last hours, and a mapped file
+    truncated in the meantime, as by logrotate's copytruncate, would fault the whole process once the missing
+    pages were touched. A chunk read past the end of the file instead raises FileChangedError, abandoning the
+    transfer, which starts afresh from the file as it now is when it's next retried.
+
+    Slicing the reader reads a chunk too, so it can stand in for the file content where a bytes-like object is
+    expected.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._fh = None
+        self._length = 0
+
+    def __enter__(self):
+        self._fh = open(self._filename, "rb")
+        self._length = os.fstat(self._fh.fileno()).st_size
+        logging.debug("Opened {} bytes of {}".format(self._length, self._filename))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._fh.close()
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step not in (None, 1):
+            raise TypeError("Only contiguous slices of the file can be read")
+        start, end, _ = item.indices(self._length)
+        return self.chunk(start, max(start, end))
+
+    @property
+    def length(self):
+        return self._length
+
+    def chunk(self, start, end):
+        data = os.pread(self._fh.fileno(), end - start, start)
+        if len(data) < end - start:
+            raise FileChangedError("{} is now {} bytes long, too short to read {}-{}".format(
+                self._filename, os.fstat(self._fh.fileno()).st_size, start, end))
+        return data
+
+    def crc32(self, end=None, block_size=65536):
+        """
+
+        Args:
+            end: offset to stop at, defaulting to the whole file
+
+        Returns:
+            CRC32 of the file up to end
+        """
+        end = self._length if end is None else end
+        crc = 0
+        for offset in range(0, end, block_size):
+            crc = zlib.crc32(self.chunk(offset, min(offset + block_size, end)), crc)
+        return crc
+
+
+class TransferJournal(object):
+    """ Append only record of the byte ranges of each file that have made it across the link
+
+    Files are identified by their path, size and modification time, so a file that changes is sent afresh.
+    Completing a chunk appends a single line, which is all a dropped session can lose, and the journal is
+    rewritten with just the live state once enough superseded lines have built up. Progress recorded without a
+    sync is written straight away but only forced to disk along with the next synced line, so frequent progress
+    doesn't cost a flash write each time.
+
+    The length and CRC32 of the last complete send of each path are kept as a baseline, so a file that has only
+    been appended to since can be sent from where the last send finished.
+    """
+    def __init__(self, path, compact_after=256):
+        self._path = path
+        self._compact_after = compact_after
+        self._lock = t.Lock()
+        self._ranges = dict()
+        self._done = set()
+        self._baselines = dict()
+        self._lines = 0
+        self._unsynced = False
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        if os.path.exists(path):
+            with open(path, "r") as fh:
+                for line in fh:
+                    self._lines += 1
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        # Most likely a line cut short by losing power mid write
+                        logging.warning("Ignoring unreadable line {} of transfer journal {}".format(
+                            self._lines, path))
+        self._fh = open(path, "a")
+        logging.info("Opened transfer journal {} with {} partial and {} complete files".format(
+            path, len(self._ranges), len(self._done)))
+
+        if self._should_compact():
+            self.compact()
+
+    @staticmethod
+    def file_key(filename):
+        """
+
+        Args:
+            filename: path of the file to be sent
+
+        Returns:
+            tuple identifying this version of the file
+        """
+        st = os.stat(filename)
+        return os.path.abspath(filename), st.st_size, st.st_mtime_ns
+
+    def completed(self, key):
+        """
+
+        Returns:
+            sorted list of (start, end) byte ranges of the file that have been sent
+        """
+        with self._lock:
+            return list(self._ranges.get(key, []))
+
+    def missing(self, key, length, offset=0):
+        """
+
+        Args:
+            key: from file_key
+            length: of the file
+            offset: ignore anything before this, eg. when only sending what's been appended
+
+        Returns:
+            sorted list of (start, end) byte ranges of the file that still need sending
+        """
+        gaps = []
+        for start, end in self.completed(key):
+            if start > offset:
+                gaps.append((offset, start))
+            offset = max(offset, end)
+        if offset < length:
+            gaps.append((offset, length))
+        return gaps
+
+    def is_done(self, key):
+        with self._lock:
+            return key in self._done
+
+    def baseline(self, filename):
+        """
+
+        Returns:
+            tuple of the length and CRC32 of the file when it was last sent in full, or None
+        """
+        with self._lock:
+            return self._baselines.get(os.path.abspath(filename))
+
+    def record(self, key, start, end, sync=True):
+        """Note that bytes start to end of the file have been sent
+
+        Args:
+            key: from file_key
+            start: offset of the first byte sent
+            end: offset after the last byte sent
+            sync: force the record to disk before returning, rather than with the next one that is
+        """
+        self._append({"file": list(key), "range": [start, end]}, sync)
+
+    def sync(self):
+        """Force anything recorded without a sync to disk"""
+        with self._lock:
+            if self._unsynced:
+                os.fsync(self._fh.fileno())
+                self._unsynced = False
+
+    def finish(self, key, crc=None):
+        """Note that the whole file has been sent
+
+        Args:
+            key: from file_key
+            crc: CRC32 of the whole file, to allow later appends to be sent on their own
+        """
+        self._append({"file": list(key), "done": True})
+        if crc is not None:
+            self._append({"path": key[0], "baseline": [key[1], crc]})
+
+    def compact(self):
+        """Rewrite the journal with only the state of files that are still on disk as they were"""
+        with self._lock:
+            live = set()
+            for key in set(self._ranges.keys()) | self._done:
+                try:
+                    if self.file_key(key[0]) == key:
+                        live.add(key)
+                except OSError:
+                    pass
+
+            self._ranges = dict([(k, v) for k, v in self._ranges.items() if k in live])
+            self._done = set([k for k in self._done if k in live])
+            self._baselines = dict([(k, v) for k, v in self._baselines.items() if os.path.exists(k)])
+
+            records = [{"path": k, "baseline": list(v)} for k, v in self._baselines.items()] + \
+                [{"file": list(k), "done": True} for k in self._done] + \
+                [{"file": list(k), "range": [start, end]} for k, v in self._ranges.items() for start, end in v]
+
+            tmp_path = "{}.tmp".format(self._path)
+            with open(tmp_path, "w") as fh:
+                for record in records:
+                    fh.write("{}\n".format(json.dumps(record)))
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, self._path)
+
+            self._fh.close()
+            self._fh = open(self._path, "a")
+            self._unsynced = False
+            logging.info("Compacted transfer journal from {} to {} lines".format(self._lines, len(records)))
+            self._lines = len(records)
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._fh.close()
+
+    def _append(self, record, sync=True):
+        with self._lock:
+            self._apply(record)
+            self._fh.write("{}\n".format(json.dumps(record)))
+            self._fh.flush()
+            if sync:
+                os.fsync(self._fh.fileno())
+            self._unsynced = not sync
+            self._lines += 1
+            compact = self._should_compact()
+
+        if compact:
+            self.compact()
+
+    def _should_compact(self):
+        return self._lines > self._compact_after and \
+            self._lines > 2 * (len(self._baselines) + len(self._done) + sum(len(v) for v in self._ranges.values()))
+
+    def _apply(self, record):
+        if "baseline" in record:
+            self._baselines[record["path"]] = tuple(record["baseline"])
+            return
+
+        key = tuple(record["file"])
+
+        if record.get("done"):
+            self._done.add(key)
+            self._ranges.pop(key, None)
+            return
+
+        start, end = record["range"]
+        merged = []
+        for r_start, r_end in self._ranges.get(key, []):
+            if r_end < start or r_start > end:
+                merged.append((r_start, r_end))
+            else:
+                start, end = min(start, r_start), max(end, r_end)
+        merged.append((start, end))
+        self._ranges[key] = sorted(merged)
@@ -0,0 +1,185 @@
+import logging
+import threading as t
+import time as tm
+from contextlib import contextmanager
+
+import serial
+
+from pyremotenode.comms.responses import ResponseParser
+
+
+class ResponseRouter(object):
+    """ Routes bytes read from the modem to the response of the outstanding command, if there is one
+
+    Bytes the command's parser doesn't take, whether because there's no command outstanding or because they
+    followed its final result, are tokenized by an idle parser. Either way, any line matching a registered
+    unsolicited result code pattern is taken out of the stream and handed to its handler. This is shared by
+    every transport that owns the serial port.
+    """
+    def __init__(self):
+        self._handlers = []
+        self._parser = None
+        self._idle_parser = ResponseParser(unsolicited=self.dispatch)
+
+    def register(self, pattern, handler):
+        """Register a handler for unsolicited lines
+
+        Args:
+            pattern: compiled regular expression matched against each line
+            handler: callable receiving the line and the match
+        """
+        self._handlers.append((pattern, handler))
+
+    def dispatch(self, line):
+        for pattern, handler in self._handlers:
+            match = pattern.match(line)
+            if match:
+                logging.info("Unsolicited result code received: {}".format(line))
+                try:
+                    handler(line, match)
+                except Exception:
+                    logging.exception("Unsolicited handler failed for {}".format(line))
+                return True
+        return False
+
+    def expect(self, parser):
+        """Route bytes to parser from now on, or to the idle parser alone if None"""
+        self._parser = parser
+
+    def feed(self, data):
+        if self.expecting:
+            data = data[self._parser.feed(data):]
+
+        if len(data):
+            self._idle_parser.feed(data)
+            if self._idle_parser.complete or not self._idle_parser.partial:
+                self._idle_parser = ResponseParser(unsolicited=self.dispatch)
+
+    @property
+    def expecting(self):
+        """True if there's a command waiting on the rest of its response"""
+        return self._parser is not None and not self._parser.complete
+
+
+class UnsolicitedDispatcher(object):
+    """ Background reader that owns the serial port whilst the modem is in use
+
+    Every byte from the modem passes through here, to be routed by a ResponseRouter to the outstanding command or
+    to the handler of an unsolicited result code.
+
+    Handlers are called from the reader thread, so they should be quick and must not issue modem commands
+    themselves - signal another thread to do the work instead.
+    """
+    def __init__(self, data_conn, read_timeout=0.5):
+        self._conn = data_conn
+        self._read_timeout = read_timeout
+
+        self._router = ResponseRouter()
+        self._command_lock = t.Lock()
+        self._cond = t.Condition()
+        self._received = 0
+        self._last_read = None
+
+        self._pause_lock = t.Lock()
+        self._paused = False
+        self._pausing = False
+        self._running = False
+        self._thread = None
+
+    def register(self, pattern, handler):
+        self._router.register(pattern, handler)
+
+    def dispatch(self, line):
+        return self._router.dispatch(line)
+
+    def command(self, parser, data, msg_timeout):
+        """Run a command whose response is read by the dispatcher
+
+        Args:
+            parser: ResponseParser for the command response
+            data: bytes, or list of bytes-like objects, to write to the modem
+            msg_timeout: seconds of silence on the line before we give up
+
+        Returns:
+            number of bytes fed to the parser
+        """
+        with self._command_lock:
+            with self._cond:
+                self._router.expect(parser)
+                self._received = 0
+                self._last_read = tm.monotonic()
+
+            try:
+                for buf in data if isinstance(data, (list, tuple)) else [data]:
+                    self._conn.write(buf)
+
+                with self._cond:
+                    while not parser.complete and self._running:
+                        remaining = self._last_read + msg_timeout - tm.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    return self._received
+            finally:
+                with self._cond:
+                    self._router.expect(None)
+
+    @contextmanager
+    def paused(self):
+        """Hand the serial port back to the caller, eg. for the duration of a data call"""
+        self._pausing = True
+        self._pause_lock.acquire()
+        self._paused = True
+        self._pausing = False
+        try:
+            yield
+        finally:
+            self._conn.timeout = self._read_timeout
+            self._paused = False
+            self._pause_lock.release()
+
+    def start(self):
+        if not self._thread:
+            logging.info("Starting unsolicited result code dispatcher")
+            self._conn.timeout = self._read_timeout
+            self._running = True
+            self._thread = t.Thread(name=self.__class__.__name__, target=self.run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            logging.info("Stopping unsolicited result code dispatcher")
+            self._running = False
+            if self._thread is not t.current_thread():
+                self._thread.join()
+            self._thread = None
+
+    def run(self):
+        while self._running:
+            if self._pausing:
+                tm.sleep(0.01)
+                continue
+
+            with self._pause_lock:
+                try:
+                    data = self._conn.read(max(1, self._conn.in_waiting))
+                except (serial.SerialException, OSError, TypeError):
+                    logging.exception("Unsolicited dispatcher could not read from the modem, stopping")
+                    self._running = False
+                    data = None
+
+            with self._cond:
+                if data:
+                    self._feed(data)
+                self._cond.notify_all()
+
+    def _feed(self, data):
+        if self._router.expecting:
+            self._received += len(data)
+            self._last_read = tm.monotonic()
+        self._router.feed(data)
+
+    @property
+    def active(self):
+        return self._running and not self._pausing and not self._paused
@@ -3,16 +3,18 @@ import shlex
 import subprocess
 import threading as t
 import time as tm
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from pyremotenode.comms.base import ModemConnectionException
 from pyremotenode.utils import Configuration
 
 
-class ModemLock(object):
-    def __init__(self):
-        self._lock = t.RLock()
+class ModemPower(object):
+    """ Powers the modem on and off, and knows when it mustn't be used
 
+    Exclusive use of the modem is arbitrated by the ModemSession built on top of this.
+    """
+    def __init__(self):
         cfg = Configuration().config
         self.grace_period = int(cfg['ModemConnection']['grace_period']) \
             if 'grace_period' in cfg['ModemConnection'] else 3
@@ -29,29 +31,20 @@ class ModemLock(object):
         self.offline_end = cfg['ModemConnection']['offline_end'] \
             if 'offline_end' in cfg['ModemConnection'] else None
 
-    def acquire(self, **kwargs):
-        if self._in_offline_time():
-            logging.warning("Barring use of the modem during pre-determined window")
-            return False
-
-        res = self._lock.acquire(**kwargs)
-
-        if res:
-            rc = 0
-            if self._modem_power_on is not None:
-                logging.info("Switching on modem {}".format(self._modem_power_on))
-                rc = subprocess.call(shlex.split(self._modem_power_on))
-                logging.debug("Modem on rc: {}".format(rc))
+    def power_on(self):
+        rc = 0
+        if self._modem_power_on is not None:
+            logging.info("Switching on modem {}".format(self._modem_power_on))
+            rc = subprocess.call(shlex.split(self._modem_power_on))
+            logging.debug("Modem on rc: {}".format(rc))
 
-            if rc != 0:
-                logging.warning("Non-zero acquisition command return value, releasing the lock!")
-                self._lock.release()
-                return False
-            logging.debug("Sleeping for grace period of {} seconds to allow modem boot".format(self.grace_period))
-            tm.sleep(self.grace_period)
-        return res
+        if rc != 0:
+            return False
+        logging.debug("Sleeping for grace period of {} seconds to allow modem boot".format(self.grace_period))
+        tm.sleep(self.grace_period)
+        return True
 
-    def release(self):
+    def power_off(self):
         if self._modem_power_off is not None:
             logging.info("Switching off modem {}".format(self._modem_power_off))
             rc = subprocess.call(shlex.split(self._modem_power_off))
@@ -60,13 +53,11 @@ class ModemLock(object):
             # This doesn't need to be configurable, the DIO will be instantly switched off so we'll just give it a
             # second or two to avoid super-quick turnaround
             tm.sleep(2)
-        return self._lock.release()
 
-    def _in_offline_time(self):
+    def in_offline_time(self):
         dt = datetime.utcnow()
         if self.offline_start and self.offline_end:
-            start = datetime.combine(dt.date(), datetime.strptime(self.offline_start, "%H%M").time())
-            end = datetime.combine(dt.date(), datetime.strptime(self.offline_end, "%H%M").time())
+            start, end = self._offline_window(dt)
             res = start <= dt <= end
             logging.debug("Checking if {} is between {} and {}: {}".format(
                 dt.strftime("%H:%M"), start.strftime("%H:%M"), end.strftime("%H:%M"), res))
@@ -74,8 +65,161 @@ class ModemLock(object):
             return False
         return res
 
+    def offline_in(self):
+        """Time until the modem must next be offline
+
+        Returns:
+            seconds until the offline window starts, 0 if it's already started or None if there isn't one
+        """
+        if not (self.offline_start and self.offline_end):
+            return None
+
+        dt = datetime.utcnow()
+        start, end = self._offline_window(dt)
+        if start <= dt <= end:
+            return 0.
+        elif dt > end:
+            start += timedelta(days=1)
+        return (start - dt).total_seconds()
+
+    def _offline_window(self, dt):
+        return datetime.combine(dt.date(), datetime.strptime(self.offline_start, "%H%M").time()), \
+            datetime.combine(dt.date(), datetime.strptime(self.offline_end, "%H%M").time())
+
+
+class ModemSession(object):
+    """ Keeps the modem powered and registered across back to back pieces of work
+
+    Work from the connection run loop and tasks acquires the session, which is the only holder of the modem. The first
+    acquisition powers the modem on and initialises it, later ones within session_idle_timeout seconds of the
+    last release reuse the powered modem, only re-registering once registration_valid seconds have passed since
+    the last successful registration. Once the session has been idle for the timeout the modem is closed and
+    powered off, or at the start of the offline window if that comes sooner. An idle timeout of 0 powers off on
+    every release.
+    """
+    def __init__(self, connection, modem_power):
+        self._connection = connection
+        self._modem_power = modem_power
+
+        cfg = Configuration().config
+        self.idle_timeout = float(cfg['ModemConnection']['session_idle_timeout']) \
+            if 'session_idle_timeout' in cfg['ModemConnection'] else 0.
+        self.registration_valid = float(cfg['ModemConnection']['registration_valid']) \
+            if 'registration_valid' in cfg['ModemConnection'] else 120.
+
+        self._lock = t.RLock()
+        self._depth = 0
+        self._powered = False
+        self._registered_at = None
+        self._last_release = None
+        self._timer = None
+
+    def acquire(self, blocking=True):
+        """Start or join the modem session
+
+        Args:
+            blocking: wait for other work to finish with the modem
+
+        Returns:
+            True if the modem is powered, initialised and ours to use
+        """
+        if self._modem_power.in_offline_time():
+            logging.warning("Barring use of the modem during pre-determined window")
+            return False
+
+        if not self._lock.acquire(blocking=blocking):
+            return False
+
+        try:
+            self._depth += 1
+            self._cancel_timer()
+
+            if not self._powered:
+                if not self._modem_power.power_on():
+                    logging.warning("Non-zero acquisition command return value, releasing the session!")
+                    self.release(end=True)
+                    return False
+                self._powered = True
+                self._registered_at = None
+
+            if not self.registered:
+                self._connection.initialise_modem()
+                self._registered_at = tm.monotonic()
+            else:
+                logging.debug("Reusing modem session registered {:.0f} seconds ago".format(
+                    tm.monotonic() - self._registered_at))
+        except Exception:
+            self.release(end=True)
+            raise
+        return True
+
+    def release(self, end=False):
+        """Leave the modem session
+
+        Args:
+            end: close and power off now, rather than when the session goes idle, eg. after a failure
+        """
+        try:
+            self._depth -= 1
+            if self._depth > 0:
+                return
+
+            self._last_release = tm.monotonic()
+            idle_timeout = self.idle_timeout
+            offline_in = self._modem_power.offline_in()
+            if offline_in is not None and offline_in < idle_timeout:
+                logging.debug("Modem session will end at the offline window in {:.0f} seconds".format(offline_in))
+                idle_timeout = offline_in
+
+            if end or idle_timeout <= 0:
+                self._end()
+            else:
+                logging.debug("Modem session will end after {:.0f} idle seconds".format(idle_timeout))
+                self._timer = t.Timer(idle_timeout, self._expire)
+                self._timer.setDaemon(True)
+                self._timer.start()
+        finally:
+            self._lock.release()
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _end(self):
+        self._cancel_timer()
+        if self._powered:
+            logging.info("Ending modem session")
+            try:
+                self._connection.close()
+            finally:
+                self._modem_power.power_off()
+                self._powered = False
+                self._registered_at = None
+
+    def _expire(self):
+        # Work may have started again since the timer was set, in which case it'll set its own timer
+        if self._lock.acquire(blocking=False):
+            try:
+                if self._depth == 0 and (tm.monotonic() - self._last_release >= self.idle_timeout
+                                         or self._modem_power.in_offline_time()):
+                    self._end()
+            finally:
+                self._lock.release()
+
+    @property
+    def powered(self):
+        return self._powered
+
+    @property
+    def registered(self):
+        return self._registered_at is not None \
+            and tm.monotonic() - self._registered_at < self.registration_valid
+
     def __enter__(self):
-        self.acquire()
+        if not self.acquire():
+            raise ModemConnectionException("Could not start a modem session")
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.release()
+        self.release(end=exc_type is not None)
@@ -0,0 +1,237 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+
+from pyremotenode.receiver.certus import DeliveryProcessor
+from pyremotenode.receiver.http import HTTPError, HTTPRequestParser, http_response
+
+# Where available the event loop receives straight into our buffer, otherwise data_received copies into it
+_Protocol = getattr(asyncio, "BufferedProtocol", asyncio.Protocol)
+
+
+class AsyncDataReceiver(object):
+    """ asyncio equivalent of JSONDataReceiver, for when a lot of units connect at once
+
+    A single event loop serves every connection rather than a thread per connection. Each connection receives into
+    its own preallocated buffer, at most max_connections are served at a time with the rest left waiting until one
+    finishes, and connections that go quiet for timeout seconds are dropped. Requests are decoded and written out
+    by a small pool of threads so the loop never waits on the disk, and each response is only sent once its
+    request has been written.
+
+    Given a worker number, the listening socket is bound with SO_REUSEPORT so that several processes can serve
+    the same port.
+    """
+    def __init__(self, server_address, output_dir,
+                 crc16=True,
+                 store=None,
+                 max_connections=128,
+                 timeout=60.,
+                 buffer_size=65536,
+                 max_request=16 * 1024 * 1024,
+                 writers=4,
+                 worker=None):
+        self.server_address = server_address
+        self._processor = DeliveryProcessor(output_dir, crc16, store, worker)
+        self._worker = worker
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._buffer_size = buffer_size
+        self._max_request = max_request
+        self._writers = writers
+
+        self._active = set()
+        self._waiting = collections.deque()
+        self._executor = None
+        self._loop = None
+        self._server = None
+
+    async def start(self):
+        self._loop = asyncio.get_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._writers)
+        # Connections beyond max_connections are still accepted, to wait their turn rather than be refused, so
+        # the backlog only needs to cover a burst of them arriving at once
+        self._server = await self._loop.create_server(lambda: DataReceiverProtocol(self),
+                                                      self.server_address[0],
+                                                      self.server_address[1],
+                                                      reuse_address=True,
+                                                      reuse_port=self._worker is not None,
+                                                      backlog=1024)
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+        logging.info("Listening on {} for up to {} connections at a time".format(
+            self.server_address, self._max_connections))
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._executor.shutdown(wait=True)
+
+    def serve_forever(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.start())
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            logging.info("Interrupted, shutting down")
+        finally:
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+    def admit(self, protocol):
+        if len(self._active) < self._max_connections:
+            self._active.add(protocol)
+            protocol.start()
+        else:
+            logging.debug("{} connections active, holding {}".format(len(self._active), protocol.peer))
+            self._waiting.append(protocol)
+
+    def release(self, protocol):
+        if protocol in self._active:
+            self._active.remove(protocol)
+        elif protocol in self._waiting:
+            self._waiting.remove(protocol)
+
+        while len(self._waiting) and len(self._active) < self._max_connections:
+            waiting = self._waiting.popleft()
+            self._active.add(waiting)
+            waiting.start()
+
+    @property
+    def buffer_size(self):
+        return self._buffer_size
+
+    @property
+    def executor(self):
+        return self._executor
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def max_request(self):
+        return self._max_request
+
+    @property
+    def output_dir(self):
+        return self._processor.output_dir
+
+    @property
+    def processor(self):
+        return self._processor
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+
+class DataReceiverProtocol(_Protocol):
+    def __init__(self, server):
+        self._server = server
+        self._buffer = bytearray(server.buffer_size)
+        self._parser = HTTPRequestParser(max_body=server.max_request)
+        self._requests = collections.deque()
+        self._processing = False
+        self._closing = False
+        self._transport = None
+        self._timer = None
+        self.peer = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self.peer = transport.get_extra_info("peername")
+        # Nothing is read until there's a slot for the connection
+        transport.pause_reading()
+        self._server.admit(self)
+
+    def start(self):
+        logging.debug("Receiving from {}".format(self.peer))
+        self._transport.resume_reading()
+        self._reset_timer()
+
+    def get_buffer(self, sizehint):
+        return memoryview(self._buffer)
+
+    def buffer_updated(self, nbytes):
+        self.data_received(memoryview(self._buffer)[:nbytes])
+
+    def data_received(self, data):
+        if self._closing:
+            return
+        self._reset_timer()
+
+        try:
+            self._requests.extend(self._parser.feed(data))
+        except HTTPError as e:
+            logging.warning("Bad request from {}: {}".format(self.peer, e))
+            self._requests.append(e)
+        self._next_request()
+
+    def eof_received(self):
+        if not self._parser.idle:
+            logging.warning("Connection from {} closed part way through a request".format(self.peer))
+        self._closing = True
+        if not self._processing:
+            self._transport.close()
+        # Otherwise the connection is kept open to respond to what's already been received
+        return True
+
+    def connection_lost(self, exc):
+        self._cancel_timer()
+        self._server.release(self)
+
+    def _next_request(self):
+        if self._processing or not len(self._requests):
+            return
+
+        request = self._requests.popleft()
+        if isinstance(request, HTTPError):
+            self._respond(http_response(request.status, request.reason, False), False)
+            return
+
+        # Requests on a connection are processed one at a time, so their responses go back in order
+        self._processing = True
+        self._cancel_timer()
+        future = self._server.loop.run_in_executor(self._server.executor, self._server.processor.process, request)
+        future.add_done_callback(lambda f: self._processed(f, request))
+
+    def _processed(self, future, request):
+        self._processing = False
+
+        if future.exception():
+            logging.error("Could not process request from {}: {}".format(self.peer, future.exception()))
+            self._respond(http_response(500, "Internal Server Error", False), False)
+            return
+
+        status, reason, body = future.result()
+        self._respond(http_response(status, reason, request.keep_alive, body), request.keep_alive)
+
+    def _respond(self, response, keep_alive):
+        if self._transport.is_closing():
+            return
+
+        self._transport.write(response)
+        if not keep_alive or (self._closing and not len(self._requests)):
+            self._closing = True
+            self._requests.clear()
+            self._transport.close()
+            return
+
+        self._reset_timer()
+        self._next_request()
+
+    def _reset_timer(self):
+        self._cancel_timer()
+        self._timer = self._server.loop.call_later(self._server.timeout, self._timed_out)
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _timed_out(self):
+        logging.warning("Nothing from {} for {} seconds, dropping the connection".format(
+            self.peer, self._server.timeout))
+        self._transport.abort()
@@ -1,27 +1,197 @@
+import base64
+import binascii
+import json
 import logging
 import os
+import socket
 import socketserver
+import struct
+import threading as t
 import time
 
-from http.client import HTTPResponse
+from pyremotenode.receiver.http import HTTPError, HTTPRequestParser, http_response
+from pyremotenode.receiver.transfers import FileReassembler, parse_chunk
 
+# Fields of a delivered message that may hold its base64 encoded payload, in order of preference
+PAYLOAD_FIELDS = ("data", "payload", "message")
 
-class JSONDataReceiver(socketserver.ThreadingTCPServer):
-    def __init__(self, server_address, handler, output_dir):
-        socketserver.TCPServer.__init__(self,
-                                        server_address,
-                                        handler,
-                                        True)
+
+def decode_delivery(body):
+    """Pull the payloads out of the JSON body of a delivery
+
+    The body can be a single message object or a list of them, each with its payload base64 encoded in one of
+    PAYLOAD_FIELDS. The other simple values of each message are kept alongside its payload.
+
+    Args:
+        body: bytes of the request body
+
+    Returns:
+        list of tuples of the message metadata and the payload bytes
+    """
+    try:
+        document = json.loads(body.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Delivery is not valid JSON: {}".format(e))
+
+    messages = document if isinstance(document, list) else [document]
+    decoded = []
+    for message in messages:
+        if not isinstance(message, dict):
+            raise ValueError("Delivered message is not an object")
+
+        fields = [f for f in PAYLOAD_FIELDS if isinstance(message.get(f), str)]
+        if not len(fields):
+            raise ValueError("Delivered message has none of the payload fields {}".format(", ".join(PAYLOAD_FIELDS)))
+
+        try:
+            payload = base64.b64decode(message[fields[0]], validate=True)
+        except (binascii.Error, ValueError) as e:
+            raise ValueError("Could not decode base64 payload: {}".format(e))
+
+        metadata = dict([(k, v) for k, v in message.items()
+                         if k != fields[0] and isinstance(v, (str, int, float, bool))])
+        decoded.append((metadata, payload))
+    return decoded
+
+
+def verify_crc16(payload):
+    """Check and remove the CRC16 that CertusConnection appends to each message
+
+    Returns:
+        bytes of the payload without its CRC
+    """
+    if len(payload) < 2:
+        raise ValueError("Payload of {} bytes is too short to carry a CRC".format(len(payload)))
+
+    expected = struct.unpack(">H", payload[-2:])[0]
+    calculated = binascii.crc_hqx(payload[:-2], 0)
+    if expected != calculated:
+        raise ValueError("Payload CRC {:#06x} does not match calculated CRC {:#06x}".format(expected, calculated))
+    return payload[:-2]
+
+
+class DeliveryProcessor(object):
+    """ Decodes Certus deliveries and writes out the payloads they carry
+
+    Each payload is written to its own file, named after the time the request arrived and its position in the
+    request, except for chunks of file transfers which are reassembled into their files under files/. Anything
+    that can't be decoded is kept in full under invalid/ rather than lost. Safe to call from several threads at
+    once.
+
+    Every payload is expected to end with the CRC16 that CertusConnection writes with each message, which is
+    checked and removed before anything else is done with it, unless crc16 is False.
+
+    Given a SegmentStore, payloads are appended to it instead of each being written to a file.
+
+    A GET of /transfers gives the byte ranges of each partly received file that are still missing.
+
+    When several processes write to the same output directory each is given its own worker number, which goes
+    into the names of the files it writes, and file transfers are reassembled between them.
+    """
+    def __init__(self, output_dir, crc16=True, store=None, worker=None):
         self._dir = output_dir
+        self._crc16 = crc16
+        self._store = store
+        self._suffix = ".w{}".format(worker) if worker is not None else ""
+        self._lock = t.Lock()
+        self._last_time = 0.
 
         if not os.path.exists(self._dir):
             logging.warning("{} doesn't exist, creating".format(self._dir))
             os.makedirs(self._dir)
+        self._files = FileReassembler(os.path.join(self._dir, "files"), shared=worker is not None)
+
+    def process(self, request):
+        """
+
+        Args:
+            request: HTTPRequest to process
+
+        Returns:
+            tuple of the status, reason and body to respond with
+        """
+        request_time = self._request_time()
+
+        if request.method == "GET" and request.target.split("?")[0].rstrip("/") == "/transfers":
+            missing = dict([(name, {"length": length, "missing": gaps})
+                            for name, (length, gaps) in self._files.missing().items()])
+            return 200, "OK", json.dumps(missing).encode("utf-8")
+        elif request.method != "POST":
+            return 405, "Method Not Allowed", b""
+
+        try:
+            deliveries = decode_delivery(request.body)
+            payloads = [(metadata, verify_crc16(payload) if self._crc16 else payload)
+                        for metadata, payload in deliveries]
+        except ValueError as e:
+            logging.warning("Could not decode delivery to {}: {}".format(request.target, e))
+            self._write(os.path.join(self._dir, "invalid", "{:020.6f}{}.raw".format(request_time, self._suffix)),
+                        request.body)
+            # Accepted all the same, as sending it again won't make it any more decodable
+            return 202, "Accepted", b""
+
+        for i, (metadata, payload) in enumerate(payloads):
+            chunk = parse_chunk(payload)
+            if chunk is not None:
+                self._files.add(chunk)
+                continue
+
+            if self._store is not None:
+                unit = metadata.get("imei") or request.target.split("?")[0].rstrip("/").split("/")[-1]
+                output_file, offset = self._store.append(request_time, unit or "unknown", payload, metadata)
+                logging.info("Stored {} byte payload at {} of {}".format(len(payload), offset, output_file))
+                continue
+
+            output_file = os.path.join(self._dir, "{:020.6f}{}.{:03d}.msg".format(request_time, self._suffix, i))
+            self._write(output_file, payload)
+            logging.info("Written {} byte payload to {} ({})".format(
+                len(payload), output_file, ", ".join("{}={}".format(k, v) for k, v in sorted(metadata.items()))))
+        return 200, "OK", b""
+
+    def _request_time(self):
+        # Names are taken from the time, so make sure no two requests get the same one
+        with self._lock:
+            self._last_time = max(time.time(), self._last_time + 0.000001)
+            return self._last_time
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fh:
+            fh.write(data)
 
     @property
     def output_dir(self):
         return self._dir
 
+
+class JSONDataReceiver(socketserver.ThreadingTCPServer):
+    def __init__(self, server_address, handler, output_dir, crc16=True, timeout=60., store=None, worker=None):
+        # Workers each bind their own socket to the same port, the kernel sharing connections out between them
+        self._reuse_port = worker is not None
+        socketserver.TCPServer.__init__(self,
+                                        server_address,
+                                        handler,
+                                        True)
+        self._processor = DeliveryProcessor(output_dir, crc16, store, worker)
+        self._timeout = timeout
+
+    def server_bind(self):
+        if self._reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    @property
+    def output_dir(self):
+        return self._processor.output_dir
+
+    @property
+    def processor(self):
+        return self._processor
+
+    @property
+    def timeout(self):
+        return self._timeout
+
     def verify_request(self, request, client_address):
         # TODO: this is where we're going to access control the request
         # TODO: IP filter (though this should be doubled up via network layer)
@@ -31,30 +201,41 @@ class JSONDataReceiver(socketserver.ThreadingTCPServer):
 
 class DataReceiverHandler(socketserver.BaseRequestHandler):
     def setup(self):
-        pass
+        self._parser = HTTPRequestParser()
+        self._buffer = bytearray(65536)
+        self.request.settimeout(self.server.timeout)
 
     def handle(self):
-        payload = bytearray()
-        request_time = time.time()
         logging.debug("Received: {} from {}".format(self.request, self.client_address))
+        view = memoryview(self._buffer)
 
         try:
-            data = self.request.recv(1024)
-            while data is not None and len(data) > 0:
-                payload += data
-                data = self.request.recv(1024)
+            while True:
+                received = self.request.recv_into(self._buffer)
+                if not received:
+                    if not self._parser.idle:
+                        logging.warning("Connection from {} closed part way through a request".format(
+                            self.client_address))
+                    break
+
+                keep_alive = True
+                for request in self._parser.feed(view[:received]):
+                    status, reason, body = self.server.processor.process(request)
+                    keep_alive = request.keep_alive
+                    self.request.sendall(http_response(status, reason, keep_alive, body))
+                    logging.debug("Sent HTTP {} response".format(status))
+                    if not keep_alive:
+                        break
+
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            logging.warning("Bad request from {}: {}".format(self.client_address, e))
+            self.request.sendall(http_response(e.status, e.reason, False))
         except OSError as e:
             logging.warning("Issue collecting further data: errno {}".format(e.errno))
-
-        self.request.sendall("HTTP/1.1 200".encode("utf-8"))
-        logging.debug("Sent HTTP 200 response")
-
-        # TODO: this is grim at present, handle requests between threads portably
-        #  based on parsing the messages for real
-        output_file = os.path.join(self.server.output_dir, "{:020.6f}".format(request_time))
-        with open(output_file, "wb") as fh:
-            fh.write(payload)
-        logging.debug("Written {}".format(output_file))
+        finally:
+            view.release()
 
 
 class DataReceiverConfigurationError(Exception):
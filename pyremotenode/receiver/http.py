@@ -0,0 +1,200 @@
+import logging
+import re
+
+STATE_HEADERS = 0
+STATE_BODY = 1
+STATE_CHUNK_SIZE = 2
+STATE_CHUNK = 3
+STATE_CHUNK_END = 4
+STATE_TRAILERS = 5
+
+
+class HTTPRequest(object):
+    """ A single complete request, as parsed by HTTPRequestParser """
+    def __init__(self, method, target, version, headers, body):
+        self._method = method
+        self._target = target
+        self._version = version
+        self._headers = headers
+        self._body = body
+
+    def header(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    @property
+    def body(self):
+        return self._body
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def keep_alive(self):
+        connection = self.header("connection", "").lower()
+        if self._version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    @property
+    def method(self):
+        return self._method
+
+    @property
+    def target(self):
+        return self._target
+
+    @property
+    def version(self):
+        return self._version
+
+    def __str__(self):
+        return "{} {} {} ({} bytes)".format(self._method, self._target, self._version, len(self._body))
+
+
+class HTTPRequestParser(object):
+    """ Incremental parser for HTTP/1.1 requests arriving on a connection
+
+    Bytes are handed to feed() as they're received and only the newly arrived bytes are examined. Bodies are
+    delimited by Content-Length or chunked transfer encoding, so any number of requests can follow one another on
+    a kept alive connection.
+    """
+    re_request_line = re.compile(r'^([A-Z]+) (\S+) (HTTP/1\.[01])$')
+    re_chunk_size = re.compile(rb'^([0-9a-fA-F]+)(?:;.*)?$')
+
+    def __init__(self, max_header=65536, max_body=16 * 1024 * 1024):
+        self._max_header = max_header
+        self._max_body = max_body
+        self._buffer = bytearray()
+        self._state = STATE_HEADERS
+        self._request = None
+        self._body = None
+        self._remaining = 0
+
+    def feed(self, data):
+        """Consume newly received bytes
+
+        Args:
+            data: bytes-like object just read from the connection
+
+        Returns:
+            list of HTTPRequest completed by these bytes
+        """
+        self._buffer += data
+        requests = []
+
+        while True:
+            if self._state == STATE_HEADERS:
+                end = self._buffer.find(b"\r\n\r\n")
+                if end < 0:
+                    if len(self._buffer) > self._max_header:
+                        raise HTTPError(431, "Request header fields too large")
+                    break
+                self._start_request(bytes(self._buffer[:end]).decode("latin-1"))
+                del self._buffer[:end + 4]
+            elif self._state == STATE_BODY:
+                if not self._take():
+                    break
+                if not self._remaining:
+                    requests.append(self._finish())
+            elif self._state == STATE_CHUNK_SIZE or self._state == STATE_TRAILERS:
+                end = self._buffer.find(b"\r\n")
+                if end < 0:
+                    if len(self._buffer) > self._max_header:
+                        raise HTTPError(400, "Chunk size line too long")
+                    break
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end + 2]
+
+                if self._state == STATE_TRAILERS:
+                    if not line:
+                        requests.append(self._finish())
+                    continue
+
+                match = self.re_chunk_size.match(line.strip())
+                if not match:
+                    raise HTTPError(400, "Invalid chunk size")
+                self._remaining = int(match.group(1), 16)
+                if len(self._body) + self._remaining > self._max_body:
+                    raise HTTPError(413, "Request body too large")
+                self._state = STATE_CHUNK if self._remaining else STATE_TRAILERS
+            elif self._state == STATE_CHUNK:
+                if not self._take():
+                    break
+                if not self._remaining:
+                    self._state = STATE_CHUNK_END
+            elif self._state == STATE_CHUNK_END:
+                if len(self._buffer) < 2:
+                    break
+                if self._buffer[:2] != b"\r\n":
+                    raise HTTPError(400, "Chunk not followed by CRLF")
+                del self._buffer[:2]
+                self._state = STATE_CHUNK_SIZE
+        return requests
+
+    @property
+    def idle(self):
+        """True if there's no partly received request"""
+        return self._state == STATE_HEADERS and not len(self._buffer)
+
+    def _start_request(self, head):
+        lines = head.split("\r\n")
+        match = self.re_request_line.match(lines[0])
+        if not match:
+            raise HTTPError(400, "Invalid request line")
+
+        headers = dict()
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if not sep or not name.strip():
+                raise HTTPError(400, "Invalid header line")
+            headers[name.strip().lower()] = value.strip()
+
+        self._request = (match.group(1), match.group(2), match.group(3), headers)
+        self._body = bytearray()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            self._state = STATE_CHUNK_SIZE
+            return
+
+        try:
+            self._remaining = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if self._remaining < 0:
+            raise HTTPError(400, "Invalid Content-Length")
+        if self._remaining > self._max_body:
+            raise HTTPError(413, "Request body too large")
+        self._state = STATE_BODY
+
+    def _take(self):
+        take = min(self._remaining, len(self._buffer))
+        if not take and self._remaining:
+            return False
+        self._body += self._buffer[:take]
+        del self._buffer[:take]
+        self._remaining -= take
+        return True
+
+    def _finish(self):
+        request = HTTPRequest(*(self._request + (bytes(self._body), )))
+        logging.debug("Parsed request {}".format(request))
+        self._request = None
+        self._body = None
+        self._state = STATE_HEADERS
+        return request
+
+
+class HTTPError(Exception):
+    """ A request that can't be parsed, carrying the status to respond with """
+    def __init__(self, status, reason):
+        super().__init__("{} {}".format(status, reason))
+        self.status = status
+        self.reason = reason
+
+
+def http_response(status, reason, keep_alive=True, body=b"", content_type="application/json"):
+    headers = "HTTP/1.1 {} {}\r\nContent-Length: {}\r\n{}Connection: {}\r\n\r\n".format(
+        status, reason, len(body), "Content-Type: {}\r\n".format(content_type) if len(body) else "",
+        "keep-alive" if keep_alive else "close")
+    return headers.encode("latin-1") + body
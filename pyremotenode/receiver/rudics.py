@@ -0,0 +1,184 @@
+import logging
+import os
+import re
+import select
+import socketserver
+import struct
+
+import xmodem
+
+from pyremotenode.comms.rudics import FRAME_DONE, FRAME_END, FRAME_MAGIC, DONE_OK, FrameDecoder, \
+    WindowedReceiver, WindowedTransferError, encode_frame
+
+
+class RudicsReceiver(socketserver.ThreadingTCPServer):
+    """ Ground end of RUDICS data calls, as connected through by the Iridium gateway
+
+    Speaks the FILENAME preamble sent by RudicsConnection, then receives each file with whichever of the windowed
+    protocol or XMODEM the node uses, writing them into the output directory.
+    """
+    def __init__(self, server_address, handler, output_dir, timeout=60.):
+        socketserver.TCPServer.__init__(self,
+                                        server_address,
+                                        handler,
+                                        True)
+        self._dir = output_dir
+        self._timeout = timeout
+
+        if not os.path.exists(self._dir):
+            logging.warning("{} doesn't exist, creating".format(self._dir))
+            os.makedirs(self._dir)
+
+    @property
+    def output_dir(self):
+        return self._dir
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+
+class RudicsReceiverHandler(socketserver.BaseRequestHandler):
+    re_command = re.compile(rb'^(?:@|[A-Z]+)$')
+    re_line_end = re.compile(rb'[\r\n]')
+
+    # Long enough for the sender to start the windowed protocol, after which we assume it's waiting on XMODEM
+    protocol_wait = 10.
+
+    def setup(self):
+        self._buffer = bytearray()
+        self._frames = FrameDecoder()
+        self._last_done = None
+
+    def handle(self):
+        logging.info("Data call from {}".format(self.client_address))
+
+        try:
+            while True:
+                command = self._read_command()
+                if command is None:
+                    break
+                elif command == b"@":
+                    self._reply("A")
+                elif command == b"FILENAME":
+                    self._reply("GOFORIT")
+                    self._receive_file(*self._read_filename())
+                elif command == b"ENDBATCH":
+                    self._reply("BATCHRECV")
+                    logging.info("End of batch from {}".format(self.client_address))
+        except (OSError, WindowedTransferError) as e:
+            logging.warning("Data call from {} ended: {}".format(self.client_address, e))
+        logging.info("Call from {} finished".format(self.client_address))
+
+    def _read_command(self):
+        data = bytes(self._buffer)
+
+        while True:
+            # A lost DONE has the sender repeat its END, which we can answer from here
+            for frame_type, seq, _ in self._frames.feed(data):
+                if frame_type == FRAME_END and self._last_done is not None and seq == self._last_done[0]:
+                    self.request.sendall(encode_frame(FRAME_DONE, seq, bytes([self._last_done[1]])))
+
+            match = self.re_line_end.search(self._buffer)
+            while match:
+                line = bytes(self._buffer[:match.start()]).strip()
+                del self._buffer[:match.end()]
+                if self.re_command.match(line):
+                    return line
+                match = self.re_line_end.search(self._buffer)
+
+            try:
+                data = self._recv(self.server.timeout)
+            except OSError:
+                # Hanging up between files is how a call normally ends
+                return None
+
+            if not data:
+                return None
+            self._buffer += data
+
+    def _read_filename(self):
+        header = self._read_exactly(2)
+        marker, length = struct.unpack("BB", header)
+        if marker != 0x1a:
+            raise WindowedTransferError("Invalid filename preamble")
+
+        body = self._read_exactly(length + struct.calcsize("iiiiB"))
+        name = body[:length].decode("latin-1")
+        file_length, _, _, _, end = struct.unpack("iiiiB", body[length:])
+        if end != 0x1b:
+            raise WindowedTransferError("Invalid filename preamble ending")
+
+        self._reply("NAMERECV")
+        return os.path.basename(name), file_length
+
+    def _receive_file(self, name, file_length):
+        path = os.path.join(self.server.output_dir, name)
+        part_path = "{}.part".format(path)
+        logging.info("Receiving {} of {} bytes from {}".format(name, file_length, self.client_address))
+
+        # Partial files are kept, with their progress alongside, for the node to resume into after a dropped call
+        with open(part_path, "r+b" if os.path.exists(part_path) else "w+b") as fh:
+            if self._wait_for(self.protocol_wait) and FRAME_MAGIC in self._buffer[:8]:
+                data = bytes(self._buffer)
+                del self._buffer[:]
+                receiver = WindowedReceiver(self._recv, self.request.sendall, self.server.timeout,
+                                            state_path="{}.state".format(part_path))
+                try:
+                    received = receiver.receive(fh, data)
+                except WindowedTransferError:
+                    self._last_done = None
+                    raise
+                self._last_done = (receiver.total, DONE_OK)
+            else:
+                fh.truncate(0)
+                received = self._receive_xmodem(fh)
+                fh.truncate(file_length)
+
+        os.replace(part_path, path)
+        logging.info("Received {} bytes into {}".format(received, path))
+
+    def _receive_xmodem(self, fh):
+        def _getc(size, timeout=1):
+            if not self._wait_for(timeout, size):
+                return None
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+        def _putc(data, timeout=1):
+            self.request.sendall(data)
+            return len(data)
+
+        received = xmodem.XMODEM(_getc, _putc).recv(fh, crc_mode=1)
+        if received is None:
+            raise WindowedTransferError("XMODEM transfer failed")
+        return received
+
+    def _read_exactly(self, size):
+        if not self._wait_for(self.server.timeout, size):
+            raise WindowedTransferError("Timed out reading {} bytes".format(size))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _wait_for(self, timeout, size=1):
+        while len(self._buffer) < size:
+            data = self._recv(timeout)
+            if not data:
+                return False
+            self._buffer += data
+        return True
+
+    def _recv(self, timeout):
+        readable, _, _ = select.select([self.request], [], [], timeout)
+        if not readable:
+            return b""
+
+        data = self.request.recv(4096)
+        if not data:
+            raise OSError("Connection closed")
+        return data
+
+    def _reply(self, result):
+        self.request.sendall("\r\n{}\r\n".format(result).encode("latin-1"))
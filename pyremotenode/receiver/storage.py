@@ -0,0 +1,449 @@
+import binascii
+import json
+import logging
+import os
+import re
+import struct
+import threading as t
+import time
+from datetime import datetime
+
+# Each record is the header, its JSON metadata and then the payload, the CRC covering both of the latter
+RECORD_MAGIC = 0x52
+RECORD_HEADER = struct.Struct("!BIIHd")
+# Index entries give the offset and total length of each record along with its time, for scanning without reading
+INDEX_ENTRY = struct.Struct("!QId")
+
+re_segment = re.compile(r'^segment-(\d{6})(?:-w(\d+))?\.log$')
+re_unit = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def partition_path(root, record_time, unit):
+    """
+
+    Args:
+        root: top of the store
+        record_time: seconds since the epoch the record was received at
+        unit: identifier of the node the record came from
+
+    Returns:
+        directory holding the records for the unit on the (UTC) day
+    """
+    unit = re_unit.sub("_", str(unit)) or "unknown"
+    return os.path.join(root, datetime.utcfromtimestamp(record_time).strftime("%Y{0}%m{0}%d".format(os.sep)), unit)
+
+
+def encode_record(record_time, metadata, payload):
+    body = json.dumps(metadata, sort_keys=True).encode("utf-8")
+    crc = binascii.crc32(payload, binascii.crc32(body)) & 0xffffffff
+    return RECORD_HEADER.pack(RECORD_MAGIC, len(payload), crc, len(body), record_time) + body + payload
+
+
+def _read_record(fh):
+    """Read the record at the current position of a segment
+
+    Returns:
+        tuple of the record length, time, metadata and payload, or None at the end of the segment
+    """
+    header = fh.read(RECORD_HEADER.size)
+    if not len(header):
+        return None
+    elif len(header) < RECORD_HEADER.size:
+        raise ValueError("Truncated record header")
+
+    magic, length, crc, metadata_length, record_time = RECORD_HEADER.unpack(header)
+    if magic != RECORD_MAGIC:
+        raise ValueError("Bad record magic")
+    body = fh.read(metadata_length)
+    payload = fh.read(length)
+    if len(body) < metadata_length or len(payload) < length:
+        raise ValueError("Truncated record")
+    elif binascii.crc32(payload, binascii.crc32(body)) & 0xffffffff != crc:
+        raise ValueError("Record CRC mismatch")
+    return RECORD_HEADER.size + metadata_length + length, record_time, json.loads(body.decode("utf-8")), payload
+
+
+def read_records(path):
+    """Read every intact record of a segment, stopping at the first damaged one
+
+    Args:
+        path: of the segment log
+
+    Returns:
+        generator of tuples of the record offset, time, metadata and payload
+    """
+    with open(path, "rb") as fh:
+        offset = 0
+        while True:
+            try:
+                record = _read_record(fh)
+            except ValueError as e:
+                logging.warning("{} at {} of {}, ignoring the rest of the segment".format(e, offset, path))
+                return
+            if record is None:
+                return
+
+            length, record_time, metadata, payload = record
+            yield offset, record_time, metadata, payload
+            offset += length
+
+
+def recover_segment(path):
+    """Cut a segment back to the end of its last intact record
+
+    A crash part way through an append leaves a torn record at the end of the log, and anything appended after it
+    would be unreadable, so this is done before a segment is written to again. The index is trusted up to its
+    last entry that points at an intact record, and any intact records after that are read from the log and
+    indexed again.
+
+    Args:
+        path: of the segment log
+
+    Returns:
+        number of bytes cut from the end of the log
+    """
+    entries = []
+    if os.path.exists(index_path(path)):
+        with open(index_path(path), "rb") as fh:
+            index = fh.read()
+        entries = [INDEX_ENTRY.unpack_from(index, offset)
+                   for offset in range(0, len(index) - len(index) % INDEX_ENTRY.size, INDEX_ENTRY.size)]
+    else:
+        index = b""
+
+    with open(path, "r+b") as fh:
+        size = os.fstat(fh.fileno()).st_size
+
+        # Index entries go out before their records, so the last few may be for records that never made it
+        while len(entries):
+            offset, length, _ = entries[-1]
+            fh.seek(offset)
+            try:
+                record = _read_record(fh) if offset + length <= size else None
+            except ValueError:
+                record = None
+            if record is not None and record[0] == length:
+                break
+            entries.pop()
+
+        end = entries[-1][0] + entries[-1][1] if len(entries) else 0
+        fh.seek(end)
+        while True:
+            try:
+                record = _read_record(fh)
+            except ValueError:
+                record = None
+            if record is None:
+                break
+            entries.append((end, record[0], record[1]))
+            end += record[0]
+
+        if end < size:
+            logging.warning("Cutting {} bytes of damaged records from the end of {}".format(size - end, path))
+            fh.truncate(end)
+            os.fsync(fh.fileno())
+
+    rebuilt = b"".join(INDEX_ENTRY.pack(*entry) for entry in entries)
+    if rebuilt != index:
+        tmp_path = "{}.tmp".format(index_path(path))
+        with open(tmp_path, "wb") as fh:
+            fh.write(rebuilt)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, index_path(path))
+    return size - end
+
+
+def segment_paths(partition):
+    """
+
+    Returns:
+        sorted list of the segment logs in a partition
+    """
+    if not os.path.isdir(partition):
+        return []
+    return [os.path.join(partition, f) for f in sorted(os.listdir(partition)) if re_segment.match(f)]
+
+
+def index_path(segment):
+    return "{}.idx".format(segment[:-len(".log")])
+
+
+class _Segment(object):
+    def __init__(self, partition, number, writer=None):
+        self.path = os.path.join(partition, "segment-{:06d}{}.log".format(
+            number, "-w{}".format(writer) if writer is not None else ""))
+        self.number = number
+        self.writer = writer
+        if os.path.exists(self.path):
+            recover_segment(self.path)
+        self.log = open(self.path, "ab")
+        self.index = open(index_path(self.path), "ab")
+        self.size = self.log.tell()
+        self.last_write = time.monotonic()
+
+    def append(self, record, record_time):
+        self.index.write(INDEX_ENTRY.pack(self.size, len(record), record_time))
+        self.log.write(record)
+        self.size += len(record)
+        self.last_write = time.monotonic()
+
+    def flush(self):
+        self.log.flush()
+        self.index.flush()
+        return self.log.fileno(), self.index.fileno()
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+
+class SegmentStore(object):
+    """ Append only storage of received payloads, partitioned by day and unit
+
+    Rather than a file per payload, each partition holds a few large segment logs with a fixed width index
+    alongside, so neither writing nor scanning slows down as the directories fill. Each record is checked by a
+    CRC, so anything damaged by a power cut is spotted when reading.
+
+    append() returns once its record is on disk. Writers that arrive whilst a sync is under way wait for the next
+    one, which then covers all of their records, so the cost of each fsync is shared by however many payloads
+    arrived during the last.
+
+    Several processes can share a store as long as each is given its own writer number, which goes into the names
+    of the segments it writes.
+    """
+    def __init__(self, root, segment_bytes=64 * 1024 * 1024, sync_delay=0., idle_close=300., writer=None):
+        """
+
+        Args:
+            root: top directory of the store
+            segment_bytes: size after which a new segment is started
+            sync_delay: seconds to hold a sync back, to gather more records into it
+            idle_close: seconds after which segments that haven't been written to are closed
+            writer: number of this process amongst those writing to the store
+        """
+        self._root = root
+        self._writer = writer
+        self._segment_bytes = segment_bytes
+        self._sync_delay = sync_delay
+        self._idle_close = idle_close
+
+        self._segments = dict()
+        self._dirty = set()
+        self._lock = t.Lock()
+        self._synced = t.Condition(self._lock)
+        self._syncing = False
+        self._written = 0
+        self._durable = 0
+        self._syncs = 0
+
+        os.makedirs(self._root, exist_ok=True)
+
+    def append(self, record_time, unit, payload, metadata=None):
+        """Store a payload, returning once it's durable
+
+        Args:
+            record_time: seconds since the epoch the payload was received at
+            unit: identifier of the node it came from
+            payload: bytes received
+            metadata: dict of simple values describing the payload
+
+        Returns:
+            tuple of the segment path and the offset of the record in it
+        """
+        record = encode_record(record_time, metadata or {}, payload)
+
+        with self._lock:
+            segment = self._segment(partition_path(self._root, record_time, unit))
+            offset = segment.size
+            segment.append(record, record_time)
+            self._dirty.add(segment)
+            self._written += 1
+            sequence = self._written
+
+            while self._durable < sequence:
+                if self._syncing:
+                    self._synced.wait()
+                else:
+                    self._sync()
+        return segment.path, offset
+
+    def close(self):
+        with self._lock:
+            while self._syncing:
+                self._synced.wait()
+            self._sync()
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = dict()
+        logging.info("Closed store after {} syncs of {} records".format(self._syncs, self._written))
+
+    def _sync(self):
+        # Called holding the lock, which is let go whilst waiting on the disk so other writers can carry on
+        self._syncing = True
+        try:
+            if self._sync_delay:
+                self._lock.release()
+                try:
+                    time.sleep(self._sync_delay)
+                finally:
+                    self._lock.acquire()
+
+            target = self._written
+            fds = [fd for segment in self._dirty for fd in segment.flush()]
+            self._dirty = set()
+
+            self._lock.release()
+            try:
+                for fd in fds:
+                    os.fsync(fd)
+            finally:
+                self._lock.acquire()
+
+            self._durable = target
+            self._syncs += 1
+            self._close_idle()
+        finally:
+            self._syncing = False
+            self._synced.notify_all()
+
+    def _segment(self, partition):
+        segment = self._segments.get(partition)
+        while segment is not None and segment.size >= self._segment_bytes and self._syncing:
+            # A sync may be using its descriptors, so it can't be closed until that's done
+            self._synced.wait()
+            segment = self._segments.get(partition)
+
+        if segment is not None and segment.size < self._segment_bytes:
+            return segment
+
+        if segment is None:
+            os.makedirs(partition, exist_ok=True)
+            numbers = [int(match.group(1)) for match in
+                       [re_segment.match(os.path.basename(path)) for path in segment_paths(partition)]
+                       if match.group(2) == (str(self._writer) if self._writer is not None else None)]
+            number = max(numbers) if len(numbers) else 0
+        else:
+            # Full, and only closed once its last records are synced
+            number = segment.number + 1
+            self._retire(segment)
+
+        segment = _Segment(partition, number, self._writer)
+        if segment.size >= self._segment_bytes:
+            self._retire(segment)
+            segment = _Segment(partition, number + 1, self._writer)
+        self._segments[partition] = segment
+        return segment
+
+    def _retire(self, segment):
+        if segment in self._dirty:
+            segment.flush()
+            os.fsync(segment.log.fileno())
+            os.fsync(segment.index.fileno())
+            self._dirty.discard(segment)
+        segment.close()
+
+    def _close_idle(self):
+        now = time.monotonic()
+        for partition, segment in list(self._segments.items()):
+            if segment not in self._dirty and now - segment.last_write > self._idle_close:
+                segment.close()
+                del self._segments[partition]
+
+
+def scan(partition):
+    """Read every record in a partition, in the order they were stored
+
+    Returns:
+        generator of tuples of the record time, metadata and payload
+    """
+    for segment in segment_paths(partition):
+        for _, record_time, metadata, payload in read_records(segment):
+            yield record_time, metadata, payload
+
+
+def compact(partition, segment_bytes=64 * 1024 * 1024):
+    """Rewrite the segments of a partition into as few as possible
+
+    Damaged records are dropped and the indexes are rebuilt. Every intact record is kept, however alike two of
+    them are, as identical payloads can arrive together. The new segments are numbered after the old ones and
+    written aside, then a list of the segments they replace is put down before any are moved into place, so a
+    compaction that's interrupted is finished off by the next rather than leaving records in twice. Only run this
+    on partitions that aren't being written to, eg. those of previous days.
+
+    Args:
+        partition: directory of the partition
+        segment_bytes: size of the segments written
+
+    Returns:
+        tuple of the number of records kept and dropped
+    """
+    tmp_dir = os.path.join(partition, ".compact")
+    if os.path.exists(os.path.join(tmp_dir, "replaces")):
+        logging.warning("Finishing interrupted compaction of {}".format(partition))
+        _replace_segments(partition)
+
+    segments = segment_paths(partition)
+    if not len(segments):
+        return 0, 0
+
+    os.makedirs(tmp_dir, exist_ok=True)
+    for stale in os.listdir(tmp_dir):
+        os.unlink(os.path.join(tmp_dir, stale))
+
+    number = max(int(re_segment.match(os.path.basename(path)).group(1)) for path in segments) + 1
+    output = _Segment(tmp_dir, number)
+    outputs = [output]
+    kept = 0
+
+    for segment in segments:
+        for _, record_time, metadata, payload in read_records(segment):
+            if output.size >= segment_bytes:
+                number += 1
+                output = _Segment(tmp_dir, number)
+                outputs.append(output)
+            output.append(encode_record(record_time, metadata, payload), record_time)
+            kept += 1
+
+    for output in outputs:
+        for fd in output.flush():
+            os.fsync(fd)
+        output.close()
+
+    # Damaged records never make it past read_records, so count what was there from the indexes
+    indexed = sum(os.path.getsize(index_path(s)) // INDEX_ENTRY.size for s in segments
+                  if os.path.exists(index_path(s)))
+    dropped = max(indexed - kept, 0)
+
+    with open(os.path.join(tmp_dir, "replaces.tmp"), "w") as fh:
+        json.dump([os.path.basename(segment) for segment in segments], fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(os.path.join(tmp_dir, "replaces.tmp"), os.path.join(tmp_dir, "replaces"))
+    _replace_segments(partition)
+
+    logging.info("Compacted {} segments of {} into {}, keeping {} records and dropping {}".format(
+        len(segments), partition, len(outputs), kept, dropped))
+    return kept, dropped
+
+
+def _replace_segments(partition):
+    # Moves the compacted segments into place and removes those they replace, which is safe to repeat
+    tmp_dir = os.path.join(partition, ".compact")
+    with open(os.path.join(tmp_dir, "replaces"), "r") as fh:
+        replaced = json.load(fh)
+
+    for output in segment_paths(tmp_dir):
+        if os.path.exists(index_path(output)):
+            os.replace(index_path(output), index_path(os.path.join(partition, os.path.basename(output))))
+        os.replace(output, os.path.join(partition, os.path.basename(output)))
+
+    for name in replaced:
+        segment = os.path.join(partition, name)
+        if os.path.exists(segment):
+            os.unlink(segment)
+        if os.path.exists(index_path(segment)):
+            os.unlink(index_path(segment))
+
+    os.unlink(os.path.join(tmp_dir, "replaces"))
+    os.rmdir(tmp_dir)
@@ -0,0 +1,331 @@
+import binascii
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import struct
+import threading as t
+
+CONTINUATION_HEADER = struct.Struct("!iLLL")
+RANGE_FIELDS = struct.Struct("!LLL")
+
+
+class FileChunk(object):
+    """ One chunk of a file sent by CertusConnection.process_transfer """
+    def __init__(self, name_crc, name, file_length, start, end, data):
+        self.name_crc = name_crc
+        self.name = name
+        self.file_length = file_length
+        self.start = start
+        self.end = end
+        self.data = data
+
+    @property
+    def key(self):
+        return self.name_crc, self.file_length
+
+
+def parse_chunk(payload):
+    """Recognise a file chunk amongst the payloads delivered from a node
+
+    The first chunk of each session carries the file name, CRC and all, and the rest a shorter continuation
+    header. Both start with the CRC of the name, which being 16 bits always starts with two zero bytes, something
+    no other kind of message sent by a node does.
+
+    Args:
+        payload: bytes of a delivered payload
+
+    Returns:
+        FileChunk, or None if the payload isn't one
+    """
+    if len(payload) < CONTINUATION_HEADER.size or payload[:2] != b"\x00\x00":
+        return None
+
+    name_crc = struct.unpack_from("!i", payload)[0]
+    name_length = payload[4]
+    name = bytes(payload[5:5 + name_length])
+    offset = 5 + name_length + RANGE_FIELDS.size
+
+    if len(payload) >= offset and binascii.crc32(name) & 0xffff == name_crc:
+        file_length, start, end = RANGE_FIELDS.unpack_from(payload, 5 + name_length)
+        name = name.decode("latin-1")
+    else:
+        name = None
+        offset = CONTINUATION_HEADER.size
+        _, file_length, start, end = CONTINUATION_HEADER.unpack_from(payload)
+
+    if not start <= end <= file_length or end - start != len(payload) - offset:
+        return None
+    return FileChunk(name_crc, name, file_length, start, end, payload[offset:])
+
+
+class FileReassembler(object):
+    """ Rebuilds files from their chunks as they arrive, in whatever order and however many times
+
+    Each file is identified by the CRC of its name and its length. Chunks are written straight into place in a
+    sparse partial file, with the ranges covered so far kept alongside it so reassembly carries on across
+    restarts, and chunks that have already been written are skipped. Once every byte is in, the file is moved
+    into the output directory in one step under its own name.
+
+    Continuation chunks can arrive before the chunk naming their file, in which case the file is finished once
+    the name turns up. Chunks that arrive after their file has been finished are checked against it: retransmitted
+    ones match and are dropped, whereas one that differs means the file has changed without changing length, so
+    it is written over a copy of the file which then replaces it. A file that has been sent again after being
+    appended to is seeded with the version already received, when its first chunk starts where that version ends.
+
+    If shared, the chunks of a file can be handed to reassemblers in several processes at once. Each then takes a
+    lock on the partial directory and reads the state of the file afresh before writing anything. The state of
+    each finished file is kept, marked complete, so that chunks arriving late at any of them are checked against
+    the finished file.
+    """
+    re_state_file = re.compile(r'^\.(-?\d+)-(\d+)\.part\.state$')
+
+    def __init__(self, output_dir, shared=False):
+        self._dir = output_dir
+        self._partial_dir = os.path.join(output_dir, ".partial")
+        self._shared = shared
+        self._lock = t.Lock()
+        self._transfers = dict()
+        self._completed = collections.deque()
+
+        os.makedirs(self._partial_dir, exist_ok=True)
+        self._transfers = self._load()
+        logging.info("Resumed {} partially received files".format(len(self._transfers)))
+
+    def add(self, chunk):
+        """
+
+        Args:
+            chunk: FileChunk to write into place
+
+        Returns:
+            path of the completed file if this chunk finished it, otherwise None
+        """
+        with self._locked():
+            if self._shared:
+                state = self._load_state(chunk.key)
+                if state is None:
+                    self._transfers.pop(chunk.key, None)
+                else:
+                    self._transfers[chunk.key] = state
+
+            transfer = self._transfers.get(chunk.key)
+            changed = False
+            if transfer is None:
+                transfer = self._finished(chunk) or {"name": None, "ranges": [], "complete": False}
+                self._transfers[chunk.key] = transfer
+                if transfer["complete"]:
+                    self._remember(chunk.key)
+
+            if transfer["complete"]:
+                if self._matches(os.path.join(self._dir, transfer["name"]), chunk):
+                    logging.debug("{}-{} of {} arrived after the file was finished, ignoring".format(
+                        chunk.start, chunk.end, transfer["name"]))
+                    return None
+                changed = self._reopen(chunk.key, transfer)
+
+            if chunk.name and not transfer["name"]:
+                name = os.path.basename(chunk.name)
+                transfer["name"] = name if name not in ("", ".", "..") else "{:04x}".format(chunk.name_crc)
+                # Continuation chunks of an appended file may well have arrived before this one
+                self._seed(chunk, transfer)
+
+            if self._covered(transfer["ranges"], chunk.start, chunk.end) and not changed:
+                logging.debug("Already have {}-{} of {}, ignoring".format(
+                    chunk.start, chunk.end, transfer["name"] or chunk.key))
+            else:
+                with open(self._part_path(chunk.key), "r+b" if os.path.exists(self._part_path(chunk.key))
+                          else "w+b") as fh:
+                    fh.seek(chunk.start)
+                    fh.write(chunk.data)
+                transfer["ranges"] = self._merge(transfer["ranges"], chunk.start, chunk.end)
+                logging.info("Received {}-{} of {} byte file {}".format(
+                    chunk.start, chunk.end, chunk.file_length, transfer["name"] or chunk.key))
+
+            if self._covered(transfer["ranges"], 0, chunk.file_length) and transfer["name"]:
+                return self._finalise(chunk.key, transfer)
+
+            self._save(chunk.key, transfer)
+            return None
+
+    def missing(self):
+        """
+
+        Returns:
+            dict of file name, or name CRC where the name isn't yet known, to the file length and the list of
+            (start, end) byte ranges still to arrive
+        """
+        with self._locked():
+            if self._shared:
+                self._transfers = self._load()
+
+            missing = dict()
+            for (name_crc, file_length), transfer in self._transfers.items():
+                if transfer["complete"]:
+                    continue
+
+                gaps = []
+                offset = 0
+                for start, end in transfer["ranges"]:
+                    if start > offset:
+                        gaps.append((offset, start))
+                    offset = max(offset, end)
+                if offset < file_length:
+                    gaps.append((offset, file_length))
+                missing[transfer["name"] or "{:04x}".format(name_crc)] = (file_length, gaps)
+            return missing
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if not self._shared:
+                yield
+                return
+
+            with open(os.path.join(self._partial_dir, ".lock"), "a") as fh:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+    def _load(self):
+        transfers = dict()
+        for state_file in os.listdir(self._partial_dir):
+            match = self.re_state_file.match(state_file)
+            if match:
+                key = (int(match.group(1)), int(match.group(2)))
+                state = self._load_state(key)
+                if state is not None and not state["complete"]:
+                    transfers[key] = state
+        return transfers
+
+    def _load_state(self, key):
+        try:
+            with open(self._state_path(key), "r") as fh:
+                state = json.load(fh)
+            return {"name": state["name"],
+                    "ranges": [tuple(r) for r in state["ranges"]],
+                    "complete": state.get("complete", False)}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring unreadable transfer state {}: {}".format(self._state_path(key), e))
+            return None
+
+    def _finished(self, chunk):
+        # Without any state, a named chunk is checked against a file of its name and length that's already there
+        if chunk.name:
+            name = os.path.basename(chunk.name)
+            output_file = os.path.join(self._dir, name)
+            if name not in ("", ".", "..") and os.path.exists(output_file) \
+                    and os.path.getsize(output_file) == chunk.file_length:
+                return {"name": name, "ranges": [], "complete": True}
+        return None
+
+    def _remember(self, key):
+        # Finished files are only kept in memory for so long, shared ones live on in their state
+        self._completed.append(key)
+        while len(self._completed) > 1024:
+            old = self._completed.popleft()
+            if old in self._transfers and self._transfers[old]["complete"]:
+                del self._transfers[old]
+
+    @staticmethod
+    def _matches(path, chunk):
+        try:
+            with open(path, "rb") as fh:
+                fh.seek(chunk.start)
+                return fh.read(chunk.end - chunk.start) == bytes(chunk.data)
+        except OSError:
+            return False
+
+    def _reopen(self, key, transfer):
+        output_file = os.path.join(self._dir, transfer["name"])
+        logging.info("{} has changed since it was finished, receiving the new version".format(output_file))
+        transfer.update({"ranges": [], "complete": False})
+        if not os.path.exists(output_file) or os.path.getsize(output_file) != key[1]:
+            return False
+
+        # The rest of the new version will overwrite the old as it arrives, where it differs
+        with open(output_file, "rb") as src, open(self._part_path(key), "wb") as dst:
+            while True:
+                data = src.read(65536)
+                if not data:
+                    break
+                dst.write(data)
+        transfer["ranges"] = [(0, key[1])]
+        return True
+
+    def _seed(self, chunk, transfer):
+        if not chunk.name or not chunk.start:
+            return
+
+        previous = os.path.join(self._dir, os.path.basename(chunk.name))
+        if not os.path.exists(previous) or os.path.getsize(previous) != chunk.start:
+            return
+
+        part_path = self._part_path(chunk.key)
+        with open(previous, "rb") as src, open(part_path, "r+b" if os.path.exists(part_path) else "w+b") as dst:
+            while True:
+                data = src.read(65536)
+                if not data:
+                    break
+                dst.write(data)
+        transfer["ranges"] = self._merge(transfer["ranges"], 0, chunk.start)
+        logging.info("Seeded {} with the {} bytes already received".format(chunk.name, chunk.start))
+
+    def _finalise(self, key, transfer):
+        part_path = self._part_path(key)
+        if not os.path.exists(part_path):
+            # Only possible for an empty file
+            open(part_path, "wb").close()
+
+        with open(part_path, "r+b") as fh:
+            fh.truncate(key[1])
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        output_file = os.path.join(self._dir, transfer["name"])
+        os.replace(part_path, output_file)
+        transfer.update({"ranges": [], "complete": True})
+        if self._shared:
+            # Kept so that other processes know to check chunks of this file that arrive late
+            self._save(key, transfer)
+        elif os.path.exists(self._state_path(key)):
+            os.unlink(self._state_path(key))
+        self._remember(key)
+        logging.info("Completed {} of {} bytes".format(output_file, key[1]))
+        return output_file
+
+    def _save(self, key, transfer):
+        tmp_path = "{}.tmp".format(self._state_path(key))
+        with open(tmp_path, "w") as fh:
+            json.dump({"name": transfer["name"],
+                       "ranges": transfer["ranges"],
+                       "complete": transfer.get("complete", False)}, fh)
+        os.replace(tmp_path, self._state_path(key))
+
+    def _part_path(self, key):
+        return os.path.join(self._partial_dir, ".{}-{}.part".format(*key))
+
+    def _state_path(self, key):
+        return "{}.state".format(self._part_path(key))
+
+    @staticmethod
+    def _covered(ranges, start, end):
+        return start == end or any(r_start <= start and end <= r_end for r_start, r_end in ranges)
+
+    @staticmethod
+    def _merge(ranges, start, end):
+        merged = []
+        for r_start, r_end in ranges:
+            if r_end < start or r_start > end:
+                merged.append((r_start, r_end))
+            else:
+                start, end = min(start, r_start), max(end, r_end)
+        merged.append((start, end))
+        return sorted(merged)
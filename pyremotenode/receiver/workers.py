@@ -0,0 +1,122 @@
+import logging
+import os
+import signal
+import sys
+import time
+
+
+class WorkerSupervisor(object):
+    """ Runs a receiver in several processes, restarting any that die
+
+    Each worker is forked from the supervisor and runs target with its worker number, which stays with the worker
+    across restarts. A worker that dies soon after starting is restarted after a delay that doubles each time,
+    so one that can't start doesn't spin. Stopping the supervisor with SIGTERM or SIGINT stops the workers, and
+    waits for them to exit.
+    """
+    def __init__(self, workers, target,
+                 restart_delay=1.,
+                 max_restart_delay=60.,
+                 stable_after=60.):
+        """
+
+        Args:
+            workers: number of worker processes to run
+            target: function run in each worker, given its worker number
+            restart_delay: seconds to wait before restarting a worker that died early
+            max_restart_delay: longest that delay grows to
+            stable_after: seconds after which a worker is considered to have started properly
+        """
+        self._workers = workers
+        self._target = target
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._stable_after = stable_after
+
+        self._children = dict()
+        self._started = dict()
+        self._delays = dict()
+        self._stopping = False
+
+    def run(self):
+        handlers = [(s, signal.signal(s, self._stop)) for s in (signal.SIGTERM, signal.SIGINT)]
+
+        try:
+            for worker in range(self._workers):
+                self._start(worker)
+
+            while len(self._children):
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+
+                worker = self._children.pop(pid, None)
+                if worker is None:
+                    continue
+                elif self._stopping:
+                    logging.info("Worker {} (PID {}) has stopped".format(worker, pid))
+                    continue
+
+                if os.WIFSIGNALED(status):
+                    logging.warning("Worker {} (PID {}) was killed by signal {}".format(
+                        worker, pid, os.WTERMSIG(status)))
+                else:
+                    logging.warning("Worker {} (PID {}) exited with status {}".format(
+                        worker, pid, os.WEXITSTATUS(status)))
+
+                if time.monotonic() - self._started[worker] < self._stable_after:
+                    delay = self._delays.get(worker, 0.)
+                    delay = min(delay * 2, self._max_restart_delay) if delay else self._restart_delay
+                    self._delays[worker] = delay
+                    logging.info("Restarting worker {} in {:.1f} seconds".format(worker, delay))
+                    time.sleep(delay)
+                else:
+                    self._delays.pop(worker, None)
+
+                if not self._stopping:
+                    self._start(worker)
+        finally:
+            for s, handler in handlers:
+                signal.signal(s, handler)
+        logging.info("All workers have stopped")
+
+    def _start(self, worker):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                # Stopping runs through the same clean up as an interrupt would, so anything buffered is written
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGTERM, self._exit)
+                self._target(worker)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 0
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logging.exception("Worker {} failed".format(worker))
+                status = 1
+            finally:
+                logging.shutdown()
+                os._exit(status)
+
+        logging.info("Started worker {} as PID {}".format(worker, pid))
+        self._children[pid] = worker
+        self._started[worker] = time.monotonic()
+
+    def _stop(self, signum, frame):
+        logging.info("Received signal {}, stopping {} workers".format(signum, len(self._children)))
+        self._stopping = True
+        for pid in list(self._children.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    @staticmethod
+    def _exit(signum, frame):
+        sys.exit(0)
+
+    @property
+    def workers(self):
+        return dict(self._children)
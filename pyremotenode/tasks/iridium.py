@@ -79,7 +79,7 @@ class MessageSender(BaseSender):
             include_date=not invoking_task.binary,
             warning=warning,
             critical=critical,
-            max_length=self._message_length
+            max_length=self.max_length
         )
         self.modem.send_message(msg)
         self.modem.start()
@@ -89,9 +89,14 @@ class MessageSender(BaseSender):
         self.modem.send_message(Message(message,
                                         binary=self.binary,
                                         include_date=include_date,
-                                        max_length=self._message_length))
+                                        max_length=self.max_length))
         self.modem.start()
 
+    @property
+    def max_length(self):
+        # Fragmentation takes care of messages longer than the connection can send in one go
+        return None if self.modem.fragment_messages else self._message_length
+
     @property
     def message_length(self):
         return self._message_length
@@ -178,7 +183,8 @@ class MTMessageCheck(BaseTask):
         logging.debug("Running MTMessageCheck task")
 
         modem = ModemConnection()
-        modem_locked = False
+        in_session = False
+        failed = False
 
         qsize = modem.message_queue.qsize()
         if qsize > 0:
@@ -186,26 +192,21 @@ class MTMessageCheck(BaseTask):
             return BaseTask.OK
 
         try:
-            if modem.modem_lock.acquire(blocking=False):
-                modem_locked = True
-                logging.debug("Running MTMessageCheck initialisation")
-                modem.initialise_modem()
+            if modem.modem_session.acquire(blocking=False):
+                in_session = True
 
                 if modem.signal_check():
                     logging.debug("Running MTMessageCheck processing")
-                    modem.process_sbd_message()
+                    modem.poll_for_messages()
         except ModemConnectionException:
+            failed = True
             logging.exception("Caught a modem exception running the regular task, abandoning")
         except Exception:
+            failed = True
             logging.exception("Modem inoperational or another error occurred")
         finally:
-            if modem_locked:
-                modem.close()
-
-                try:
-                    modem.modem_lock.release()
-                except RuntimeError:
-                    logging.warning("Looks like the lock wasn't acquired, dealing with this...")
+            if in_session:
+                modem.modem_session.release(end=failed)
 
         return BaseTask.OK
 
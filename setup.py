@@ -39,6 +39,8 @@ setup(
     ],
     entry_points={
         "console_scripts": [
+            "run_compactor = pyremotenode.cli:compactor_main",
+            "run_decoder = pyremotenode.cli:decoder_main",
             "run_receiver = pyremotenode.cli:receiver_main",
             "run_pyremotenode = pyremotenode.cli:remotenode_main",
         ]
@@ -0,0 +1,1335 @@
+import struct
+
+from pyremotenode.comms.responses import ResponseParser
+
+
+def test_response_lines_and_result():
+    parser = ResponseParser()
+    for chunk in (b"\r\n+SBDIX: 0, 12, 1, 3", b", 20, 2\r\n\r\nO", b"K\r\n"):
+        parser.feed(chunk)
+
+    response = parser.response()
+    assert response.ok
+    assert response.value("+SBDIX") == "0, 12, 1, 3, 20, 2"
+
+
+def test_response_error_result():
+    parser = ResponseParser()
+    parser.feed(b"+IMTWB ERROR: 2\r\n")
+    assert parser.response().result == "+IMTWB ERROR: 2"
+
+
+def test_response_length_prefixed_binary():
+    body = b"OK\r\nnot a result"
+    block = struct.pack(">H", len(body)) + body + b"\x00\x01"
+    parser = ResponseParser(length_prefixed=True)
+    for i in range(len(block)):
+        parser.feed(block[i:i + 1])
+    assert not parser.complete
+    parser.feed(b"\r\nOK\r\n")
+
+    response = parser.response()
+    assert response.ok
+    assert response.binary == block
+
+
+def test_unsolicited_codes_split_and_interleaved():
+    import queue
+    import re
+
+    from pyremotenode.comms.responses import ResponseParser
+    from pyremotenode.comms.unsolicited import UnsolicitedDispatcher
+
+    class _Serial(object):
+        def __init__(self):
+            self.timeout = None
+            self.in_waiting = 0
+            self.replies = dict()
+            self.pending = queue.Queue()
+
+        def read(self, size):
+            try:
+                return self.pending.get(timeout=self.timeout)
+            except queue.Empty:
+                return b""
+
+        def write(self, data):
+            for piece in self.replies.pop(bytes(data), []):
+                self.pending.put(piece)
+
+    conn = _Serial()
+    received = queue.Queue()
+    dispatcher = UnsolicitedDispatcher(conn, read_timeout=0.05)
+    dispatcher.register(re.compile(r'^\+(IMTMTS|SBDRING)'), lambda line, match: received.put(line))
+    dispatcher.start()
+
+    try:
+        # Whilst idle, split across reads
+        for piece in (b"\r\n+IMTM", b"TS: 1, 2", b", 3\r", b"\n"):
+            conn.pending.put(piece)
+        assert received.get(timeout=5) == "+IMTMTS: 1, 2, 3"
+
+        # In the middle of a command response, and straight after it in the same read
+        conn.replies[b"AT+CSQ\r"] = [b"\r\n+CS", b"Q: 4\r\n+SBDRI", b"NG\r\n\r\nO", b"K\r\n+IMTMTS: 2,",
+                                     b" 5, 6\r\n"]
+        parser = ResponseParser(unsolicited=dispatcher.dispatch)
+        assert dispatcher.command(parser, b"AT+CSQ\r", 5)
+        response = parser.response()
+        assert response.ok and response.lines == ["+CSQ: 4"]
+        assert received.get(timeout=5) == "+SBDRING"
+        assert received.get(timeout=5) == "+IMTMTS: 2, 5, 6"
+    finally:
+        dispatcher.stop()
+
+
+class _FakeModem(object):
+    """ Answers AT commands on one end of a socket pair, recording what it was sent """
+    def __init__(self, sock):
+        import threading
+
+        self.sock = sock
+        self.received = []
+        self.polls = dict()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        buffer = b""
+        binary = 0
+        while True:
+            data = self.sock.recv(4096)
+            if not data:
+                return
+            buffer += data
+
+            while True:
+                if binary:
+                    if len(buffer) < binary:
+                        break
+                    self.received.append(buffer[:binary])
+                    buffer, binary = buffer[binary:], 0
+                    # Unsolicited MT notification ahead of the final result
+                    self.sock.sendall(b"+IMTWB: 9\r\n+IMTMTS: 1, 2, 3\r\n\r\nOK\r\n")
+                    continue
+                elif b"\r" not in buffer:
+                    break
+
+                command, buffer = buffer.split(b"\r", 1)
+                command = command.decode()
+                self.received.append(command)
+                if command.startswith("AT+IMTWB="):
+                    binary = int(command.split("=")[1])
+                    self.sock.sendall(b"\r\nREADY\r\n")
+                elif command.startswith("AT+IMTMOS="):
+                    message_id = command.split("=")[1]
+                    self.polls[message_id] = self.polls.get(message_id, 0) + 1
+                    status = 5 if self.polls[message_id] > int(message_id) else 2
+                    self.sock.sendall("+IMTMOS: {},{}\r\n\r\nOK\r\n".format(message_id, status).encode())
+                else:
+                    self.sock.sendall(b"\r\nOK\r\n")
+
+
+def test_async_driver_serialises_commands_and_sends():
+    import asyncio
+    import re
+    import socket
+
+    from pyremotenode.comms.aio import AsyncModemDriver
+
+    node, modem = socket.socketpair()
+    fake = _FakeModem(modem)
+    loop = asyncio.new_event_loop()
+    driver = AsyncModemDriver(node, loop)
+    received = []
+    driver.register(re.compile(r'^\+IMTMTS:'), lambda line, match: received.append(line))
+
+    async def _run():
+        await driver.open()
+        try:
+            return await asyncio.gather(
+                driver.modem_command("AT+IMTMOS=0"),
+                driver.send_binary("AT+IMTWB=5", [b"hel", b"lo"]),
+                driver.modem_command("AT+IMTMOS=1"))
+        finally:
+            driver.close()
+
+    try:
+        first, sent, second = loop.run_until_complete(_run())
+    finally:
+        loop.close()
+        node.close()
+        modem.close()
+
+    assert first.value("+IMTMOS") == "0,5" and second.value("+IMTMOS") == "1,2"
+    assert sent.ok and sent.value("+IMTWB") == "9"
+    assert received == ["+IMTMTS: 1, 2, 3"]
+    # Nothing came between the write command and its binary
+    assert fake.received == ["AT+IMTMOS=0", "AT+IMTWB=5", b"hello", "AT+IMTMOS=1"]
+
+
+def test_sync_modem_facade():
+    import queue
+    import re
+    import select
+    import socket
+    import threading
+
+    from pyremotenode.comms.aio import SyncModemFacade
+    from pyremotenode.comms.responses import ResponseParser
+
+    node, modem = socket.socketpair()
+    fake = _FakeModem(modem)
+    facade = SyncModemFacade(node)
+    received = queue.Queue()
+    facade.register(re.compile(r'^\+IMTMTS:'), lambda line, match: received.put(line))
+    facade.start()
+
+    try:
+        assert facade.active
+        responses = []
+
+        def _command(n):
+            parser = ResponseParser(unsolicited=facade.dispatch)
+            facade.command(parser, "AT+CSQ{}\r".format(n).encode(), 5)
+            responses.append(parser.response())
+
+        threads = [threading.Thread(target=_command, args=(n, )) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(responses) == 4 and all(r.ok for r in responses)
+
+        assert facade.send_binary("AT+IMTWB=2", [b"hi"]).ok
+        assert received.get(timeout=5) == "+IMTMTS: 1, 2, 3"
+
+        # Whilst paused, the port is left to the caller, eg. for a data call
+        with facade.paused():
+            assert not facade.active
+            modem.sendall(b"+IMTMTS: 4, 5, 6\r\n")
+            assert select.select([node], [], [], 5)[0]
+            assert node.recv(100) == b"+IMTMTS: 4, 5, 6\r\n"
+        assert received.empty()
+        assert sorted(fake.received[:4]) == ["AT+CSQ{}".format(n) for n in range(4)]
+    finally:
+        facade.stop()
+        node.close()
+        modem.close()
+
+
+def test_queue_requeue_at_head(tmp_path):
+    from pyremotenode.comms.queues import MessageQueue, PersistentMessageQueue
+
+    for q in (MessageQueue(), PersistentMessageQueue(str(tmp_path / "queue.db"))):
+        for item in ("first", "second"):
+            q.put((1, item))
+        q.put((2, "file"))
+
+        priority, item, entry_id = q.get()
+        assert item == "first"
+        q.requeue(entry_id)
+        assert q.get()[1] == "first"
+        assert q.qsize() == 3
+
+
+def test_persistent_queue_recovers_outstanding(tmp_path):
+    from pyremotenode.comms.queues import PersistentMessageQueue
+
+    path = str(tmp_path / "queue.db")
+    q = PersistentMessageQueue(path)
+    q.put((1, "first"))
+    q.put((1, "second"))
+    q.ack(q.get()[2])
+    q.get()
+    q.close()
+
+    q = PersistentMessageQueue(path)
+    assert q.qsize() == 1
+    assert q.get()[1] == "second"
+
+
+def test_pack_round_trip():
+    from pyremotenode.comms.framing import decode_message, pack_records, packed_size
+
+    records = [b"", b"short", bytes(range(256)) * 2]
+    frame = pack_records(records)
+    assert len(frame) == packed_size(records)
+    assert decode_message(frame) == records
+    assert decode_message(b"01-01-2020 00:00:00:raw") == [b"01-01-2020 00:00:00:raw"]
+
+
+def test_raw_binary_not_taken_for_framing():
+    from pyremotenode.comms.compression import Compressor
+    from pyremotenode.comms.framing import decode_message
+    from pyremotenode.comms.iridium import RudicsConnection
+    from pyremotenode.tasks.iridium import Message
+
+    conn = object.__new__(RudicsConnection)
+    conn._rockblock = False
+    conn.fragment_messages = False
+
+    # Raw binary that happens to start like a packed frame, a fragment or an encoded message
+    for first in (0x1e, 0x1f, 0xe0, 0xe1, 0xe4):
+        data = bytes([first]) + b"\x00\x01sensor"
+        for pack_messages, compressor in ((True, None), (False, Compressor())):
+            conn.pack_messages = pack_messages
+            conn._compressor = compressor
+            sent = conn._encode_message(Message(data, binary=True, include_date=False)).get_message_text()
+            assert decode_message(sent) == [data]
+
+        assert decode_message(data, framed=False) == [data]
+
+    # A node that doesn't frame sends everything as it is
+    conn.pack_messages = False
+    conn._compressor = None
+    assert conn._encode_message(Message(data, binary=True, include_date=False)).get_message_text() == data
+    text = conn._encode_message(Message(b"01-01-2020 00:00:00:ok", binary=True, include_date=False))
+    assert text.get_message_text() == b"01-01-2020 00:00:00:ok"
+
+
+def test_compression_round_trip():
+    from pyremotenode.comms.compression import Compressor, train_dictionary
+    from pyremotenode.comms.framing import decode_message, pack_records
+
+    samples = ["01-05-2021 12:{:02d}:00:ok - disk 45% load 0.{} temp 21C".format(i, i).encode() for i in range(40)]
+    dictionary = train_dictionary(samples[:30])
+    compressor = Compressor(dictionary)
+
+    for message in samples[30:] + [pack_records(samples[30:]), bytes(range(256)) * 8, b""]:
+        encoded = compressor.encode(message)
+        assert len(encoded) <= len(message) + 1
+        assert b"".join(decode_message(encoded, [dictionary])) == b"".join(decode_message(message))
+
+    assert len(compressor.encode(samples[-1])) < len(Compressor().encode(samples[-1]))
+
+
+def _take_all(plan, max_bytes):
+    chunks = []
+    while plan:
+        chunks.append(plan.take(max_bytes))
+    return chunks
+
+
+def test_chunk_plan_covers_file():
+    from pyremotenode.comms.transfer import ChunkPlan
+
+    chunks = _take_all(ChunkPlan(1000, 40, 16), 300)
+    assert chunks[0] == (0, 260)
+    assert all(end - start <= 284 for start, end in chunks[1:])
+    assert chunks[-1][1] == 1000
+    assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    assert not ChunkPlan(0, 40, 16)
+
+
+def test_chunk_plan_recuts_failed_chunks():
+    from pyremotenode.comms.transfer import ChunkPlan, ChunkSizer
+
+    plan = ChunkPlan(1000, 40, 16)
+    sizer = ChunkSizer(400, 100, grow_after=2)
+    first = plan.take(sizer.size)
+    second = plan.take(sizer.size)
+    sizer.failure()
+    plan.put_back(*first)
+    assert sizer.size == 200
+    assert plan.take(sizer.size) == (0, 160)
+    assert plan.ranges == [(160, 360), (744, 1000)]
+
+    sizer.signal(1)
+    assert sizer.size == 100
+    sizer.signal(5)
+    sizer.success()
+    sizer.success()
+    assert sizer.size == 200
+
+
+def test_certus_crc16_matches_xmodem():
+    from pyremotenode.comms.iridium import CertusConnection
+
+    assert CertusConnection.calculate_crc16(b"123456789") == 0x31c3
+    assert CertusConnection.calculate_crc16(b"6789", CertusConnection.calculate_crc16(b"12345")) == 0x31c3
+
+
+def test_transfer_journal_resumes_at_offset(tmp_path):
+    from pyremotenode.comms.transfer import ChunkPlan, TransferJournal
+
+    data = tmp_path / "data.log"
+    data.write_bytes(b"x" * 1000)
+    journal = TransferJournal(str(tmp_path / "transfers.journal"))
+    key = journal.file_key(str(data))
+    journal.record(key, 0, 300)
+    journal.record(key, 600, 800)
+    journal.record(key, 300, 400)
+    journal.close()
+
+    journal = TransferJournal(str(tmp_path / "transfers.journal"))
+    assert journal.completed(key) == [(0, 400), (600, 800)]
+    assert journal.missing(key, 1000) == [(400, 600), (800, 1000)]
+    assert _take_all(ChunkPlan(1000, 40, 16, ranges=journal.missing(key, 1000)), 150) == \
+        [(400, 510), (510, 600), (800, 934), (934, 1000)]
+
+    journal.finish(key)
+    journal.compact()
+    assert journal.is_done(key)
+    data.write_bytes(b"y" * 1001)
+    assert not journal.is_done(journal.file_key(str(data)))
+
+
+def test_file_chunk_reader_truncated(tmp_path):
+    import binascii
+
+    import pytest
+
+    from pyremotenode.comms.transfer import FileChangedError, FileChunkReader
+
+    data = tmp_path / "data.log"
+    data.write_bytes(bytes(range(256)) * 1000)
+    with FileChunkReader(str(data)) as reader:
+        assert reader.crc32() == binascii.crc32(data.read_bytes())
+        assert reader[1000:1010] == bytes(range(232, 242))
+
+        # As logrotate's copytruncate does, part way through sending
+        with open(str(data), "r+b") as fh:
+            fh.truncate(0)
+        with pytest.raises(FileChangedError):
+            reader.chunk(1000, 2000)
+
+
+def test_transfer_journal_batches_progress_syncs(tmp_path, monkeypatch):
+    from pyremotenode.comms import transfer
+
+    synced = []
+    monkeypatch.setattr(transfer.os, "fsync", synced.append)
+
+    data = tmp_path / "data.bin"
+    data.write_bytes(b"x" * 10000)
+    journal = transfer.TransferJournal(str(tmp_path / "transfers.journal"))
+    key = journal.file_key(str(data))
+
+    # Progress on every acknowledgement is written but not synced until asked
+    for offset in range(1000, 10001, 1000):
+        journal.record(key, 0, offset, sync=False)
+    assert not synced
+    journal.sync()
+    journal.sync()
+    assert len(synced) == 1
+
+    journal.record(key, 0, 10000)
+    journal.finish(key)
+    assert len(synced) == 3
+    journal.close()
+    assert len(synced) == 3
+
+    journal = transfer.TransferJournal(str(tmp_path / "transfers.journal"))
+    assert journal.is_done(journal.file_key(str(data)))
+
+
+def test_transfer_journal_baseline(tmp_path):
+    from pyremotenode.comms.transfer import TransferJournal
+
+    data = tmp_path / "data.log"
+    data.write_bytes(b"x" * 100)
+    journal = TransferJournal(str(tmp_path / "transfers.journal"))
+    key = journal.file_key(str(data))
+    journal.record(key, 0, 100)
+    journal.finish(key, 1234)
+    journal.compact()
+
+    journal = TransferJournal(str(tmp_path / "transfers.journal"))
+    assert journal.baseline(str(data)) == (100, 1234)
+    assert journal.missing(journal.file_key(str(data)), 150, 100) == [(100, 150)]
+
+
+def _socket_reader(sock):
+    import socket
+
+    def _read(timeout):
+        sock.settimeout(timeout)
+        try:
+            return sock.recv(4096)
+        except socket.timeout:
+            return b""
+    return _read
+
+
+def test_windowed_transfer_recovers_lost_blocks():
+    import io
+    import os
+    import socket
+    import threading
+
+    from pyremotenode.comms.rudics import FRAME_DATA, FrameDecoder, WindowedReceiver, WindowedSender
+
+    node, ground = socket.socketpair()
+
+    # Drop the first transmission of every fifth block
+    dropped = set()
+
+    def _lossy_write(data):
+        frames = FrameDecoder().feed(data)
+        if frames and frames[0][0] == FRAME_DATA and frames[0][1] % 5 == 2 and frames[0][1] not in dropped:
+            dropped.add(frames[0][1])
+            return
+        node.sendall(data)
+
+    content = os.urandom(20000)
+    output = io.BytesIO()
+    receiver = threading.Thread(target=WindowedReceiver(_socket_reader(ground), ground.sendall, timeout=10).receive,
+                                args=(output, ))
+    receiver.start()
+
+    blocks = WindowedSender(_socket_reader(node), _lossy_write, block_size=512, window=8, timeout=2).send(
+        memoryview(content))
+    receiver.join()
+    assert output.getvalue() == content
+    assert blocks == 40 + len(dropped)
+
+
+def test_windowed_transfer_resumes(tmp_path):
+    import binascii
+    import json
+    import os
+    import socket
+    import threading
+
+    from pyremotenode.comms.rudics import WindowedReceiver, WindowedSender
+
+    content = os.urandom(10000)
+    part = tmp_path / "data.part"
+    part.write_bytes(content[:4096])
+    (tmp_path / "data.part.state").write_text(json.dumps({
+        "length": len(content), "crc": binascii.crc32(content), "block_size": 1024, "base": 4}))
+
+    node, ground = socket.socketpair()
+    with open(str(part), "r+b") as fh:
+        receiver = threading.Thread(target=WindowedReceiver(_socket_reader(ground), ground.sendall, timeout=10,
+                                                            state_path=str(tmp_path / "data.part.state")).receive,
+                                    args=(fh, ))
+        receiver.start()
+        progress = []
+        blocks = WindowedSender(_socket_reader(node), node.sendall, block_size=1024).send(content, progress.append)
+        receiver.join()
+
+    assert blocks == 6
+    assert progress[-1] == len(content)
+    assert part.read_bytes() == content
+    assert not (tmp_path / "data.part.state").exists()
+
+
+def test_windowed_transfer_resends_start():
+    import io
+    import os
+    import socket
+    import threading
+
+    import pytest
+
+    from pyremotenode.comms.rudics import (FRAME_START, FrameDecoder, WindowedReceiver, WindowedSender,
+                                           WindowedTransferError)
+
+    node, ground = socket.socketpair()
+    starts = []
+
+    def _write(data):
+        frames = FrameDecoder().feed(data)
+        if frames and frames[0][0] == FRAME_START:
+            starts.append(data)
+            if len(starts) == 1:
+                return
+        node.sendall(data)
+
+    content = os.urandom(3000)
+    output = io.BytesIO()
+    receiver = threading.Thread(target=WindowedReceiver(_socket_reader(ground), ground.sendall, timeout=10).receive,
+                                args=(output, ))
+    receiver.start()
+    WindowedSender(_socket_reader(node), _write, block_size=1024, timeout=0.2).send(content)
+    receiver.join()
+    assert len(starts) == 2
+    assert output.getvalue() == content
+
+    # Nobody listening, the start is tried once and then once per retry
+    written = []
+    with pytest.raises(WindowedTransferError):
+        WindowedSender(lambda timeout: b"", written.append, timeout=0.01, max_retries=3).send(content)
+    assert len(written) == 4
+
+
+def test_rudics_batch_redials_dropped_call(tmp_path):
+    import io
+    import os
+    import socket
+    import threading
+
+    import pytest
+
+    from pyremotenode.comms.connections import ConnectionException
+    from pyremotenode.comms.iridium import RudicsConnection
+    from pyremotenode.comms.rudics import WindowedReceiver
+    from pyremotenode.comms.transfer import TransferJournal
+
+    class _DataConn(object):
+        """Just enough of a serial port for the windowed sender, returning whatever has arrived"""
+        def __init__(self, sock):
+            self._sock = sock
+            self.timeout = None
+            self.in_waiting = 0
+
+        def read(self, size):
+            self._sock.settimeout(self.timeout)
+            try:
+                return self._sock.recv(4096)
+            except socket.timeout:
+                return b""
+
+        def write(self, data):
+            self._sock.sendall(data)
+
+    node, ground = socket.socketpair()
+    files = []
+    for i in range(3):
+        files.append(tmp_path / "file{}.bin".format(i))
+        files[-1].write_bytes(os.urandom(3000 + i))
+
+    events = []
+    received = dict()
+    receivers = []
+    drop_at = ["file1.bin"]
+
+    def _send_filename(filename):
+        for receiver in receivers:
+            receiver.join()
+        name = os.path.basename(filename)
+        events.append(("filename", name))
+        if name in drop_at:
+            drop_at.remove(name)
+            raise ConnectionException("NO CARRIER")
+
+        received[name] = io.BytesIO()
+        receivers.append(threading.Thread(target=WindowedReceiver(_socket_reader(ground), ground.sendall,
+                                                                  timeout=10).receive, args=(received[name], )))
+        receivers[-1].start()
+
+    conn = object.__new__(RudicsConnection)
+    conn._dispatcher = None
+    conn._data_conn = _DataConn(node)
+    conn._last_write = 0.
+    conn._transfer_journal = TransferJournal(str(tmp_path / "transfers.journal"))
+    conn._rudics_protocol = "windowed"
+    conn._rudics_block_size = 1024
+    conn._rudics_window = 8
+    conn._call_redials = 1
+    conn.batch_transfers = True
+    conn._start_data_call = lambda: events.append("dial") or True
+    conn._drop_data_call = lambda: events.append("hangup")
+    conn._send_end_of_batch = lambda: events.append("endbatch")
+    conn._send_filename = _send_filename
+
+    # The whole batch goes over one call, with the call redialled where it dropped
+    sent = []
+    conn.process_transfers([str(f) for f in files], sent)
+    for receiver in receivers:
+        receiver.join()
+    assert events == ["dial", ("filename", "file0.bin"), ("filename", "file1.bin"), "hangup",
+                      "dial", ("filename", "file1.bin"), ("filename", "file2.bin"), "endbatch", "hangup"]
+    assert sent == [str(f) for f in files]
+    assert dict((n, b.getvalue()) for n, b in received.items()) == dict((f.name, f.read_bytes()) for f in files)
+
+    # A file queued again is sent again, and once out of redials whatever is left isn't marked as sent
+    extra = tmp_path / "extra.bin"
+    extra.write_bytes(os.urandom(100))
+    del events[:]
+    del receivers[:]
+    drop_at.extend(["extra.bin", "extra.bin"])
+    sent = []
+    with pytest.raises(ConnectionException):
+        conn.process_transfers([str(files[0]), str(extra)], sent)
+    assert sent == [str(files[0])]
+    assert received["file0.bin"].getvalue() == files[0].read_bytes()
+    assert events == ["dial", ("filename", "file0.bin"), ("filename", "extra.bin"), "hangup",
+                      "dial", ("filename", "extra.bin"), "hangup"]
+
+
+def test_end_data_call_guard_time(monkeypatch):
+    from pyremotenode.comms.iridium import RudicsConnection
+    from pyremotenode.comms.responses import ModemResponse
+
+    clock = [100.]
+    monkeypatch.setattr("pyremotenode.comms.iridium.tm.monotonic", lambda: clock[0])
+    monkeypatch.setattr("pyremotenode.comms.iridium.tm.sleep", lambda s: clock.__setitem__(0, clock[0] + s))
+
+    class _DataConn(object):
+        def __init__(self, out_waiting, flush_time, received=b""):
+            self.out_waiting = out_waiting
+            self._flush_time = flush_time
+            self._received = received
+
+        def flush(self):
+            clock[0] += self._flush_time
+            self.out_waiting = 0
+
+        @property
+        def in_waiting(self):
+            return len(self._received)
+
+        def read(self, size):
+            return self._received[:size]
+
+    def _hang_up(data_conn, last_write, script):
+        commands = []
+
+        def _modem_response(command, **kwargs):
+            commands.append((command, clock[0]))
+            return ModemResponse(script.pop(0))
+
+        conn = object.__new__(RudicsConnection)
+        conn.data_conn = data_conn
+        conn.modem_response = _modem_response
+        conn._last_write = last_write
+        conn._escape_guard_time, conn._hangup_timeout = 1., 5.
+        conn._end_data_call()
+        assert not script
+        return commands
+
+    # Frames still buffered when the call is ended go out during the flush, and the guard runs from then
+    assert _hang_up(_DataConn(4096, 3.), 100., ["OK", "OK"]) == [(b"+++", 104.), ("ATH0", 104.)]
+    # Nothing buffered, so the guard only makes up what hasn't passed since the last write
+    assert _hang_up(_DataConn(0, 0.), 103.75, ["OK", "OK"]) == [(b"+++", 104.75), ("ATH0", 104.75)]
+    assert _hang_up(_DataConn(0, 0.), 100., ["OK", "OK"]) == [(b"+++", 104.75), ("ATH0", 104.75)]
+    # Call dropped before or during the escape
+    assert _hang_up(_DataConn(0, 0., b"\r\nNO CARRIER\r\n"), 0., []) == []
+    assert _hang_up(_DataConn(0, 0.), 0., ["NO CARRIER"]) == [(b"+++", 104.75)]
+
+
+def test_sbd_session_drains_mailbox(tmp_path, monkeypatch):
+    from pyremotenode.comms.framing import PackedMessage
+    from pyremotenode.comms.iridium import RudicsConnection
+    from pyremotenode.comms.responses import ModemResponse
+
+    def _mt(body):
+        return struct.pack(">H", len(body)) + body + struct.pack(">H", sum(body) & 0xffff)
+
+    msg = PackedMessage([b"mo"])
+    script = [
+        ("AT+SBDWB=4", ModemResponse("READY")),
+        (None, ModemResponse("OK", ["0"])),
+        ("AT+SBDIX", ModemResponse("OK", ["+SBDIX: 18, 1, 2, 0, 0, 3"])),
+        ("AT+SBDIX", ModemResponse("OK", ["+SBDIX: 1, 2, 1, 7, 3, 2"])),
+        ("AT+SBDRB", ModemResponse("OK", binary=_mt(b"one"))),
+        ("AT+SBDD0", ModemResponse("OK")),
+        ("AT+SBDIX", ModemResponse("OK", ["+SBDIX: 0, 2, 1, 8, 3, 1"])),
+        ("AT+SBDRB", ModemResponse("OK", binary=_mt(b"two"))),
+        ("AT+SBDIX", ModemResponse("OK", ["+SBDIX: 0, 2, 1, 9, 5, 0"])),
+        ("AT+SBDRB", ModemResponse("OK", binary=_mt(b"three"))),
+        ("AT+SBDD2", ModemResponse("OK")),
+    ]
+    sleeps = []
+    monkeypatch.setattr("pyremotenode.comms.iridium.tm.sleep", sleeps.append)
+
+    def _modem_response(command, raw=False, **kwargs):
+        expected, response = script.pop(0)
+        assert command == expected or raw
+        return response
+
+    conn = object.__new__(RudicsConnection)
+    conn.modem_response = _modem_response
+    conn._dispatcher = None
+    conn.msg_xfer_timeout = 60.
+    conn.mt_destination = str(tmp_path)
+    conn.adaptive_sizing = False
+    conn._sbdix_backoff, conn._sbdix_backoff_max, conn._sbd_airtime = 2., 60., 300.
+
+    assert conn.process_message(msg)
+    assert not script
+    assert len(sleeps) == 1 and 1. <= sleeps[0] <= 2.
+    assert sorted(open(str(p), "rb").read() for p in tmp_path.iterdir()) == [b"one", b"three", b"two"]
+
+
+def test_modem_session_idle_and_offline_window(monkeypatch):
+    import time
+    import types
+    from datetime import datetime, timedelta
+
+    from pyremotenode.comms import utils
+
+    settings = {"session_idle_timeout": "0.2", "registration_valid": "60", "grace_period": "0"}
+    monkeypatch.setattr(utils, "Configuration", lambda: types.SimpleNamespace(config={"ModemConnection": settings}))
+
+    t0 = time.monotonic()
+    base = [datetime(2026, 1, 1, 10, 0)]
+
+    class _Clock(datetime):
+        @classmethod
+        def utcnow(cls):
+            return base[0] + timedelta(seconds=time.monotonic() - t0)
+    monkeypatch.setattr(utils, "datetime", _Clock)
+
+    events = []
+
+    class _Connection(object):
+        def initialise_modem(self):
+            events.append("init")
+
+        def close(self):
+            events.append("close")
+
+    power = utils.ModemPower()
+    monkeypatch.setattr(power, "power_on", lambda: events.append("on") or True)
+    monkeypatch.setattr(power, "power_off", lambda: events.append("off"))
+    session = utils.ModemSession(_Connection(), power)
+
+    # Back to back work shares one power cycle and registration, then the session ends once idle
+    assert power.offline_in() is None
+    for _ in range(2):
+        with session:
+            assert session.powered and session.registered
+    assert events == ["on", "init"]
+    time.sleep(0.4)
+    assert events == ["on", "init", "close", "off"] and not session.powered
+
+    # An idle session doesn't keep the modem powered into the offline window
+    del events[:]
+    settings["session_idle_timeout"] = "60"
+    session = utils.ModemSession(_Connection(), power)
+    power.offline_start, power.offline_end = "1200", "1300"
+    t0 = time.monotonic()
+    base[0] = datetime(2026, 1, 1, 11, 59, 59, 800000)
+    assert 0 < power.offline_in() <= 0.2
+    with session:
+        pass
+    assert session.powered
+    time.sleep(0.4)
+    assert events == ["on", "init", "close", "off"] and not session.powered
+    assert power.in_offline_time() and power.offline_in() == 0
+    assert not session.acquire()
+
+    base[0] = datetime(2026, 1, 1, 13, 30)
+    assert not power.in_offline_time()
+    assert abs(power.offline_in() - 22.5 * 3600) < 1
+
+
+def _certus_transfer(tmp_path, status, max_bytes=1000, window=1, retransmits=3):
+    from pyremotenode.comms.iridium import CertusConnection
+    from pyremotenode.comms.transfer import TransferJournal
+
+    conn = object.__new__(CertusConnection)
+    conn._transfer_journal = TransferJournal(str(tmp_path / "transfers.journal"))
+    conn._chunk_sizer = None
+    conn.adaptive_sizing = False
+    conn.adaptive_min_bytes = 256
+    conn.delta_transfers = False
+    conn._imt_max_bytes = max_bytes
+    conn._imt_window = window
+    conn._imt_poll_interval, conn._imt_poll_max = 0., 0.
+    conn._imt_mo_timeout = 600.
+    conn._imt_retransmits = retransmits
+
+    # Messages as written to the modem, and the status reported for each by message ID
+    sent = []
+
+    def _write_imt_message(buffers):
+        sent.append(b"".join(bytes(b) for b in buffers))
+        return str(len(sent))
+    conn._write_imt_message = _write_imt_message
+    conn._imt_mo_status = lambda message_id: status(int(message_id), sent)
+    return conn, sent
+
+
+def test_certus_transfer_long_name_at_minimum_size(tmp_path):
+    import os
+
+    from pyremotenode.comms.iridium import CertusConnection
+
+    data = tmp_path / ("x" * 250 + ".dat")
+    data.write_bytes(os.urandom(1000))
+
+    conn, sent = _certus_transfer(tmp_path, lambda message_id, sent: CertusConnection.IMT_MO_SENT)
+    conn.adaptive_sizing = True
+    for _ in range(3):
+        conn.chunk_sizer.failure()
+    assert conn.chunk_sizer.size == 256
+
+    header_length = struct.calcsize("!iB254sLLL")
+    assert header_length > 256
+    assert conn.process_transfer(str(data))
+    assert len(sent[0]) == header_length + 1
+    assert len(sent[0]) - header_length + sum(len(m) - struct.calcsize("!iLLL") for m in sent[1:]) == 1000
+
+
+def _certus_chunks(sent, name):
+    """File data written to the modem, by the offset of each chunk"""
+    full = struct.Struct("!iB{}sLLL".format(len(name)))
+    continuation = struct.Struct("!iLLL")
+
+    chunks = []
+    for message in sent:
+        header = full if message[4] == len(name) and message[5:5 + len(name)] == name else continuation
+        start, end = header.unpack_from(message)[-2:]
+        assert len(message) - header.size == end - start
+        chunks.append((start, message[header.size:]))
+    return chunks
+
+
+def test_certus_windowed_transfer_retransmits(tmp_path):
+    import os
+
+    import pytest
+
+    from pyremotenode.comms.connections import ConnectionException
+    from pyremotenode.comms.iridium import CertusConnection
+
+    content = os.urandom(5000)
+    data = tmp_path / "data.bin"
+    data.write_bytes(content)
+
+    # The modem loses the second chunk the first time around, only that chunk is written again
+    polled = []
+
+    def _status(message_id, sent):
+        polled.append((message_id, len(sent)))
+        return None if message_id == 2 else CertusConnection.IMT_MO_SENT
+
+    conn, sent = _certus_transfer(tmp_path, _status, window=3)
+    assert conn.process_transfer(str(data))
+    assert polled[0] == (1, 3)
+    assert max(m for m, _ in polled) == len(sent)
+
+    chunks = _certus_chunks(sent, b"data.bin")
+    starts = [start for start, _ in chunks]
+    assert len(chunks) == 7 and starts.count(chunks[1][0]) == 2 and len(set(starts)) == 6
+    assert b"".join(chunk for _, chunk in sorted(dict(chunks).items())) == content
+    assert conn.transfer_journal.is_done(conn.transfer_journal.file_key(str(data)))
+
+    # A chunk the modem never manages to send is given up on after its retransmissions
+    os.makedirs(str(tmp_path / "failing"))
+    conn, sent = _certus_transfer(tmp_path / "failing", lambda message_id, sent: None, window=2, retransmits=2)
+    with pytest.raises(ConnectionException):
+        conn.process_transfer(str(data))
+    assert [start for start, _ in _certus_chunks(sent, b"data.bin")].count(0) == 3
+    assert not conn.transfer_journal.is_done(conn.transfer_journal.file_key(str(data)))
+
+
+def test_certus_poll_streams_all_topics(tmp_path):
+    from pyremotenode.comms.iridium import CertusConnection
+    from pyremotenode.comms.responses import ModemResponse, ResponseParser
+
+    messages = {"7": [b"a" * 3000, b"b" * 10], "9": [b"c" * 5]}
+    acked = []
+
+    def _modem_response(command, binary_length=None, binary_sink=None, **kwargs):
+        if command == "AT+IMTMTS":
+            lines = ["+IMTMTS: {}, {}{}, {}".format(t, t, len(m), len(m[0])) for t, m in messages.items() if m]
+            return ModemResponse("OK", lines)
+        elif command.startswith("AT+IMTRB="):
+            body = messages[command.split("=")[1]][0]
+            block = body + struct.pack(">H", CertusConnection.calculate_crc16(body)) + b"\r\nOK\r\n"
+            parser = ResponseParser(binary_length=binary_length, binary_sink=binary_sink)
+            for i in range(0, len(block), 512):
+                parser.feed(block[i:i + 512])
+            assert parser.complete and not parser.response().binary
+            return parser.response()
+        topic, _ = [(t, m) for t, m in messages.items() if m and command == "AT+IMTA={}{}".format(t, len(m))][0]
+        acked.append(messages[topic].pop(0))
+        return ModemResponse("OK")
+
+    conn = object.__new__(CertusConnection)
+    conn.modem_response = _modem_response
+    conn.mt_destination = str(tmp_path)
+    conn.poll_for_messages()
+
+    assert len(acked) == 3
+    assert sorted(open(str(p), "rb").read() for p in tmp_path.iterdir()) == [b"a" * 3000, b"b" * 10, b"c" * 5]
+
+
+def test_fragments_reassemble_out_of_order():
+    import random
+
+    from pyremotenode.comms.compression import Compressor
+    from pyremotenode.comms.framing import FRAGMENT_HEADER, Reassembler, decode_message
+    from pyremotenode.comms.iridium import RudicsConnection
+    from pyremotenode.tasks.iridium import Message
+
+    rng = random.Random(1)
+    data = bytes(rng.getrandbits(8) for _ in range(1000))
+    sent = []
+
+    conn = object.__new__(RudicsConnection)
+    conn._rockblock = False
+    conn.pack_messages = False
+    conn.fragment_messages = True
+    conn._compressor = Compressor()
+    conn._fragment_id = 0xfffffffe
+    conn.process_message = lambda msg: sent.append(msg.get_message_text()) or True
+
+    assert conn._send_message(Message(data, binary=True, include_date=False))
+    assert len(sent) == 4 and all(len(f) <= 340 for f in sent)
+
+    reassembler = Reassembler()
+    frames = sent + sent[1:2]
+    rng.shuffle(frames)
+    results = [reassembler.add(f) for f in frames]
+    assert len([r for r in results if r is not None]) == 1
+    assert decode_message([r for r in results if r is not None][0]) == [data]
+    assert not reassembler.missing()
+
+    other = Reassembler()
+    other.add(sent[0])
+    assert list(other.missing().values()) == [[1, 2, 3]]
+    assert FRAGMENT_HEADER.unpack_from(sent[3])[1:] == (0xfffffffe, 3, 4)
+
+    # The same content sent again, and alongside another message, is a new message with its own id
+    del sent[:]
+    other_data = bytes(rng.getrandbits(8) for _ in range(1000))
+    assert conn._send_message(Message(data, binary=True, include_date=False))
+    assert conn._send_message(Message(other_data, binary=True, include_date=False))
+    assert conn._send_message(Message(data, binary=True, include_date=False))
+    assert [FRAGMENT_HEADER.unpack_from(f)[1] for f in sent[::4]] == [0xffffffff, 0, 1]
+
+    frames = sent[:]
+    rng.shuffle(frames)
+    results = [r for r in (reassembler.add(f) for f in frames) if r is not None]
+    assert sorted(decode_message(r)[0] for r in results) == sorted([data, data, other_data])
+
+
+
+def _delivery(payload, chunked=False, close=False):
+    import base64
+    import json
+
+    body = json.dumps({"imei": "300000000000000", "data": base64.b64encode(payload).decode()}).encode()
+    headers = "POST /unit HTTP/1.1\r\nContent-Type: application/json\r\n{}".format(
+        "Connection: close\r\n" if close else "")
+    if chunked:
+        chunks = b"".join(b"%x\r\n" % len(body[i:i + 7]) + body[i:i + 7] + b"\r\n" for i in range(0, len(body), 7))
+        return (headers + "Transfer-Encoding: chunked\r\n\r\n").encode() + chunks + b"0\r\n\r\n"
+    return (headers + "Content-Length: {}\r\n\r\n".format(len(body))).encode() + body
+
+
+def test_http_parser_incremental():
+    import binascii
+
+    from pyremotenode.receiver.certus import decode_delivery, verify_crc16
+    from pyremotenode.receiver.http import HTTPRequestParser
+
+    payload = b"payload" + struct.pack(">H", binascii.crc_hqx(b"payload", 0))
+    stream = _delivery(payload) + _delivery(payload, chunked=True) + _delivery(b"", close=True)
+
+    parser = HTTPRequestParser()
+    requests = []
+    for i in range(len(stream)):
+        requests += parser.feed(stream[i:i + 1])
+
+    assert parser.idle
+    assert [r.keep_alive for r in requests] == [True, True, False]
+    assert requests[0].body == requests[1].body
+    [(metadata, decoded)] = decode_delivery(requests[1].body)
+    assert metadata == {"imei": "300000000000000"} and verify_crc16(decoded) == b"payload"
+
+
+def test_certus_receiver_reassembles_node_messages(tmp_path):
+    import os
+
+    from pyremotenode.comms.iridium import CertusConnection
+    from pyremotenode.comms.responses import ModemResponse
+    from pyremotenode.receiver.certus import DeliveryProcessor
+    from pyremotenode.receiver.http import HTTPRequestParser
+
+    data = tmp_path / "log.txt"
+    data.write_bytes(os.urandom(2500))
+
+    # Messages exactly as the node writes them to the modem, trailing CRC16 and all
+    conn, _ = _certus_transfer(tmp_path, lambda message_id, sent: CertusConnection.IMT_MO_SENT)
+    del conn._write_imt_message
+    messages = []
+
+    def _modem_binary(command, buffers):
+        messages.append(b"".join(bytes(b) for b in buffers))
+        return ModemResponse("OK", ["+IMTWB: {}".format(len(messages))])
+    conn.modem_binary = _modem_binary
+    assert conn.process_transfer(str(data)) and len(messages) == 3
+
+    processor = DeliveryProcessor(str(tmp_path / "out"))
+    parser = HTTPRequestParser()
+    for message in reversed(messages):
+        [request] = parser.feed(_delivery(message))
+        assert processor.process(request)[0] == 200
+    assert (tmp_path / "out" / "files" / "log.txt").read_bytes() == data.read_bytes()
+    assert not list((tmp_path / "out").glob("**/*.msg"))
+
+
+def test_async_receiver_bounds_connections(tmp_path):
+    import asyncio
+
+    from pyremotenode.receiver.aio import AsyncDataReceiver
+
+    async def _send(receiver, payloads):
+        reader, writer = await asyncio.open_connection(*receiver.server_address)
+        responses = []
+        for i, payload in enumerate(payloads):
+            writer.write(_delivery(payload, chunked=i % 2, close=i == len(payloads) - 1))
+            await writer.drain()
+            responses.append(await reader.readuntil(b"\r\n\r\n"))
+        assert await reader.read() == b""
+        writer.close()
+        return [r.split(b"\r\n")[0] for r in responses]
+
+    async def _run():
+        receiver = AsyncDataReceiver(("127.0.0.1", 0), str(tmp_path), crc16=False, max_connections=1,
+                                     buffer_size=16)
+        await receiver.start()
+        try:
+            return await asyncio.gather(*[_send(receiver, [bytes([i, j]) * 5000 for j in range(2)])
+                                          for i in range(3)])
+        finally:
+            await receiver.stop()
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(_run()) == [[b"HTTP/1.1 200 OK"] * 2] * 3
+    finally:
+        loop.close()
+    assert sorted(open(str(p), "rb").read() for p in tmp_path.glob("*.msg")) == \
+        [bytes([i, j]) * 5000 for i in range(3) for j in range(2)]
+
+
+def _chunks(name, data, ranges):
+    import binascii
+
+    from pyremotenode.receiver.transfers import parse_chunk
+
+    name_crc = binascii.crc32(name) & 0xffff
+    chunks = []
+    for start, end in ranges:
+        if start == ranges[0][0]:
+            header = struct.pack("!iB{}sLLL".format(len(name)), name_crc, len(name), name, len(data), start, end)
+        else:
+            header = struct.pack("!iLLL", name_crc, len(data), start, end)
+        chunks.append(parse_chunk(header + data[start:end]))
+    return chunks
+
+
+def test_file_reassembly_out_of_order(tmp_path):
+    from pyremotenode.receiver.transfers import FileReassembler, parse_chunk
+
+    data = bytes(range(256)) * 20
+    first, second, third = _chunks(b"log.txt", data, [(0, 2000), (2000, 4000), (4000, 5120)])
+    assert parse_chunk(b"01-01-2024 12:00:00:message") is None
+
+    reassembler = FileReassembler(str(tmp_path))
+    assert reassembler.add(third) is None
+    assert reassembler.missing() == {"{:04x}".format(third.name_crc): (5120, [(0, 4000)])}
+    assert reassembler.add(first) is None
+
+    # Picks up where it left off after a restart, ignoring duplicates before and after completion
+    reassembler = FileReassembler(str(tmp_path))
+    assert reassembler.missing() == {"log.txt": (5120, [(2000, 4000)])}
+    assert reassembler.add(third) is None
+    output_file = reassembler.add(second)
+    assert open(output_file, "rb").read() == data
+    assert reassembler.add(second) is None and not reassembler.missing()
+
+    # Appends are sent on their own and reassembled onto the copy already received
+    appended = data + b"more"
+    [tail] = _chunks(b"log.txt", appended, [(5120, 5124)])
+    assert open(reassembler.add(tail), "rb").read() == appended
+
+    # A file that changes without changing length is still a new file
+    changed = appended[::-1]
+    [whole] = _chunks(b"log.txt", changed, [(0, len(changed))])
+    assert open(reassembler.add(whole), "rb").read() == changed
+    assert FileReassembler(str(tmp_path)).add(whole) is None
+
+    # Where only part of it changes, only the chunks that differ are written over it
+    edited = changed[:2000] + bytes(len(changed) - 2000)
+    same, edit = _chunks(b"log.txt", edited, [(0, 2000), (2000, len(edited))])
+    assert reassembler.add(same) is None
+    assert open(reassembler.add(edit), "rb").read() == edited
+
+    # The rest of an append can arrive before the chunk naming the file
+    appended, end = edited + bytes(200), len(edited)
+    named, rest = _chunks(b"log.txt", appended, [(end, end + 100), (end + 100, end + 200)])
+    assert reassembler.add(rest) is None
+    assert open(reassembler.add(named), "rb").read() == appended
+
+
+def test_shared_file_reassembly(tmp_path):
+    from pyremotenode.receiver.transfers import FileReassembler
+
+    workers = [FileReassembler(str(tmp_path), shared=True) for _ in range(2)]
+    data = bytes(range(256)) * 8
+    first, second = _chunks(b"data.bin", data, [(0, 1024), (1024, 2048)])
+    assert workers[1].add(second) is None
+    assert workers[0].missing() == {"{:04x}".format(second.name_crc): (2048, [(0, 1024)])}
+    assert open(workers[0].add(first), "rb").read() == data
+
+    # Late duplicates are dropped by every worker, including one started afterwards
+    assert workers[1].add(first) is None
+    assert FileReassembler(str(tmp_path), shared=True).add(second) is None
+    assert not any(w.missing() for w in workers)
+
+    # Whereas chunks of a different file of the same name and length are written over it, by whichever worker
+    changed = data[::-1]
+    first, second = _chunks(b"data.bin", changed, [(0, 1024), (1024, 2048)])
+    assert open(FileReassembler(str(tmp_path), shared=True).add(first), "rb").read() == changed[:1024] + data[1024:]
+    assert workers[0].add(first) is None
+    assert open(workers[1].add(second), "rb").read() == changed
+
+
+def test_segment_store_group_commit_and_compact(tmp_path):
+    import os
+    import threading
+
+    import pytest
+
+    from pyremotenode.receiver.storage import SegmentStore, compact, partition_path, scan, segment_paths
+
+    store = SegmentStore(str(tmp_path), segment_bytes=4096, sync_delay=0.01)
+    record_time = 1700000000.
+
+    def _writer(n):
+        for i in range(25):
+            store.append(record_time + i, "300/1", "{}-{}".format(n, i).encode() * 20, {"writer": n})
+
+    threads = [threading.Thread(target=_writer, args=(n, )) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    syncs = store._syncs
+    store.close()
+
+    partition = partition_path(str(tmp_path), record_time, "300/1")
+    assert partition == os.path.join(str(tmp_path), "2023", "11", "14", "300_1")
+    assert syncs < 200 and len(segment_paths(partition)) > 1
+    assert len(list(scan(partition))) == 200
+
+    # Identical payloads delivered together are all kept, and a torn write at the end gives a damaged record
+    store = SegmentStore(str(tmp_path), segment_bytes=4096)
+    for _ in range(3):
+        store.append(record_time, "300/1", b"same", {"writer": 0})
+    store.close()
+    with open(segment_paths(partition)[-1], "ab") as fh:
+        fh.write(b"\x52\x00\x00")
+    expected = sorted(["{}-{}".format(n, i).encode() * 20 for n in range(8) for i in range(25)] + [b"same"] * 3)
+
+    # A compaction interrupted after moving the first of its segments into place is finished by the next
+    real_replace = os.replace
+    moved = []
+
+    def _interrupted_replace(src, dst):
+        if src.endswith(".log") and ".compact" in src:
+            if len(moved):
+                raise KeyboardInterrupt
+            moved.append(dst)
+        real_replace(src, dst)
+
+    os.replace = _interrupted_replace
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            compact(partition, segment_bytes=4096)
+    finally:
+        os.replace = real_replace
+    assert len(moved) == 1 and os.path.exists(os.path.join(partition, ".compact", "replaces"))
+
+    assert compact(partition, segment_bytes=1 << 20) == (203, 0)
+    assert len(segment_paths(partition)) == 1
+    assert not os.path.exists(os.path.join(partition, ".compact"))
+    assert sorted(p for _, _, p in scan(partition)) == expected
+
+
+def test_segment_store_recovers_torn_write(tmp_path):
+    import os
+
+    from pyremotenode.receiver.storage import INDEX_ENTRY, SegmentStore, compact, encode_record, index_path, \
+        partition_path, scan, segment_paths
+
+    record_time = 1700000000.
+    store = SegmentStore(str(tmp_path))
+    for i in range(5):
+        store.append(record_time + i, "unit", b"before-%d" % i)
+    store.close()
+
+    # Power lost part way through a record, after its index entry went out
+    [segment] = segment_paths(partition_path(str(tmp_path), record_time, "unit"))
+    torn = encode_record(record_time + 5, {}, b"torn" * 10)
+    with open(index_path(segment), "ab") as fh:
+        fh.write(INDEX_ENTRY.pack(os.path.getsize(segment), len(torn), record_time + 5))
+    with open(segment, "ab") as fh:
+        fh.write(torn[:len(torn) // 2])
+
+    store = SegmentStore(str(tmp_path))
+    for i in range(5):
+        store.append(record_time + 10 + i, "unit", b"after-%d" % i)
+    store.close()
+
+    expected = [b"before-%d" % i for i in range(5)] + [b"after-%d" % i for i in range(5)]
+    partition = os.path.dirname(segment)
+    assert [p for _, _, p in scan(partition)] == expected
+    assert os.path.getsize(index_path(segment)) == 10 * INDEX_ENTRY.size
+    assert compact(partition) == (10, 0)
+    assert [p for _, _, p in scan(partition)] == expected
+
+
+def test_workers_share_port_and_restart(tmp_path):
+    import os
+    import signal
+    import socket
+    import time
+
+    from pyremotenode.receiver.certus import DataReceiverHandler, JSONDataReceiver
+    from pyremotenode.receiver.storage import SegmentStore, re_segment, scan, segment_paths
+    from pyremotenode.receiver.workers import WorkerSupervisor
+
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    store_dir = str(tmp_path / "store")
+
+    def worker_main(worker):
+        store = SegmentStore(store_dir, writer=worker)
+        server = JSONDataReceiver(("127.0.0.1", port), DataReceiverHandler, str(tmp_path / "out"),
+                                  crc16=False, store=store, worker=worker)
+        (tmp_path / "w{}.{}".format(worker, os.getpid())).touch()
+        try:
+            server.serve_forever(0.05)
+        finally:
+            store.close()
+
+    def pids(worker):
+        return [int(p.name.split(".")[1]) for p in tmp_path.glob("w{}.*".format(worker))]
+
+    def wait_for(condition):
+        deadline = time.monotonic() + 10
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+    def send(n):
+        for i in range(n):
+            with socket.create_connection(("127.0.0.1", port)) as s:
+                s.sendall(_delivery(b"payload-%d" % i, close=True))
+                assert s.recv(1024).startswith(b"HTTP/1.1 200")
+
+    supervisor = os.fork()
+    if supervisor == 0:
+        try:
+            WorkerSupervisor(2, worker_main, restart_delay=0.1).run()
+        finally:
+            os._exit(0)
+
+    try:
+        wait_for(lambda: len(pids(0)) and len(pids(1)))
+        send(20)
+        os.kill(pids(0)[0], signal.SIGKILL)
+        wait_for(lambda: len(pids(0)) == 2)
+        send(20)
+    finally:
+        os.kill(supervisor, signal.SIGTERM)
+        assert os.waitpid(supervisor, 0)[1] == 0
+
+    partitions = set(os.path.dirname(p) for p in tmp_path.glob("store/*/*/*/*/segment-*.log"))
+    assert len(partitions) == 1
+    segments = segment_paths(partitions.pop())
+    assert set(re_segment.match(os.path.basename(s)).group(2) for s in segments) == {"0", "1"}
+    assert len([r for r in scan(os.path.dirname(segments[0]))]) == 40